@@ -2,14 +2,20 @@
 
 import os
 import glob
+import datetime
 import PIL.Image
 
 import logging
 logger = logging.getLogger(__name__)
 
 from BaseClass import BaseClass
-from wolf_utils.PILhelper import get_all_exif, is_gray, get_all_iptcs
+from wolf_utils.PILhelper import get_all_exif, is_gray, get_all_iptcs, get_exif_value, get_dimensions
+from wolf_utils.image_header import get_image_dimensions
+from wolf_utils.thumbnails import DEFAULT_LEVELS, ThumbnailPack, make_pyramid
 from Storage.DataStorage import BasicAnalysisDataStorage
+from wolf_utils.cache import hash_file
+from wolf_utils.tracing import trace
+from wolf_utils.sharding import get_shard_of_path, get_shards_of_batches
 
 
 
@@ -20,30 +26,181 @@ class BasicAnalysisClass(BaseClass):
         self.run_num = run_num
 
     def run(self, ctx):
+        for _ in self.stream(ctx, None):
+            pass
+
+        return True, ctx
+
+    def can_stream(self, upstream_output):
+        # We are always the source
+        return upstream_output is None
+
+    def get_stream_output(self, upstream_output):
+        return "Storage.DataStorage.BasicAnalysisDataStorage", "get_all_images"
+
+    def get_time_batching_config(self):
+        # The config of the time batching later on (if any)
+        for m in self.config["modules"]:
+            if m["name"] == "Batching.TimeBatching.TimeBatchingClass":
+                return m
+        return None
+
+    def get_time_source(self):
+        # The exif tag used by the time batching later on (if any)
+        time_batching_config = self.get_time_batching_config()
+        return time_batching_config["exif_time_source"] if time_batching_config is not None else None
+
+    def get_thumbnail_levels(self):
+        """
+        The levels of the thumbnail pyramid: "thumbnails" in the module config, true for the default levels, false
+        (default) for none
+        """
+        levels = self.get_module_config().get("thumbnails", False)
+        if levels is True:
+            levels = DEFAULT_LEVELS
+        return list(levels) if levels else []
+
+    def get_images(self, ctx=None):
+        """
+        Return the input images in the order of glob
+
+        If this is a sharded run, only the images of this shard are returned (c.f. get_shard_images).
+        """
+        images = glob.glob(self.get_input_data() + "/*." + self.get_main_config()["image_filetype"])
+
+        if ctx is not None and ctx.get("shard") is not None:
+            images = self.get_shard_images(images, ctx["shard"])
+        return images
+
+    def sort_by_time(self, images):
+        """
+        Return the images sorted by the timestamp used by the time batching and a dict image -> timestamp. Only the
+        header is read. Images without a valid timestamp are moved to the end
+        """
+        time_source = self.get_time_source()
+
+        def get_timestamp(image):
+            try:
+                with PIL.Image.open(image) as img:
+                    return datetime.datetime.strptime(get_exif_value(img, time_source), "%Y:%m:%d %H:%M:%S")
+            except Exception:
+                return None
+
+        timestamps = {image: get_timestamp(image) for image in images}
+        images = sorted(images, key=lambda i: (timestamps[i] is None, timestamps[i] or datetime.datetime.min))
+        return images, timestamps
+
+    def get_processing_order(self, images):
+        """
+        Return the images in the order they are analysed
+
+        In the streaming mode, images batched by time later on are sorted by their timestamp. This way, complete
+        batches are available as early as possible. Otherwise, the order of get_images is kept.
+        """
+        if self.get_time_source() is None or not self.get_main_config().get("streaming", False):
+            return images
+        return self.sort_by_time(images)[0]
+
+    def get_shard_images(self, images, shard):
+        """
+        Return the images of one shard
+
+        "shard_by" in the main config selects how the images are split: "batch" keeps the time batches together
+        (default if the images are batched by time), "path" uses the hash of the image path.
+        """
+        shard_by = self.get_main_config().get("shard_by", "batch" if self.get_time_source() is not None else "path")
+        if shard_by == "batch":
+            if self.get_time_source() is None:
+                raise ValueError("Sharding by batch requires the TimeBatchingClass")
+            by_time, timestamps = self.sort_by_time(images)
+            shard_of_image = dict(zip(by_time, get_shards_of_batches(
+                [timestamps[i] for i in by_time],
+                self.get_time_batching_config()["max_timediff_s"],
+                shard["count"],
+            )))
+            shards = [shard_of_image[i] for i in images]
+        elif shard_by == "path":
+            shards = [get_shard_of_path(i, self.get_input_data(), shard["count"]) for i in images]
+        else:
+            raise ValueError(f"Unknown shard_by {shard_by}. Use batch or path")
+
+        images = [i for i, s in zip(images, shards) if s == shard["index"]]
+        logger.info(f"Shard {shard['index']}/{shard['count']}: {len(images)} images")
+        return images
+
+    def stream(self, ctx, inputs):
         logger.info(f"Identifier: {self.get_step_identifier()}")
         logger.info(f"Config: {self.get_module_config()}")
-        images = glob.glob(self.get_input_data() + "/*." + self.get_main_config()["image_filetype"])
+        images = self.get_images(ctx)
 
         ds = BasicAnalysisDataStorage(self.get_sqlite_file(ctx))
+        order = self.get_processing_order(images)
+        if order != images:
+            # The ids of the images follow the order of get_images as in the batch mode
+            ds.get_image_ids(images)
+        cache = self.get_result_cache()
+        journal = self.get_journal(ctx)
+        done = journal.get_done(self.get_step_identifier())
 
-        for image in images:
+        writer = self.get_bulk_writer(ctx, ds.store_many, purge=ds.delete_for_images)
+        levels = self.get_thumbnail_levels()
+        pack = ThumbnailPack(ds.thumbnails.get_pack_file()) if len(levels) else None
+        for image in order:
+            if image in done:
+                # Stored by an interrupted run
+                yield image
+                continue
             logger.info(f"Processing image {image}")
-            with PIL.Image.open(image) as img:
-                imageIsGray = is_gray(img)
-                ds.store(
-                        fullpath = image,
-                        imageIsGray = imageIsGray,
-                        exifs = get_all_exif(img),
-                        iptcs = get_all_iptcs(img),
-                        )
-
-        ctx["steps"].append({
+            key = self.get_cache_key({}, hash_file(image)) if cache is not None else None
+            analysis = cache.get(key) if key is not None else None
+
+            thumbnails = []
+            if pack is not None:
+                try:
+                    with trace("thumbnails"):
+                        for level, frame in make_pyramid(image, levels):
+                            thumbnails.append(dict(pack.append(frame), level=level))
+                except Exception as e:
+                    logger.warning(f"Cannot create the thumbnails of {image}: {e}")
+
+            if analysis is None:
+                with trace("analyse"), PIL.Image.open(image) as img:
+                    analysis = {
+                        "imageIsGray": is_gray(img),
+                        "exifs": get_all_exif(img),
+                        "iptcs": get_all_iptcs(img),
+                        "dimensions": get_dimensions(img),
+                    }
+                if key is not None:
+                    cache.put(key, self.get_step_identifier(), analysis)
+            elif analysis.get("dimensions") is None:
+                # Cached by an older version
+                analysis["dimensions"] = get_image_dimensions(image)
+
+            # The images are passed on once their metadata is in the database
+            yield from writer.add([{
+                        "fullpath": image,
+                        "imageIsGray": analysis["imageIsGray"],
+                        "exifs": analysis["exifs"],
+                        "iptcs": analysis["iptcs"],
+                        "dimensions": analysis["dimensions"],
+                        "thumbnails": thumbnails,
+                        }], item=image, key=image)
+        yield from writer.flush()
+        if pack is not None:
+            pack.close()
+
+        step = {
                 "identifier" : self.get_step_identifier(),
                 "num_images" : len(images),
-                "sqlite_file" : self.get_sqlite_file(ctx)
-                })
-
-        return True, ctx
+                "skipped_images" : len(done),
+                "sqlite_file" : self.get_sqlite_file(ctx),
+                "storage" : writer.get_stats(),
+                "thumbnail_levels" : levels,
+                }
+        if cache is not None:
+            step["cache"] = cache.get_stats()
+        ctx["steps"].append(step)
 
 if __name__ == "__main__":
     pass
@@ -4,12 +4,12 @@ import logging
 import os
 import sys
 
-import cv2
 from pathlib import Path
 
 from Storage.BackmappingStorage import BackmappingStorage
 from Storage.SimpleLabelStorage import SimpleLabelStorage
-from wolf_utils.misc import getter_factory, draw_text
+from wolf_utils.misc import getter_factory, iter_getter_factory
+from wolf_utils.rendering import get_renderer, Drawing
 
 
 logger = logging.getLogger(__name__)
@@ -17,6 +17,7 @@ logger = logging.getLogger(__name__)
 from BaseClass import BaseClass
 from Storage.DataStorage import BaseStorage, SegmentDataStorage
 from Storage.DetectionStorage import DetectionStorage
+from Storage.LineageStorage import LineageStorage
 
 
 
@@ -33,6 +34,21 @@ class BackmappingClass(BaseClass):
         bs = BaseStorage(self.get_sqlite_file(ctx))
         all_votings = [] # Collect the votings
 
+        # The full-scale votings of all artifacts with a lineage, each with one join. Artifacts without (e.g. from
+        # databases created before the lineage table) use the get_fullscale_voting chain
+        lineage_votings = LineageStorage(self.get_sqlite_file(ctx)).get_fullscale_votings(
+            SegmentDataStorage.get_class().__name__)
+        lineage_votings.update(DetectionStorage(self.get_sqlite_file(ctx)).get_fullscale_votings())
+        lineage_votings.update(SimpleLabelStorage(self.get_sqlite_file(ctx)).get_fullscale_votings())
+        logger.info(f"Got {len(lineage_votings)} votings from the lineage")
+
+        def get_lineage_voting(path):
+            voting = lineage_votings.get(path)
+            if voting is None:
+                return None
+            # Copy: The votings of the duplicates are extended
+            return dict(voting, votings=list(voting["votings"]))
+
 
         # Start the duplicate handler for this instance
         if "duplicates" in self.get_module_config():
@@ -52,7 +68,7 @@ class BackmappingClass(BaseClass):
             input_getter = input_source["getter"]
             logger.info(f"Using input_source {input_dataclass} with getter {input_getter} from config.")
 
-            for image in getter_factory(input_dataclass, input_getter, self.get_sqlite_file(ctx))():
+            for image in iter_getter_factory(input_dataclass, input_getter, self.get_sqlite_file(ctx))():
                 logger.info(f"Image: {image}")
                 logger.info(f"class: {image.source_class}.{image.source_getter}")
 
@@ -90,16 +106,24 @@ class BackmappingClass(BaseClass):
 
                 if isinstance(image, DetectionStorage.get_class()):
                     # We are a detection -> take directly the votings.
-                    voting = DetectionStorage.get_fullscale_voting(image, self.get_sqlite_file(ctx))
+                    voting = get_lineage_voting(image.cut_image) or \
+                             DetectionStorage.get_fullscale_voting(image, self.get_sqlite_file(ctx))
 
                 elif isinstance(image, SimpleLabelStorage.get_class()):
-                    voting = SimpleLabelStorage.get_fullscale_voting(image, self.get_sqlite_file(ctx))
+                    voting = get_lineage_voting(image.dest_fullpath) or \
+                             SimpleLabelStorage.get_fullscale_voting(image, self.get_sqlite_file(ctx))
 
                 else:
                     raise ValueError(f"Unhandled class: {type(image)}")
 
                 all_votings.append(voting)
                 for dup in image_duplicates:
+                    dup_voting = get_lineage_voting(dup.fullpath)
+                    if dup_voting is not None:
+                        dup_voting["votings"].extend(voting["votings"])
+                        all_votings.append(dup_voting)
+                        continue
+
                     img = getter_factory(dup.dataclass, dup.getter, self.get_sqlite_file(ctx))(dup.fullpath)[0]
 
 
@@ -122,37 +146,39 @@ class BackmappingClass(BaseClass):
         logger.info(f"Now, we have {len(all_votings)}. Storing everything to the database...")
 
         backmapping_storage = BackmappingStorage(self.get_sqlite_file(ctx))
+        writer = self.get_bulk_writer(ctx, backmapping_storage.store_many, journal=False)
         for voting in all_votings:
-            backmapping_storage.store(
-                image_fullpath=voting["orig_image_fullpath"],
-                image_name=voting["orig_image_name"],
-                source=voting["source"],
-                votings=voting["votings"],
-                x_min=voting["x_min"],
-                x_max=voting["x_max"],
-                y_min=voting["y_min"],
-                y_max=voting["y_max"]
-            )
+            writer.add([{
+                "image_fullpath": voting["orig_image_fullpath"],
+                "image_name": voting["orig_image_name"],
+                "source": voting["source"],
+                "votings": voting["votings"],
+                "x_min": voting["x_min"],
+                "x_max": voting["x_max"],
+                "y_min": voting["y_min"],
+                "y_max": voting["y_max"],
+            }])
+        writer.flush()
 
         logger.info("Storing boxes in images...")
 
         output_dir = os.path.join(self.get_current_data_dir(ctx), "boxes")
         Path(output_dir).mkdir(parents=True, exist_ok=True)
 
-        for backmapping_image in backmapping_storage.get_all_images():
-            img =cv2.imread(backmapping_image)
+        renderer = get_renderer()
+        for backmapping_image in backmapping_storage.iter_all_images():
+            drawing = Drawing()
             for bm in backmapping_storage.get_backmappings_for_image(backmapping_image):
-                cv2.rectangle(img, (int(bm.x_min), int(bm.y_min)),
-                              (int(bm.x_max), int(bm.y_max)), (0, 0, 255), 2)
+                drawing.rectangle((int(bm.x_min), int(bm.y_min)),
+                                  (int(bm.x_max), int(bm.y_max)), (0, 0, 255), 2)
                 w = bm.x_max - bm.x_min
                 h = bm.y_max- bm.y_min
-                draw_text(
-                    img=img,
+                drawing.draw_text(
                     text=str(bm.votings),
                     pos=(int(bm.x_max) - int(w / 2), int(bm.y_max) - int(h / 2)),
                 )
 
-            cv2.imwrite(os.path.join(output_dir, bm.image_name), img)
+            renderer.render(os.path.join(output_dir, bm.image_name), backmapping_image, drawing)
 
         logger.info("Done")
 
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import os
+import glob
 import json
 import datetime
 import shutil
@@ -8,10 +9,20 @@ from pathlib import Path
 import logging
 import pickle
 import pprint
+from collections import deque
 
 import argparse
 
-from wolf_utils.misc import slugify, getter_factory
+from wolf_utils.misc import slugify, instance_factory
+from wolf_utils.streaming import StreamingPipeline
+from wolf_utils.cache import make_cache_key
+from wolf_utils.tracing import get_tracer
+from wolf_utils.memory import get_memory_governor
+from wolf_utils.frame_cache import get_frame_cache, create_shared_dir, remove_shared_dir
+from wolf_utils.rendering import get_renderer
+from wolf_utils.sharding import parse_shard
+from wolf_utils.parallel import map_work_units, get_num_workers
+from wolf_utils.manifest import get_class_manifest, get_missing_modules, get_module_directory, ManifestError
 from wolf_utils.ColorLogger import CustomFormatter
 
 logfile = "run_" + slugify(datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")) + "_logfile.log"
@@ -57,20 +68,115 @@ class BaseClass:
     def get_sqlite_file(self, ctx, name="metadata.sqlite"):
         return "sqlite:///" + os.path.abspath(os.path.join(ctx["output_dir"], name))
 
-    def run(self, ctx=None, cont=0):
+    def get_merged_context(self, shard_dirs, output):
+        """
+        Merge the results of sharded runs (c.f. --shard) into a new output directory
+
+        All shards have to be finished up to the same step. Returns the context to continue with and the number of the
+        next step.
+        """
+        from Storage.ShardMerge import merge_database
+
+        shard_ctxs = []
+        for shard_dir in shard_dirs:
+            ctx_files = glob.glob(os.path.join(shard_dir, "*_end_ctx.pickle"))
+            if not len(ctx_files):
+                raise ValueError(f"No finished step found in {shard_dir}")
+            last_step = max(int(os.path.basename(f).split("_", 1)[0]) for f in ctx_files)
+            with open(os.path.join(shard_dir, f"{last_step}_end_ctx.pickle"), "rb") as f:
+                shard_ctxs.append(pickle.load(f))
+
+        num_steps = {len(c["steps"]) for c in shard_ctxs}
+        if len(num_steps) != 1:
+            raise ValueError(f"The shards finished a different number of steps: {num_steps}. Use -u/--until.")
+        num_steps = num_steps.pop()
+
+        shards = [c.get("shard") for c in shard_ctxs]
+        if None not in shards and sorted(s["index"] for s in shards) != list(range(shards[0]["count"])):
+            logger.warning(f"Not all shards are merged: {shards}")
+
+        ctx = self.get_new_context(output=output)
+        ctx["shards"] = [os.path.abspath(d) for d in shard_dirs]
+        for shard_dir in shard_dirs:
+            merge_database(self.get_sqlite_file({"output_dir": shard_dir}), self.get_sqlite_file(ctx))
+
+        # The files created by the shards stay in the shard directories
+        for n in range(num_steps):
+            step = dict(shard_ctxs[0]["steps"][n])
+            if "sqlite_file" in step:
+                step["sqlite_file"] = self.get_sqlite_file(ctx)
+            step["shards"] = [c["steps"][n] for c in shard_ctxs]
+            ctx["steps"].append(step)
+
+        with open(os.path.join(ctx["output_dir"], f"{num_steps - 1}_end_ctx.pickle"), "wb") as f:
+            pickle.dump(ctx, f)
+        logger.info(f"Merged {len(shard_dirs)} shards with {num_steps} steps into {ctx['output_dir']}")
+        return ctx, num_steps
+
+    def run(self, ctx=None, cont=0, until=None):
+        """
+        Run the modules starting with step cont. If until is given, stop before this step
+        """
         if ctx is None:
             ctx = self.get_new_context()
-        for i, m in enumerate(self.config["modules"][cont:], start=cont):
-            cont, ctx = getter_factory(m["name"], "run", i, config=self.config_filename)(ctx)
+        # The single spans for the trace file. The summary per step is always part of the step output
+        get_tracer().keep_events = self.get_main_config().get("trace", False)
+        memory_budget_mb = self.get_main_config().get("memory_budget_mb", None)
+        get_memory_governor().set_budget(int(memory_budget_mb * 1024 ** 2) if memory_budget_mb is not None else None)
+        frame_cache_mb = self.get_main_config().get("frame_cache_mb", None)
+        if frame_cache_mb:
+            get_frame_cache().configure(
+                int(frame_cache_mb * 1024 ** 2),
+                create_shared_dir() if self.get_main_config().get("frame_cache_shared", False) else None,
+            )
+        self.configure_renderer(ctx)
+
+        from Storage.EngineRegistry import configure_sqlite, dispose_engines
+        from Storage.DatabaseWriter import start_writer, stop_writer
+        configure_sqlite(self.get_main_config().get("sqlite_pragmas", None))
+        # All writes through one thread: Without concurrent modules (i.e. streaming), this is only an extra thread hop
+        if self.get_main_config().get("sqlite_single_writer", self.get_main_config().get("streaming", False)):
+            start_writer()
+
+        first_step = cont
+        last_step = len(self.config["modules"]) if until is None else min(until, len(self.config["modules"]))
+        i = cont
+        while i < last_step:
+            m = self.config["modules"][i]
+
+            stages = self.get_streaming_stages(i)[:last_step - i]
+            if len(stages) > 1:
+                logger.info(f"Streaming steps {i} to {i + len(stages) - 1}: {', '.join(s.get_step_identifier() for s in stages)}")
+                queue_size = self.get_main_config().get("streaming_queue_size", 2)
+                for stage, steps in zip(stages, StreamingPipeline(stages, queue_size).run(ctx)):
+                    ctx["steps"].extend(steps)
+                    get_renderer().flush()
+                    # Store the end context of each streamed step to be able to continue as in the batch mode
+                    with open(os.path.join(ctx["output_dir"], f"{i}_end_ctx.pickle"), "wb") as f:
+                        pickle.dump(ctx, f)
+                    self.get_journal(ctx).clear(stage.get_step_identifier())
+                    i += 1
+                continue
+
+            module = instance_factory(m["name"], i, config=self.config_filename)
+            with get_tracer().step(module.get_step_identifier()) as stats:
+                cont, ctx = module.run(ctx)
+                # The debug images of the step are complete with the step
+                get_renderer().flush()
+            if len(ctx["steps"]):
+                ctx["steps"][-1]["trace"] = stats
 
             # Store the end context to a pickle
             with open(os.path.join(ctx["output_dir"], f"{i}_end_ctx.pickle"), "wb") as f:
                 pickle.dump(ctx, f)
+            # The step is complete: The journal is not required anymore
+            self.get_journal(ctx).clear(module.get_step_identifier())
 
             # Previous step indicated to stop now
             if not cont:
                 logger.info(f"Process stop was indicated by {m['name']}. Check output for further information.")
                 break
+            i += 1
 
         if "continue_start" in ctx:
             ctx["continue_end"] = datetime.datetime.now().isoformat()
@@ -79,12 +185,162 @@ class BaseClass:
             ctx["end"] = datetime.datetime.now().isoformat()
             ctx["duration"] = (datetime.datetime.fromisoformat(ctx["end"]) - datetime.datetime.fromisoformat(ctx["start"])).total_seconds()
 
+        if get_tracer().keep_events:
+            trace_file = os.path.join(ctx["output_dir"], "trace.json" if first_step == 0 else f"trace_from_{first_step}.json")
+            get_tracer().export(trace_file)
+            ctx["trace_file"] = trace_file
+
+        # Frames shared by the workers
+        remove_shared_dir()
+
+        writer_stats = stop_writer()
+        if writer_stats is not None:
+            ctx["database_writer"] = writer_stats
+        # Closing the connections merges the write-ahead log into the database file
+        dispose_engines()
+
         pp = pprint.PrettyPrinter(indent=4)
         logger.info(f"Final context:\n {pp.pformat(ctx)}\n")
 
     def get_main_config(self):
         return self.config["main_config"]
 
+    def configure_renderer(self, ctx):
+        """
+        Configure the rendering of the debug images from the main config (c.f. wolf_utils.rendering)
+        """
+        get_renderer().configure(
+            self.get_main_config().get("render", "inline"),
+            self.get_main_config().get("render_workers", None),
+            self.get_main_config().get("render_scale", None),
+            self.get_main_config().get("render_jpeg_quality", None),
+            self.get_sqlite_file(ctx),
+        )
+
+    def render_pending(self, output):
+        """
+        Render the images stored by a run with "render": "lazy" in the main config
+        """
+        get_renderer().configure("inline", self.get_main_config().get("render_workers", None))
+        rendered = get_renderer().render_pending(output)
+        logger.info(f"Rendered {rendered} images in {output}")
+        return rendered
+
+    def get_streaming_stages(self, start):
+        """
+        Return the module instances which can be streamed starting with the module number start
+
+        Only used if "streaming" is enabled in the main config. The first module has to be a source (i.e. accept no
+        input stream), each further module has to accept the output of its predecessor.
+        """
+        if not self.get_main_config().get("streaming", False):
+            return []
+
+        stages = []
+        upstream_output = None
+        for i in range(start, len(self.config["modules"])):
+            module = instance_factory(self.config["modules"][i]["name"], i, config=self.config_filename)
+            if not module.can_stream(upstream_output):
+                break
+            stages.append(module)
+            upstream_output = module.get_stream_output(upstream_output)
+            if upstream_output is None:
+                break
+        return stages
+
+    # Streaming API: Modules supporting the streaming mode override can_stream, get_stream_output and stream.
+
+    def can_stream(self, upstream_output):
+        """
+        Can this module consume the units produced by the previous module?
+
+        upstream_output is the (dataclass, getter) tuple describing the units of the previous module or None if this
+        module would be the first one of the stream.
+        """
+        return False
+
+    def get_stream_output(self, upstream_output):
+        """
+        Return the (dataclass, getter) tuple describing the units yielded by stream or None if nothing is yielded
+        """
+        return None
+
+    def stream_accepts_input(self, upstream_output):
+        """
+        True if the first input of this module is the output of the previous module
+        """
+        inputs = self.get_module_config().get("inputs", [])
+        return upstream_output is not None and len(inputs) > 0 and \
+            (inputs[0]["dataclass"], inputs[0]["getter"]) == tuple(upstream_output)
+
+    def stream(self, ctx, inputs):
+        """
+        Streaming version of run: A generator consuming the units of the previous module
+
+        The units yielded have to carry the same data as the ones the getter from get_stream_output returns once
+        this module is done. The step has to be appended to the ctx as in run.
+        """
+        raise NotImplementedError(f"{self.__class__.__name__} does not support the streaming mode")
+
+
+    def get_plan(self, cont=0, output=None):
+        """
+        Check the config without running or importing the modules (c.f. wolf_utils.manifest)
+
+        Returns the lines describing the execution plan and a list of errors
+        """
+        lines = []
+        errors = []
+        main_config = self.get_main_config()
+
+        image_dir = main_config.get("image_dir")
+        if image_dir is None or not os.path.isdir(image_dir):
+            errors.append(f"Image directory {image_dir} does not exist")
+        else:
+            num_images = len(glob.glob(image_dir + "/*." + main_config.get("image_filetype", "")))
+            lines.append(f"Images: {num_images} *.{main_config.get('image_filetype')} files in {image_dir}")
+            if num_images == 0:
+                errors.append(f"No images found in {image_dir}")
+
+        if cont > 0:
+            ctx_file = os.path.join(output or "", f"{cont-1}_end_ctx.pickle")
+            if output is None or not os.path.isfile(ctx_file):
+                errors.append(f"Cannot continue from step {cont}: {ctx_file} does not exist")
+
+        for key in ["workers", "streaming", "cache_dir"]:
+            if key in main_config:
+                lines.append(f"{key}: {main_config[key]}")
+
+        for i, m in enumerate(self.config["modules"]):
+            state = "skipped" if i < cont else "run"
+            lines.append(f"{i:3d} [{state}] {m['name']}")
+            try:
+                manifest = get_class_manifest(m["name"])
+            except ManifestError as e:
+                errors.append(f"Step {i}: {e}")
+                continue
+            if "run" not in manifest.methods:
+                errors.append(f"Step {i}: {m['name']} has no run method")
+            missing = get_missing_modules(manifest)
+            if len(missing):
+                lines.append(f"      missing dependencies: {', '.join(missing)}")
+
+            # Inputs and other sources like the duplicates of the backmapping
+            sources = list(m.get("inputs", [])) + [v for v in m.values() if isinstance(v, dict) and "dataclass" in v]
+            for source in sources:
+                lines.append(f"      input: {source['dataclass']} -> {source['getter']}")
+                try:
+                    if source["getter"] not in get_class_manifest(source["dataclass"]).methods:
+                        errors.append(f"Step {i}: {source['dataclass']} has no getter {source['getter']}")
+                except ManifestError as e:
+                    errors.append(f"Step {i}: {e}")
+
+            if "detect_model" in m and "detect_loader" not in m and i >= cont:
+                model_file = os.path.join(get_module_directory(m["name"]), m["detect_model"])
+                if not os.path.isfile(model_file):
+                    errors.append(f"Step {i}: Model file {model_file} does not exist")
+
+        return lines, errors
 
     def get_last_config(self, key):
         for i in range(self.run_num, 0, -1):
@@ -127,6 +383,273 @@ class BaseClass:
         Path(p).mkdir(parents=True, exist_ok=True)
         return p
 
+    # Work unit API: Modules with independent items (images, batches, ...) can override get_work_units,
+    # process_work_unit and store_work_unit_result and call run_work_units from their run method.
+
+    def get_num_workers(self):
+        """
+        Number of worker processes for this module: "workers" from the module config, the main config or 1.
+        0 uses all available cores.
+        """
+        return get_num_workers(self.get_module_config().get("workers", self.get_main_config().get("workers", 1)))
+
+    def get_work_units(self, ctx):
+        """
+        Return an iterable of the independent items handled by this module
+        """
+        raise NotImplementedError(f"{self.__class__.__name__} does not implement the work unit API")
+
+    def get_work_unit_args(self, ctx):
+        """
+        Return a tuple of additional arguments for process_work_unit. Has to be picklable
+        """
+        return tuple()
+
+    @staticmethod
+    def process_work_unit(item, *args):
+        """
+        Handle one item. Runs in a worker process: Has to be free of side effects on the database and the ctx
+        """
+        raise NotImplementedError("process_work_unit is not implemented")
+
+    def store_work_unit_result(self, ctx, item, result):
+        """
+        Store the result of one item. Called in the main process in the order given by get_work_units
+
+        If get_work_unit_rows returns rows for the item, only the rest (e.g. output images) is stored here.
+        """
+        pass
+
+    def get_work_unit_rows(self, ctx, item, result):
+        """
+        Return the database rows of a result which are written in bulk by store_work_unit_rows or None if
+        store_work_unit_result stores the item on its own
+        """
+        return None
+
+    def store_work_unit_rows(self, ctx, rows):
+        """
+        Store the rows of several items with one transaction, e.g. using store_many of a storage
+        """
+        raise NotImplementedError(f"{self.__class__.__name__} does not implement store_work_unit_rows")
+
+    def get_work_unit_cache_key(self, ctx, item):
+        """
+        Return the key of the item for the result cache or None if the results should not be cached
+        """
+        return None
+
+    def to_cache(self, ctx, item, result):
+        """
+        Convert a result to a self-contained value for the result cache (i.e. include the content of created files)
+        """
+        return result
+
+    def from_cache(self, ctx, item, value):
+        """
+        Convert a value from the result cache back to a result (i.e. restore the files)
+        """
+        return value
+
+    def get_work_unit_journal_key(self, ctx, item):
+        """
+        Return the key of the item for the journal or None if this module does not journal its items (c.f. get_journal)
+        """
+        return None
+
+    def purge_work_unit(self, ctx, item):
+        """
+        Remove everything stored for an item. Called before the result of a journaled item is stored: The item might
+        have been stored partially by an interrupted run
+        """
+        pass
+
+    def purge_work_units(self, ctx, items):
+        """
+        Remove everything stored for several items. Override for a bulk delete
+        """
+        for item in items:
+            self.purge_work_unit(ctx, item)
+
+    def get_done_work_units(self, ctx):
+        """
+        Return the journal keys of the items this step has already stored completely
+        """
+        return self.get_journal(ctx).get_done(self.get_step_identifier())
+
+    def commit_work_unit_result(self, ctx, item, result):
+        """
+        Store the result of one item and record it in the journal
+
+        The rows of modules implementing get_work_unit_rows are buffered and written once enough rows are collected
+        (c.f. get_storage_flush_size). Returns the list of (item, result) tuples which are completely stored now
+        """
+        key = self.get_work_unit_journal_key(ctx, item)
+        rows = self.get_work_unit_rows(ctx, item, result)
+        if rows is None:
+            if key is not None:
+                self.purge_work_unit(ctx, item)
+            self.store_work_unit_result(ctx, item, result)
+            if key is not None:
+                self.get_journal(ctx).mark_done(self.get_step_identifier(), key)
+            return [(item, result)]
+
+        self.store_work_unit_result(ctx, item, result)
+        if getattr(self, "_work_unit_writer", None) is None:
+            self._work_unit_writer = self.get_bulk_writer(
+                ctx,
+                lambda r: self.store_work_unit_rows(ctx, r),
+                purge=lambda entries: self.purge_work_units(ctx, [i for i, _ in entries]),
+            )
+        return self._work_unit_writer.add(rows, item=(item, result), key=key)
+
+    def flush_work_unit_results(self, ctx):
+        """
+        Write the buffered rows of commit_work_unit_result. Returns the list of (item, result) tuples stored now
+        """
+        if getattr(self, "_work_unit_writer", None) is None:
+            return []
+        return self._work_unit_writer.flush()
+
+    def get_storage_flush_size(self):
+        """
+        Number of rows written to the database at once: "storage_flush_size" from the module config, the main config
+        or Storage.BulkWriter.DEFAULT_FLUSH_SIZE. 1 writes every item on its own
+        """
+        from Storage.BulkWriter import DEFAULT_FLUSH_SIZE
+        return self.get_module_config().get(
+            "storage_flush_size", self.get_main_config().get("storage_flush_size", DEFAULT_FLUSH_SIZE))
+
+    def get_bulk_writer(self, ctx, store_many, purge=None, journal=True):
+        """
+        Return a Storage.BulkWriter.BulkWriter with the flush size of this module
+
+        Parameters
+        ----------
+        ctx         The context
+        store_many  Callable storing a list of rows
+        purge       Callable removing everything stored for a list of items (called for items with a journal key)
+        journal     Add the journal keys of the written items to the journal of this step
+        """
+        from Storage.BulkWriter import BulkWriter
+        mark_done = None
+        if journal:
+            journal_storage = self.get_journal(ctx)
+            mark_done = lambda keys: journal_storage.mark_done_many(self.get_step_identifier(), keys)
+        return BulkWriter(store_many, self.get_storage_flush_size(), purge=purge, mark_done=mark_done)
+
+    def get_journal(self, ctx):
+        """
+        Return the journal of the completely stored items of the running steps
+        """
+        from Storage.JournalStorage import JournalStorage
+        return JournalStorage(self.get_sqlite_file(ctx))
+
+    def run_work_units(self, ctx):
+        """
+        Process all work units of this module, potentially in parallel
+
+        Items with a result in the result cache are not processed again, items already in the journal (i.e. stored by
+        an interrupted run of this step) are skipped. Returns a dict with some statistics which can be added to the
+        step output
+        """
+        workers = self.get_num_workers()
+        cache = self.get_result_cache()
+        done = self.get_done_work_units(ctx)
+        num_items = 0
+        skipped_items = 0
+        failed_items = []
+
+        # Items in the order of get_work_units: (item, cache key, cached value or None)
+        ordered_items = deque()
+
+        def items_to_process():
+            nonlocal skipped_items
+            for item in self.get_work_units(ctx):
+                if self.get_work_unit_journal_key(ctx, item) in done:
+                    skipped_items += 1
+                    continue
+                key = self.get_work_unit_cache_key(ctx, item) if cache is not None else None
+                value = cache.get(key) if key is not None else None
+                ordered_items.append((item, key, value))
+                if value is None:
+                    yield item
+
+        def store_cached_items():
+            while len(ordered_items) and ordered_items[0][2] is not None:
+                item, _, value = ordered_items.popleft()
+                self.commit_work_unit_result(ctx, item, self.from_cache(ctx, item, value))
+
+        for r in map_work_units(self.process_work_unit, items_to_process(), self.get_work_unit_args(ctx), workers):
+            store_cached_items()
+            _, key, _ = ordered_items.popleft()
+            num_items += 1
+            if r.error is not None:
+                logger.error(f"{self.get_step_identifier()}: Work unit {r.item} failed:\n{r.error}")
+                failed_items.append(str(r.item))
+                continue
+            if key is not None:
+                cache.put(key, self.get_step_identifier(), self.to_cache(ctx, r.item, r.result))
+            self.commit_work_unit_result(ctx, r.item, r.result)
+        store_cached_items()
+        self.flush_work_unit_results(ctx)
+
+        if skipped_items:
+            logger.info(f"{self.get_step_identifier()}: Skipped {skipped_items} work units done by a previous run")
+
+        stats = {
+            "workers": workers,
+            "num_work_units": num_items,
+            "skipped_work_units": skipped_items,
+            "failed_work_units": failed_items,
+        }
+        if getattr(self, "_work_unit_writer", None) is not None:
+            stats["storage"] = self._work_unit_writer.get_stats()
+        if cache is not None:
+            stats["cache"] = cache.get_stats()
+        return stats
+
+    def process_work_unit_cached(self, ctx, item, args):
+        """
+        Process a single work unit in the main process, using the result cache if available
+        """
+        cache = self.get_result_cache()
+        key = self.get_work_unit_cache_key(ctx, item) if cache is not None else None
+        value = cache.get(key) if key is not None else None
+        if value is not None:
+            return self.from_cache(ctx, item, value)
+
+        result = self.process_work_unit(item, *args)
+        if key is not None:
+            cache.put(key, self.get_step_identifier(), self.to_cache(ctx, item, result))
+        return result
+
+    def get_result_cache(self):
+        """
+        Return the persistent result cache or None if no "cache_dir" is given in the main config
+
+        A module can disable the cache by setting "use_cache" to false in its config.
+        """
+        if getattr(self, "_result_cache", None) is None:
+            cache_dir = self.get_main_config().get("cache_dir", None)
+            if cache_dir is None or not self.get_module_config().get("use_cache", True):
+                return None
+            from Storage.CacheStorage import ResultCacheStorage
+            Path(cache_dir).mkdir(parents=True, exist_ok=True)
+            self._result_cache = ResultCacheStorage(
+                "sqlite:///" + os.path.abspath(os.path.join(cache_dir, "cache.sqlite")),
+                max_bytes=int(self.get_main_config().get("cache_max_mb", 10 * 1024) * 1024 ** 2),
+            )
+        return self._result_cache
+
+    def get_cache_key(self, config, *parts):
+        """
+        Return a key for the result cache for this module
+
+        config are the settings influencing the result, parts for example the hashes of the input files.
+        """
+        return make_cache_key(str(self.__class__.__module__) + "." + str(self.__class__.__name__), config, *parts)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
                     prog='ShadowWolf',
@@ -135,13 +658,40 @@ if __name__ == "__main__":
     parser.add_argument('-c', '--config', type=str, default="config.json", help="The config file in json format.")
     parser.add_argument('-o', '--output', type=str, default=None, help="The output directory.")
     parser.add_argument('-d', '--cont', type=int, default=0, help="Continue from a certain step. Defaults to 0 (i.e. start from the beginning).")
+    parser.add_argument('-u', '--until', type=int, default=None, help="Stop before this step.")
+    parser.add_argument('-s', '--shard', type=str, default=None, help="Only process a part of the images, e.g. 0/4 for the first of four shards. Combine the shards using --merge.")
+    parser.add_argument('--merge', type=str, nargs='+', default=None, help="Merge the output directories of sharded runs into the output directory and continue with the next step.")
+    parser.add_argument('--plan', action='store_true', help="Only check the config and print the execution plan.")
+    parser.add_argument('--render', action='store_true', help="Only render the images of a run with \"render\": \"lazy\" in the output directory.")
     args = parser.parse_args()
 
+    if args.plan:
+        plan, errors = BaseClass(config=args.config).get_plan(cont=args.cont, output=args.output)
+        print("\n".join(plan))
+        for e in errors:
+            print(f"ERROR: {e}")
+        exit(1 if len(errors) else 0)
+
+    if args.render:
+        if args.output is None:
+            raise ValueError(f"You have to specify the output directory of the run to render.")
+        BaseClass(config=args.config).render_pending(args.output)
+        exit(0)
+
     if args.cont > 0 and args.output is None:
         raise ValueError(f"You have to specify an output directory if you would like to continue an existing run.")
 
     bc = BaseClass(config=args.config)
-    ctx = bc.get_new_context(output=args.output, cont=args.cont)
-    bc.run(ctx, cont=args.cont)
+    if args.merge is not None:
+        if args.output is None:
+            raise ValueError(f"You have to specify an output directory for the merged results.")
+        ctx, cont = bc.get_merged_context(args.merge, args.output)
+    else:
+        ctx = bc.get_new_context(output=args.output, cont=args.cont)
+        cont = args.cont
+        if args.shard is not None:
+            index, count = parse_shard(args.shard)
+            ctx["shard"] = {"index": index, "count": count}
+    bc.run(ctx, cont=cont, until=args.until)
     logger.info(f"Done. Stored logfile at {logfile}")
     shutil.copy(logfile, ctx["output_dir"])
@@ -10,6 +10,10 @@ from BaseClass import BaseClass
 from Storage.DataStorage import BatchingDataStorage, BasicAnalysisDataStorage
 
 
+def parse_exif_time(value):
+    return datetime.datetime.strptime(value, "%Y:%m:%d %H:%M:%S")
+
+
 ## Create batches based on the image timestamp
 class TimeBatchingClass(BaseClass):
     def __init__(self, run_num, config, *args, **kwargs):
@@ -21,52 +25,149 @@ class TimeBatchingClass(BaseClass):
         logger.info(f"Config: {self.get_module_config()}")
 
         ds = BatchingDataStorage(self.get_sqlite_file(ctx))
-        analysis_storage = BasicAnalysisDataStorage(self.get_sqlite_file(ctx))
-
-        image_db = []
-
-        for image in ds.get_all_images():
-            instance = analysis_storage.get_image_by_fullpath(image)
-            meta, exif = analysis_storage.get_by_instance(instance)
-            for e in exif:
-                if e.exif_name == self.get_module_config()["exif_time_source"]:
-                    dt = datetime.datetime.strptime(e.exif_value, "%Y:%m:%d %H:%M:%S")
-                    image_db.append({
-                        "image": instance,
-                        "dt": dt
-                    })
-                    continue
-        image_db.sort(key=lambda x: x["dt"])
+        exif_name = self.get_module_config()["exif_time_source"]
+
+        # Incremental: Only the images without a batch are batched. They extend the latest batch or form new ones
+        last_batch = None
+        if self.get_module_config().get("incremental", False):
+            last_batch = ds.get_last_batch(__name__, exif_name)
+            if last_batch is None:
+                logger.info("No batches yet. Batching all images.")
+
+        image_db = self.get_image_db(ds, exif_name, unbatched_only=last_batch is not None)
+        if last_batch is not None and len(image_db) and image_db[0]["dt"] < parse_exif_time(last_batch[1]):
+            logger.warning("New images are older than the latest batch. Batching all images.")
+            last_batch = None
+            image_db = self.get_image_db(ds, exif_name)
+
+        if last_batch is None:
+            # Batches of a previous (interrupted) run
+            ds.delete_batches(__name__)
+            lastframe_dt = None
+        else:
+            logger.info(f"Batching {len(image_db)} new images after batch {last_batch[0]}")
+            lastframe_dt = parse_exif_time(last_batch[1])
 
         imgdb_batches = []
         current_subbatch = []
-        lastframe = None
         for img in image_db:
-            if lastframe is None:
-                lastframe = img
-                current_subbatch.append(img["image"])
-                continue
-            if (img["dt"] - lastframe["dt"]).total_seconds() > self.get_module_config()["max_timediff_s"]:
+            if lastframe_dt is not None and \
+                    (img["dt"] - lastframe_dt).total_seconds() > self.get_module_config()["max_timediff_s"]:
                 imgdb_batches.append(current_subbatch)
                 current_subbatch = []
             current_subbatch.append(img["image"])
-            lastframe = img
+            lastframe_dt = img["dt"]
         imgdb_batches.append(current_subbatch)
 
+        extended = 0
+        if last_batch is not None:
+            # The first batch continues the latest one
+            extension = imgdb_batches.pop(0)
+            if len(extension):
+                ds.add_fullpaths(last_batch[0], extension)
+            extended = len(extension)
+            imgdb_batches = [b for b in imgdb_batches if len(b)]
+            logger.info(f"Added {extended} images to batch {last_batch[0]}")
+
         logger.info(f"Database split into {len(imgdb_batches)} batches.")
         logger.info(f"Storing batches into database")
         for batch in imgdb_batches:
-            ds.store(batch, __name__)
+            ds.store_fullpaths(batch, __name__)
+
+        self.add_step(ctx, imgdb_batches, extended)
+
+        return True, ctx
+
+    @staticmethod
+    def get_image_db(ds, exif_name, unbatched_only=False):
+        """
+        Return the dicts image, dt of all images having the time source ordered by the time
+        """
+        image_db = []
+        seen = set()
+        for image, exif_value in ds.get_images_by_exif_value(exif_name, unbatched_only):
+            if image in seen:
+                continue
+            seen.add(image)
+            image_db.append({
+                "image": image,
+                "dt": parse_exif_time(exif_value),
+            })
+        # Already ordered for EXIF formatted values (the sort is linear then)
+        image_db.sort(key=lambda x: x["dt"])
+        return image_db
 
+    def add_step(self, ctx, imgdb_batches, extended=0):
         ctx["steps"].append({
             "identifier": self.get_step_identifier(),
             "sqlite_file": self.get_sqlite_file(ctx),
             "num_batches": len(imgdb_batches),
             "batch_sizes": [len(x) for x in imgdb_batches],
-            "num_images": sum([len(x) for x in imgdb_batches]),
+            "num_images": sum([len(x) for x in imgdb_batches]) + extended,
+            "extended_images": extended,
         })
 
-        return True, ctx
+    @staticmethod
+    def order_by_id(ds, fullpaths):
+        image_ids = ds.get_image_ids(fullpaths)
+        return sorted(fullpaths, key=lambda fullpath: image_ids[fullpath])
+
+    def can_stream(self, upstream_output):
+        return upstream_output is not None and \
+            tuple(upstream_output) == ("Storage.DataStorage.BasicAnalysisDataStorage", "get_all_images")
+
+    def get_stream_output(self, upstream_output):
+        return "Storage.DataStorage.BatchingDataStorage", "get_batch_fullpaths"
+
+    def stream(self, ctx, inputs):
+        """
+        Batch the images while they are analysed
+
+        The images are sorted by time by the BasicAnalysisClass. Therefore, a batch is complete as soon as the next
+        image exceeds max_timediff_s. The batches are the same as in the batch mode. The images of a batch are passed
+        on ordered by their id like BatchingDataStorage.get_batch_fullpaths, i.e. the order of the segmentation does
+        not change.
+        """
+        logger.info(f"Identifier: {self.get_step_identifier()}")
+        logger.info(f"Config: {self.get_module_config()}")
+
+        ds = BatchingDataStorage(self.get_sqlite_file(ctx))
+        analysis_storage = BasicAnalysisDataStorage(self.get_sqlite_file(ctx))
+        # Batches of a previous (interrupted) run
+        ds.delete_batches(__name__)
+
+        imgdb_batches = []
+        current_subbatch = []
+        lastframe = None
+        for image in inputs:
+            exif_value = analysis_storage.get_exif_value(image, self.get_module_config()["exif_time_source"])
+            if exif_value is None:
+                continue
+            img = {
+                "image": image,
+                "dt": parse_exif_time(exif_value),
+            }
+            if lastframe is None:
+                lastframe = img
+                current_subbatch.append(img["image"])
+                continue
+            if img["dt"] < lastframe["dt"]:
+                raise ValueError(f"Images are not ordered by time: {image}. Cannot stream the batches.")
+            if (img["dt"] - lastframe["dt"]).total_seconds() > self.get_module_config()["max_timediff_s"]:
+                ds.store_fullpaths(current_subbatch, __name__)
+                imgdb_batches.append(current_subbatch)
+                yield self.order_by_id(analysis_storage, current_subbatch)
+                current_subbatch = []
+            current_subbatch.append(img["image"])
+            lastframe = img
+
+        ds.store_fullpaths(current_subbatch, __name__)
+        imgdb_batches.append(current_subbatch)
+        if len(current_subbatch):
+            yield self.order_by_id(analysis_storage, current_subbatch)
+
+        logger.info(f"Database split into {len(imgdb_batches)} batches.")
+        self.add_step(ctx, imgdb_batches)
 
 
 if __name__ == "__main__":
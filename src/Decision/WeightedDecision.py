@@ -16,13 +16,13 @@ import os
 import logging
 from pathlib import Path
 
-import cv2
-
-from Storage.BackmappingStorage import BackmappingStorage
+from Storage.BackmappingStorage import BackmappingStorage, decode_votings
+from Storage.BulkWriter import MAX_IN_VALUES
 from Storage.DetectionStorage import DetectionStorage
 from Storage.FinalDetectionStorage import WeightedDecisionStorage
 from wolf_utils.analysis_helper import condense_votings, to_xmin_xmax
-from wolf_utils.misc import draw_text
+from wolf_utils.misc import batch
+from wolf_utils.rendering import get_renderer, Drawing
 
 logger = logging.getLogger(__name__)
 
@@ -38,96 +38,137 @@ class WeightedDecisionClass(BaseClass):
         logger.info(f"Identifier: {self.get_step_identifier()}")
         logger.info(f"Config: {self.get_module_config()}")
 
-        output_dir = os.path.join(self.get_current_data_dir(ctx), "boxes")
-        Path(output_dir).mkdir(parents=True, exist_ok=True)
-
-        backmapping_storage = BackmappingStorage(self.get_sqlite_file(ctx))
-
-        wds = WeightedDecisionStorage(self.get_sqlite_file(ctx))
+        self.output_dir = os.path.join(self.get_current_data_dir(ctx), "boxes")
+        Path(self.output_dir).mkdir(parents=True, exist_ok=True)
 
-        detection_storage = DetectionStorage(self.get_sqlite_file(ctx))
-
-        for backmapping_image in backmapping_storage.get_all_images():
-            logger.info(f"Checking image {backmapping_image}")
-            bms = backmapping_storage.get_backmappings_for_image(backmapping_image)
-            logger.info(f"Got {len(bms)} mappings")
-
-            boxes_list = [(v.get_box_center_wh(), v.get_votings_list()) for v in bms]
-            len_before = len(boxes_list)
-            logger.info(f"Boxes before condensing ({len(boxes_list)}): {boxes_list}")
-
-            cv = condense_votings(
-                boxes_list,
-                self.get_module_config()["iou_threshold"],
-                self.get_module_config()["weights"],
-                self.get_module_config().get("box_combine_method", "bbox_union")
-            )
-            logger.info(f"Boxes after condensing: {cv}")
-
-            logger.info(f"Condensed {len_before - len(cv)} Entries")
-
-            # cv contains a list of all boxes with all (weighted) decisions. Now, select the dominant class:
-
-            major_class_votings = []
-            for c in cv:
-                box, votings = c
-                max_class = max(votings, key=votings.get)
-                major_class_votings.append((box, {max_class : votings[max_class]}))
-
-            max_allowed_class = self.get_module_config()["ignore_classes_higher"]
-
-            # major_class_votings contains each box with the major voting. Next: remove classes which are too high
-            # (i.e. out of context)
-            votings_of_interest = [v for v in major_class_votings if int(next(iter(v[1]))) <= max_allowed_class]
-
-            # votings_of_interest should now contain a box with one class and the corresponding probability.
-
-            # Store everything to the db
-            for v in votings_of_interest:
-                box, voting = v
-                (x_min, x_max, y_min, y_max) = to_xmin_xmax(box)
-                v_class_n = next(iter(voting))
-                v_class_p = voting[v_class_n]
-                v_class_n = int(v_class_n)
-                v_class_s = detection_storage.get_class_name_by_id(v_class_n)
-
-                wds.store(
-                    backmapping_image,
-                    os.path.split(backmapping_image)[1],
-                    v_class_n,
-                    v_class_s,
-                    v_class_p,
-                    x_min,
-                    x_max,
-                    y_min,
-                    y_max,
-                )
-
-            # Create images for dem / debugging
-            img = cv2.imread(backmapping_image)
-            for v in votings_of_interest:
-                box, voting = v
-                (x_min, x_max, y_min, y_max) = to_xmin_xmax(box)
-                cv2.rectangle(img, (x_min, y_min), (x_max, y_max), (0,0,255), 2)
-                draw_text(
-                    img=img,
-                    text=str(voting),
-                    pos=(x_max, y_max)
-                )
-
-            _, fn = os.path.split(backmapping_image)
-            cv2.imwrite(os.path.join(output_dir, fn), img)
+        self.wds = WeightedDecisionStorage(self.get_sqlite_file(ctx))
 
+        self.detection_storage = DetectionStorage(self.get_sqlite_file(ctx))
 
+        work_unit_stats = self.run_work_units(ctx)
 
         ctx["steps"].append({
             "identifier": self.get_step_identifier(),
             "sqlite_file": self.get_sqlite_file(ctx),
-            "output_dir" : output_dir,
+            "output_dir" : self.output_dir,
+            **work_unit_stats,
         })
 
         return True, ctx
 
+    def get_work_units(self, ctx):
+        backmapping_storage = BackmappingStorage(self.get_sqlite_file(ctx))
+
+        # The boxes and votes of several images are loaded at once from the vote table (no json parsing)
+        for images in batch(backmapping_storage.iter_all_images(), MAX_IN_VALUES):
+            boxes = backmapping_storage.get_boxes_for_images(images)
+            votings = decode_votings(backmapping_storage.get_votes_for_images(images))
+            for backmapping_image in images:
+                logger.info(f"Checking image {backmapping_image}")
+                logger.info(f"Got {len(boxes[backmapping_image])} mappings")
+
+                yield backmapping_image, [(box, votings.get(backmapping_id, []))
+                                          for backmapping_id, box in boxes[backmapping_image]]
+
+    def get_work_unit_journal_key(self, ctx, item):
+        return item[0]
+
+    def purge_work_unit(self, ctx, item):
+        self.wds.delete_for_image(item[0])
+
+    def get_work_unit_args(self, ctx):
+        return (
+            self.get_module_config()["iou_threshold"],
+            self.get_module_config()["weights"],
+            self.get_module_config().get("box_combine_method", "bbox_union"),
+            self.get_module_config()["ignore_classes_higher"],
+        )
+
+    @staticmethod
+    def process_work_unit(item, iou_threshold, weights, box_combine_method, max_allowed_class):
+        """
+        Condense the boxes of one image and select the dominant class per box
+
+        Returns a list of (box, {class: probability}) for the boxes which should be kept
+        """
+        backmapping_image, boxes_list = item
+        len_before = len(boxes_list)
+        logger.info(f"Boxes before condensing ({len(boxes_list)}): {boxes_list}")
+
+        cv = condense_votings(
+            boxes_list,
+            iou_threshold,
+            weights,
+            box_combine_method
+        )
+        logger.info(f"Boxes after condensing: {cv}")
+
+        logger.info(f"Condensed {len_before - len(cv)} Entries")
+
+        # cv contains a list of all boxes with all (weighted) decisions. Now, select the dominant class:
+
+        major_class_votings = []
+        for c in cv:
+            box, votings = c
+            max_class = max(votings, key=votings.get)
+            major_class_votings.append((box, {max_class : votings[max_class]}))
+
+        # major_class_votings contains each box with the major voting. Next: remove classes which are too high
+        # (i.e. out of context)
+        votings_of_interest = [v for v in major_class_votings if int(next(iter(v[1]))) <= max_allowed_class]
+
+        # votings_of_interest should now contain a box with one class and the corresponding probability.
+        return votings_of_interest
+
+    def purge_work_units(self, ctx, items):
+        self.wds.delete_for_images([item[0] for item in items])
+
+    def get_work_unit_rows(self, ctx, item, votings_of_interest):
+        backmapping_image, _ = item
+
+        rows = []
+        for v in votings_of_interest:
+            box, voting = v
+            (x_min, x_max, y_min, y_max) = to_xmin_xmax(box)
+            v_class_n = next(iter(voting))
+            v_class_p = voting[v_class_n]
+            v_class_n = int(v_class_n)
+            v_class_s = self.detection_storage.get_class_name_by_id(v_class_n)
+
+            rows.append({
+                "image_fullpath": backmapping_image,
+                "image_name": os.path.split(backmapping_image)[1],
+                "detection_class_numeric": v_class_n,
+                "detection_class_str": v_class_s,
+                "detection_probability": v_class_p,
+                "x_min": x_min,
+                "x_max": x_max,
+                "y_min": y_min,
+                "y_max": y_max,
+            })
+        return rows
+
+    def store_work_unit_rows(self, ctx, rows):
+        # Store everything to the db
+        self.wds.store_many(rows)
+
+    def store_work_unit_result(self, ctx, item, votings_of_interest):
+        backmapping_image, _ = item
+
+        # Create images for dem / debugging
+        drawing = Drawing()
+        for v in votings_of_interest:
+            box, voting = v
+            (x_min, x_max, y_min, y_max) = to_xmin_xmax(box)
+            drawing.rectangle((x_min, y_min), (x_max, y_max), (0,0,255), 2)
+            drawing.draw_text(
+                text=str(voting),
+                pos=(x_max, y_max)
+            )
+
+        _, fn = os.path.split(backmapping_image)
+        get_renderer().render(os.path.join(self.output_dir, fn), backmapping_image, drawing)
+
 
 if __name__ == "__main__":
     pass
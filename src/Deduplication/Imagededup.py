@@ -1,13 +1,17 @@
 #!/usr/bin/env python3
-from imagededup.methods import PHash
 import logging
-from wolf_utils.misc import getter_factory
+from wolf_utils.misc import iter_getter_factory
+from wolf_utils.cache import hash_file
 
 logger = logging.getLogger(__name__)
 
 from BaseClass import BaseClass
 
 from Storage.DuplicateStorage import DuplicateImageStorage
+from Storage.ThumbnailStorage import ThumbnailStorage
+
+# PHash scales the images down to 32x32 pixels: Original images are hashed using this thumbnail level
+THUMBNAIL_LEVEL = "256"
 
 class ImagededupClass(BaseClass):
     def __init__(self, run_num, config, *args, **kwargs):
@@ -23,7 +27,7 @@ class ImagededupClass(BaseClass):
         getter       = {}
 
         for input_cls in self.get_module_config()["inputs"]:
-            for img in  getter_factory(input_cls["dataclass"], input_cls["getter"], self.get_sqlite_file(ctx))():
+            for img in iter_getter_factory(input_cls["dataclass"], input_cls["getter"], self.get_sqlite_file(ctx))():
                 input_images.append(img)
                 dataclasses[img] = input_cls["dataclass"]
                 getter[img]      = input_cls["getter"]
@@ -31,29 +35,58 @@ class ImagededupClass(BaseClass):
         # Unify list, remove duplicates
         input_images = list(dict.fromkeys(input_images))
 
+        from imagededup.methods import PHash
         hasher = PHash() # TODO: Make configurable
 
-        encodings = dict()
+        self.input_images = input_images
+        self.encodings = dict()
+        # Original images (e.g. from BasicAnalysisDataStorage.get_all_images) have thumbnails
+        self.thumbnails = ThumbnailStorage(self.get_sqlite_file(ctx)).get_fullpaths()
 
         logger.info(f"Creating hashes for {len(input_images)} images...")
-        for image in input_images:
-            encodings[image] = hasher.encode_image(image)
+        work_unit_stats = self.run_work_units(ctx)
 
-        duplicates = hasher.find_duplicates(encoding_map=encodings)
+        duplicates = hasher.find_duplicates(encoding_map=self.encodings)
 
         duplicat_storage = DuplicateImageStorage(self.get_sqlite_file(ctx))
 
-        for dup in duplicates:
-            if len(duplicates[dup]) > 0:
-                for related_dup in duplicates[dup]:
-                    duplicat_storage.add_duplicate((dup, dataclasses[dup], getter[dup]), (related_dup, dataclasses[related_dup], getter[related_dup]))
+        # All pairs in one transaction
+        num_pairs = duplicat_storage.add_duplicates(
+            ((dup, dataclasses[dup], getter[dup]), (related_dup, dataclasses[related_dup], getter[related_dup]))
+            for dup in duplicates for related_dup in duplicates[dup]
+        )
+        logger.info(f"Stored {num_pairs} pairs of duplicates")
 
         ctx["steps"].append({
                 "identifier" : self.get_step_identifier(),
                 "sqlite_file" : self.get_sqlite_file(ctx),
+                **work_unit_stats,
             })
 
         return True, ctx
 
+    def get_work_units(self, ctx):
+        return self.input_images
+
+    def get_work_unit_args(self, ctx):
+        return (self.get_sqlite_file(ctx), )
+
+    @staticmethod
+    def process_work_unit(image, sqlite_file):
+        import cv2
+        from imagededup.methods import PHash
+        thumbnail = ThumbnailStorage(sqlite_file).get_thumbnail(image, THUMBNAIL_LEVEL)
+        if thumbnail is not None:
+            return PHash(verbose=False).encode_image(image_array=cv2.cvtColor(thumbnail, cv2.COLOR_BGR2RGB))
+        return PHash(verbose=False).encode_image(image)
+
+    def store_work_unit_result(self, ctx, image, encoding):
+        self.encodings[image] = encoding
+
+    def get_work_unit_cache_key(self, ctx, image):
+        if image in self.thumbnails:
+            return self.get_cache_key({"hasher": "PHash", "thumbnail": THUMBNAIL_LEVEL}, hash_file(image))
+        return self.get_cache_key({"hasher": "PHash"}, hash_file(image))
+
 if __name__ == "__main__":
     pass
@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
 
 import os
-import torch
 import time
+import importlib
 
 import cv2
 
@@ -14,7 +14,21 @@ logger = logging.getLogger(__name__)
 from BaseClass import BaseClass
 from Storage.DetectionStorage import  DetectionStorage
 
-from wolf_utils.misc import batch, delta_time_format, getter_factory, draw_text
+from wolf_utils.misc import batch, delta_time_format, iter_getter_factory, count_factory
+from wolf_utils.cache import hash_file
+from wolf_utils.tracing import trace
+from wolf_utils.memory import get_memory_governor, estimate_frame_bytes
+from wolf_utils.frame_cache import imread
+from wolf_utils.prefetch import prefetch
+from wolf_utils.rendering import get_renderer, Drawing
+
+
+def load_hub_model(repository, model_file, force_reload=False):
+    """
+    Load a custom model using the pytorch hub (default for detect_loader)
+    """
+    import torch
+    return torch.hub.load(repository, "custom", model_file, force_reload=force_reload)
 
 
 class YoloDetectionClass(BaseClass):
@@ -28,6 +42,24 @@ class YoloDetectionClass(BaseClass):
         self.run_num = run_num
 
     def run(self, ctx):
+        for _ in self.stream(ctx, None):
+            pass
+
+        return True, ctx
+
+    def can_stream(self, upstream_output):
+        return self.stream_accepts_input(upstream_output)
+
+    def get_stream_output(self, upstream_output):
+        return "Storage.DetectionStorage.DetectionStorage", "get_cut_images"
+
+    def stream(self, ctx, inputs):
+        """
+        Run the detection on all inputs
+
+        If inputs is not None, the images are taken from it instead of the getter of the first input source. Yields
+        the images cut to the detections.
+        """
         logger.info(f"Identifier: {self.get_step_identifier()}")
         logger.info(f"Config: {self.get_module_config()}")
 
@@ -45,84 +77,168 @@ class YoloDetectionClass(BaseClass):
         model_file = os.path.join(model_dir, self.get_module_config()["detect_model"])
         logger.info(f"Using model {model_file}. Loading...")
 
+        self.model = None
+        self.model_file = model_file
+        cache = self.get_result_cache()
+        cache_config = None
+        if cache is not None:
+            cache_config = {
+                "detect_repository": self.get_module_config()["detect_repository"],
+                "detect_model": hash_file(model_file),
+            }
+            if "detect_loader" in self.get_module_config():
+                cache_config["detect_loader"] = self.get_module_config()["detect_loader"]
+
+        governor = get_memory_governor()
+
+        # Images stored by an interrupted run of this step
+        done = self.get_journal(ctx).get_done(self.get_step_identifier())
+        storage_stats = []
+
         for image_input_num, image_input in enumerate(self.get_module_config()["inputs"]):
 
             input_dataclass = image_input["dataclass"]
             input_getter    = image_input["getter"]
             logger.info(f"Handling source {image_input_num}: {input_dataclass} -> {input_getter}")
-            input_images = getter_factory(input_dataclass, input_getter, self.get_sqlite_file(ctx))()
-
-            model = torch.hub.load(
-                    self.get_module_config()["detect_repository"],
-                    "custom",
-                    model_file,
-                    force_reload = self.get_module_config().get("detect_force_reload", False),
-                    )
+            if image_input_num == 0 and inputs is not None:
+                input_images = inputs
+                total_images = None
+            else:
+                # The images are read page by page while they are processed
+                input_images = iter_getter_factory(input_dataclass, input_getter, self.get_sqlite_file(ctx))()
+                counter = count_factory(input_dataclass, input_getter, self.get_sqlite_file(ctx))
+                total_images = counter() if counter is not None else None
 
             detection_storage = DetectionStorage(self.get_sqlite_file(ctx), input_dataclass, input_getter)
+            writer = self.get_bulk_writer(
+                ctx,
+                detection_storage.store_many,
+                purge=lambda items: detection_storage.delete_for_images([image for image, _ in items]),
+            )
 
-            total_images = len(input_images)
             handled_images = 0
             start_time_detection = time.time()
 
             logger.info(f"Source {image_input_num+1} out of {len(self.get_module_config()['inputs'])}: Starting detection...")
-            for i in batch(input_images, self.get_module_config().get("detect_batchsize", 4)):
-                results = model(i)
-                classes = results.names
-                if not os.path.isfile(classes_path):
+            batch_size = self.get_module_config().get("detect_batchsize", 4)
+            frame_bytes = 0 # Size of the last decoded image to adapt the batch size to the memory budget
+
+            def get_batches():
+                # Tuples of the images already handled (c.f. journal) and the images to detect
+                for i in batch(input_images, lambda: governor.get_batch_size(batch_size, 2 * frame_bytes)):
+                    todo = []
+                    handled = []
+                    for image in i:
+                        (handled if f"{image_input_num}:{image}" in done else todo).append(image)
+                    yield handled, todo
+
+            def load_batch(batch_images):
+                with trace("decode"):
+                    return [imread(image) for image in batch_images[1]]
+
+            def reserve_batch(batch_images):
+                # The images are decoded once for the detection and the output. Twice the size is reserved for the
+                # RGB copies given to the model
+                return 2 * sum(estimate_frame_bytes(image) for image in batch_images[1])
+
+            # The next "prefetch" batches are decoded in the background while the current one is detected. The memory
+            # is reserved before the images are decoded
+            for (handled, i), frames, reservation in prefetch(get_batches(), load_batch,
+                                                              self.get_module_config().get("prefetch", 0),
+                                                              reserve=reserve_batch):
+                if not len(i):
+                    for image in handled:
+                        handled_images += 1
+                        yield from detection_storage.get_cut_images_for_image(image)
+                    continue
+
+                stored_images = []
+                frame_bytes = max([frame.nbytes for frame in frames if frame is not None], default=frame_bytes)
+                detections, classes = self.detect(i, cache, cache_config, frames)
+                if len(classes) and not os.path.isfile(classes_path):
                     with open(classes_path, "w") as f:
                         for cls in classes:
                             f.writelines(f"{cls} {classes[cls]}\n")
 
-                for image in zip(i, results.xyxy):
-                    (_, output_filename) = os.path.split(image[0])
-                    img = cv2.imread(image[0])
-                    img_w_label = img.copy()
+                for image, img, image_detections in zip(i, frames, detections):
+                    (_, output_filename) = os.path.split(image)
                     if img is None:
-                        logger.warning(f"Source {image_input_num}: Image {image[0]} cannot be loaded. Skipping")
+                        logger.warning(f"Source {image_input_num}: Image {image} cannot be loaded. Skipping")
                         continue
-
                     detections_rows = []
-                    for i, detection in enumerate(image[1].tolist()):
+                    storage_rows = []
+                    cut_images = []
+                    for n, detection in enumerate(image_detections):
                         (x_min, y_min, x_max, y_max, confidence, cls) = detection
                         w = x_max - x_min
                         h = y_max - y_min
                         cls = int(cls)
-                        cv2.rectangle(img_w_label, (int(x_min), int(y_min)), (int(x_max), int(y_max)), (0,0,255), 2)
-                        draw_text(
-                            img=img_w_label,
-                            text=str(int(confidence*100)),
-                            pos=(int(x_max)-int(w/2), int(y_max)-int(h/2)),
-                        )
-                        cut_to_detection = img.copy()[round(y_min):round(y_max), round(x_min):round(x_max)]
+                        # A view into the decoded image: The labels are drawn into a copy by the renderer
+                        cut_to_detection = img[round(y_min):round(y_max), round(x_min):round(x_max)]
                         f, e = os.path.splitext(output_filename)
-                        cut_image = os.path.join(output_dirs["cut_to_detection"], f"{f}_{i}{e}")
-                        cv2.imwrite(cut_image, cut_to_detection)
+                        cut_image = os.path.join(output_dirs["cut_to_detection"], f"{f}_{n}{e}")
+                        with trace("imwrite"):
+                            cv2.imwrite(cut_image, cut_to_detection)
                         logger.info(f"Source {image_input_num}: Detection: class {cls} ({classes[cls]}), confidence {(confidence*100.0):3.1f}% in image {output_filename}")
-                        detection_storage.store(
-                            image[0],
-                            cut_image,
-                            classes[cls],
-                            cls,
-                            confidence,
-                            x_min,
-                            y_min,
-                            x_max,
-                            y_max,
-                        )
+                        storage_rows.append({
+                            "fullpath": image,
+                            "cut_image": cut_image,
+                            "detection_class": classes[cls],
+                            "detection_class_numeric": cls,
+                            "confidence": confidence,
+                            "x_min": x_min,
+                            "y_min": y_min,
+                            "x_max": x_max,
+                            "y_max": y_max,
+                        })
+                        cut_images.append(cut_image)
 
                         detections_rows.append(f"{cls} {round(x_min+(w/2.0))} {round(y_min+(h/2.0))} {round(w)} {round(h)}")
-                    if len(image[1].tolist()) == 0:
+                    if len(image_detections) == 0:
                         logger.info(f"Source {image_input_num}: No detections for image {output_filename}")
-                    cv2.imwrite(os.path.join(output_dirs["labelled_images"], output_filename), img_w_label)
-                    cv2.imwrite(os.path.join(output_dirs["labels_images"], output_filename), img)
+                    renderer = get_renderer()
+                    renderer.render(os.path.join(output_dirs["labels_images"], output_filename), image, frame=img)
+
+                    drawing = Drawing()
+                    for detection in image_detections:
+                        (x_min, y_min, x_max, y_max, confidence, cls) = detection
+                        w = x_max - x_min
+                        h = y_max - y_min
+                        drawing.rectangle((int(x_min), int(y_min)), (int(x_max), int(y_max)), (0,0,255), 2)
+                        drawing.draw_text(
+                            text=str(int(confidence*100)),
+                            pos=(int(x_max)-int(w/2), int(y_max)-int(h/2)),
+                        )
+                    renderer.render(os.path.join(output_dirs["labelled_images"], output_filename), image, drawing,
+                                    img)
                     with open(os.path.join(output_dirs["labels_images"], Path(os.path.split(output_filename)[1]).stem + ".txt"), "w") as f:
                         f.writelines("\n".join(detections_rows))
+                    # The detections are written in bulk. The image is added to the journal by the writer
+                    stored_images.extend(writer.add(storage_rows, item=(image, cut_images), key=f"{image_input_num}:{image}"))
+                    handled_images += 1
+                del frames
+
+                reservation.release()
+
+                # Not yielded while holding the memory reservation: The next module might wait for it (batches
+                # prefetched ahead stay reserved as they are in memory). Only cut images already in the database are
+                # passed on
+                for image in handled:
                     handled_images += 1
+                    yield from detection_storage.get_cut_images_for_image(image)
+                for _, cut_images in stored_images:
+                    yield from cut_images
 
-                # Calculate the remaining time
-                time_left = max(((time.time()-start_time_detection)/(handled_images/total_images)) - (time.time() - start_time_detection), 0)
-                logger.info(f"Source {image_input_num}: Finished image {handled_images} out of {total_images}: {(handled_images/total_images*100.0):3.1f}% done. Estimated time left: {delta_time_format(time_left)}")
+                if total_images and handled_images:
+                    # Calculate the remaining time
+                    time_left = max(((time.time()-start_time_detection)/(handled_images/total_images)) - (time.time() - start_time_detection), 0)
+                    logger.info(f"Source {image_input_num}: Finished image {handled_images} out of {total_images}: {(handled_images/total_images*100.0):3.1f}% done. Estimated time left: {delta_time_format(time_left)}")
+                else:
+                    logger.info(f"Source {image_input_num}: Finished image {handled_images}")
+
+            for _, cut_images in writer.flush():
+                yield from cut_images
+            storage_stats.append(writer.get_stats())
 
         output_dict = dict()
         for key in output_dirs:
@@ -131,8 +247,69 @@ class YoloDetectionClass(BaseClass):
         output_dict["identifier"] = self.get_step_identifier()
         output_dict["sqlite_file"] = self.get_sqlite_file(ctx)
         output_dict["classes.txt"] = classes_path
+        if cache is not None:
+            output_dict["cache"] = cache.get_stats()
+        if governor.enabled:
+            output_dict["memory"] = governor.get_stats()
+        output_dict["storage"] = storage_stats
         ctx["steps"].append(output_dict)
-        return True, ctx
+
+    def get_model(self):
+        # Loading the model takes some time: only do it if we have images which are not in the cache
+        if self.model is None:
+            # The loader can be replaced, e.g. by a stub for benchmarks (c.f. tools/benchmark). It has to return a
+            # callable taking a list of image paths and returning an object with the attributes xyxy and names.
+            loader = self.get_module_config().get("detect_loader", "Detection.YoloDetection.load_hub_model")
+            module_path, func_name = loader.rsplit(".", 1)
+            self.model = getattr(importlib.import_module(module_path), func_name)(
+                    self.get_module_config()["detect_repository"],
+                    self.model_file,
+                    force_reload = self.get_module_config().get("detect_force_reload", False),
+                    )
+        return self.model
+
+    def detect(self, images, cache=None, cache_config=None, frames=None):
+        """
+        Run the detection on a batch of images
+
+        Parameters
+        ----------
+        images          List of image paths
+        cache           The result cache or None
+        cache_config    The config for the cache keys
+        frames          The images decoded by cv2 (BGR, None for broken images). If not given, the model loads the
+                        images itself
+
+        Returns         A list of detections per image in the format [x_min, y_min, x_max, y_max, confidence, class]
+                        and the dict of class names
+        -------
+        """
+        keys = [self.get_cache_key(cache_config, hash_file(i)) if cache is not None else None for i in images]
+        cached = [cache.get(k) if k is not None else None for k in keys]
+        missing = [n for n, c in enumerate(cached) if c is None]
+
+        if frames is not None:
+            # Broken images: no detections
+            for n in [n for n in missing if frames[n] is None]:
+                cached[n] = ([], None)
+            missing = [n for n in missing if frames[n] is not None]
+
+        if len(missing):
+            model = self.get_model()
+            if frames is not None:
+                model_input = [cv2.cvtColor(frames[n], cv2.COLOR_BGR2RGB) for n in missing]
+            else:
+                model_input = [images[n] for n in missing]
+            with trace("inference", images=len(missing)):
+                results = model(model_input)
+            del model_input
+            for n, xyxy in zip(missing, results.xyxy):
+                cached[n] = (xyxy.tolist(), results.names)
+                if keys[n] is not None:
+                    cache.put(keys[n], self.get_step_identifier(), cached[n])
+
+        names = next((c[1] for c in cached if c[1] is not None), dict())
+        return [c[0] for c in cached], names
 
 
 if __name__ == "__main__":
@@ -7,7 +7,7 @@ import uuid
 import json
 import logging
 
-from wolf_utils.misc import getter_factory
+from wolf_utils.misc import getter_factory, iter_getter_factory
 
 logger = logging.getLogger(__name__)
 
@@ -61,7 +61,7 @@ class SimpleLabelEvaluationClass(BaseClass):
                 input_dataclass = input_source["dataclass"]
                 input_getter = input_source["getter"]
                 logger.info(f"Handling source {input_source_num}: {input_dataclass} -> {input_getter}")
-                for image in getter_factory(input_dataclass, input_getter, self.get_sqlite_file(ctx))():
+                for image in iter_getter_factory(input_dataclass, input_getter, self.get_sqlite_file(ctx))():
                     images.append({
                         "image": image,
                         "dataclass": input_dataclass,
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+from sqlalchemy import MetaData, Table, Column, Integer, Float, Numeric, Boolean
+from sqlalchemy import select, func, text, inspect
+
+from Storage.EngineRegistry import get_engine
+from Storage.Pagination import iter_rows
+from wolf_utils.columnar import MANIFEST_FILE, FORMAT_VERSION
+from wolf_utils.misc import batch
+
+logger = logging.getLogger(__name__)
+
+from BaseClass import BaseClass
+
+"""
+Exports the tables of the run to a columnar format for the analysis with numpy or pandas
+
+Each column is written to its own .npy file with a typed dtype (default) or each table to one parquet file (requires
+pandas and pyarrow). NULL values are given by a boolean mask. The manifest.json describes all files. Use
+wolf_utils.columnar to load the tables, the .npy files are memory mapped.
+"""
+
+DEFAULT_TABLES = ["image", "image_segments", "detected_image", "Backmappings", "backmapping_vote",
+                  "FinalDetectionStorage"]
+
+# Rows read at once
+PAGE_SIZE = 10000
+
+
+class ColumnarExportClass(BaseClass):
+    def __init__(self, run_num, config, *args, **kwargs):
+        super().__init__(config=config)
+        self.run_num = run_num
+
+    def run(self, ctx):
+        logger.info(f"Identifier: {self.get_step_identifier()}")
+        logger.info(f"Config: {self.get_module_config()}")
+
+        output_format = self.get_module_config().get("format", "npy")
+        if output_format not in ("npy", "parquet"):
+            raise ValueError(f"Unknown format {output_format}. Use npy or parquet")
+        output_dir = os.path.join(self.get_current_data_dir(ctx), self.get_module_config().get("output_dir", "columnar"))
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+
+        engine = get_engine(self.get_sqlite_file(ctx))
+        existing = set(inspect(engine).get_table_names())
+        tables = [t for t in self.get_module_config().get("tables", DEFAULT_TABLES) if t in existing]
+        missing = [t for t in self.get_module_config().get("tables", DEFAULT_TABLES) if t not in existing]
+        if len(missing):
+            logger.info(f"Tables not in the database: {missing}")
+
+        metadata = MetaData()
+        manifest = {
+            "version": FORMAT_VERSION,
+            "format": output_format,
+            "sqlite_file": self.get_sqlite_file(ctx),
+            "created": time.time(),
+            "tables": dict(),
+        }
+        for table_name in tables:
+            logger.info(f"Exporting table {table_name}")
+            manifest["tables"][table_name] = export_table(engine, get_table(engine, metadata, table_name), output_dir,
+                                                          output_format)
+
+        with open(os.path.join(output_dir, MANIFEST_FILE), "w") as f:
+            json.dump(manifest, f, indent=2)
+
+        ctx["steps"].append({
+            "identifier": self.get_step_identifier(),
+            "sqlite_file": self.get_sqlite_file(ctx),
+            "columnar_dir": output_dir,
+            "format": output_format,
+            "rows": {t: manifest["tables"][t]["rows"] for t in tables},
+        })
+
+        return True, ctx
+
+
+def get_table(engine, metadata, table_name):
+    """
+    Return a table with the columns and the primary key of the database. Only the columns are read: Reflecting the
+    indexes warns about the expression based unique indexes (e.g. uq_Backmappings_row)
+    """
+    inspector = inspect(engine)
+    keys = inspector.get_pk_constraint(table_name)["constrained_columns"]
+    return Table(table_name, metadata, *[Column(c["name"], c["type"], primary_key=c["name"] in keys)
+                                         for c in inspector.get_columns(table_name)])
+
+
+def get_column_dtype(connection, table, column):
+    """
+    Return the numpy dtype of a column and the number of NULL values
+
+    sqlite does not enforce the declared types: Integer columns containing real values are exported as float64.
+    """
+    name = f'"{column.name}"'
+    nulls, reals, texts, max_length = connection.execute(text(
+        f'SELECT COALESCE(SUM({name} IS NULL), 0), COALESCE(SUM(typeof({name}) = \'real\'), 0), '
+        f'COALESCE(SUM(typeof({name}) IN (\'text\', \'blob\')), 0), MAX(LENGTH(CAST({name} AS TEXT))) '
+        f'FROM "{table.name}"'
+    )).one()
+
+    if isinstance(column.type, Boolean) and not texts:
+        return np.dtype(bool), nulls
+    if isinstance(column.type, (Integer, Float, Numeric)) and not texts:
+        if reals or not isinstance(column.type, Integer):
+            return np.dtype(np.float64), nulls
+        return np.dtype(np.int64), nulls
+    return np.dtype(f"U{max(max_length or 0, 1)}"), nulls
+
+
+def _null_value(dtype):
+    if dtype.kind == "f":
+        return np.nan
+    if dtype.kind == "U":
+        return ""
+    if dtype.kind == "b":
+        return False
+    return 0
+
+
+def export_table(engine, table, output_dir, output_format="npy"):
+    """
+    Write one table to output_dir. Returns the description of the table for the manifest
+    """
+    with engine.connect() as connection:
+        rows = connection.execute(select(func.count()).select_from(table)).scalar_one()
+        dtypes = {c.name: get_column_dtype(connection, table, c) for c in table.columns}
+
+    table_dir = os.path.join(output_dir, table.name)
+    if output_format == "npy":
+        Path(table_dir).mkdir(parents=True, exist_ok=True)
+
+    # The npy files are filled page by page, i.e. the table does not have to fit into the memory
+    columns = dict()
+    for name, (dtype, nulls) in dtypes.items():
+        if output_format == "npy":
+            data = np.lib.format.open_memmap(os.path.join(table_dir, f"{name}.npy"), mode="w+", dtype=dtype,
+                                             shape=(rows,))
+            mask = np.lib.format.open_memmap(os.path.join(table_dir, f"{name}.mask.npy"), mode="w+", dtype=bool,
+                                             shape=(rows,)) if nulls else None
+        else:
+            data = np.empty(rows, dtype=dtype)
+            mask = np.zeros(rows, dtype=bool) if nulls else None
+        columns[name] = (data, mask)
+
+    keys = list(table.primary_key.columns)
+    if len(keys) == 1:
+        pages = batch(iter_rows(engine, select(*table.columns), keys[0], PAGE_SIZE), PAGE_SIZE)
+    else:
+        with engine.connect() as connection:
+            pages = [connection.execute(select(*table.columns)).all()]
+
+    position = 0
+    for page in pages:
+        for n, name in enumerate(dtypes):
+            data, mask = columns[name]
+            values = [row[n] for row in page]
+            if mask is not None:
+                null_value = _null_value(data.dtype)
+                mask[position:position + len(page)] = [v is None for v in values]
+                values = [null_value if v is None else v for v in values]
+            data[position:position + len(page)] = values
+        position += len(page)
+
+    description = {"rows": rows, "columns": dict()}
+    for name, (dtype, nulls) in dtypes.items():
+        description["columns"][name] = {
+            "dtype": dtype.str,
+            "nulls": int(nulls),
+        }
+    if output_format == "npy":
+        for name, (data, mask) in columns.items():
+            data.flush()
+            description["columns"][name]["file"] = os.path.join(table.name, f"{name}.npy")
+            description["columns"][name]["mask"] = os.path.join(table.name, f"{name}.mask.npy") \
+                if mask is not None else None
+            if mask is not None:
+                mask.flush()
+    else:
+        import pandas as pd
+        frame = pd.DataFrame({name: _to_pandas(data, mask) for name, (data, mask) in columns.items()})
+        frame.to_parquet(os.path.join(output_dir, f"{table.name}.parquet"), index=False)
+        description["file"] = f"{table.name}.parquet"
+    logger.info(f"Exported {rows} rows of {table.name}")
+    return description
+
+
+def _to_pandas(data, mask):
+    import pandas as pd
+    if mask is None:
+        return data
+    if data.dtype.kind == "i":
+        return pd.arrays.IntegerArray(data, mask)
+    if data.dtype.kind == "b":
+        return pd.arrays.BooleanArray(data, mask)
+    if data.dtype.kind == "U":
+        return pd.array(np.where(mask, None, data.astype(object)), dtype="string")
+    return data
+
+
+if __name__ == "__main__":
+    pass
@@ -41,7 +41,7 @@ class ReviewExportClass(BaseClass):
         bs = BaseStorage(self.get_sqlite_file(ctx))
         wds = WeightedDecisionStorage(self.get_sqlite_file(ctx))
 
-        for image in bs.get_all_images_fullpath():
+        for image in bs.iter_all_images():
             logger.info(f"Handling image {image}")
 
             store_detections_id = []
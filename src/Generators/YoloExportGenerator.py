@@ -6,13 +6,11 @@ import shutil
 from pathlib import Path
 from itertools import repeat, chain
 
-import cv2
-
 from Storage.DataStorage import BaseStorage
 from Storage.FinalDetectionStorage import WeightedDecisionStorage
 from wolf_utils.analysis_helper import to_xcenter_ycenter
 from wolf_utils.ctx_helpers import get_last_variable
-from wolf_utils.misc import draw_text
+from wolf_utils.rendering import get_renderer, Drawing
 
 logger = logging.getLogger(__name__)
 
@@ -43,13 +41,13 @@ class YoloExportClass(BaseClass):
         wds = WeightedDecisionStorage(self.get_sqlite_file(ctx))
         detection_threshold = self.get_module_config()["detection_threshold"]
 
-        for image in bs.get_all_images_fullpath():
+        for image in bs.iter_all_images():
             logger.info(f"Handling image {image}")
             shutil.copy2(image, os.path.join(output_dirs["labels_images"], os.path.split(image)[1]))
 
             img_fname = os.path.splitext(os.path.split(image)[1])[0] + ".jpg"
             img_path = os.path.join(output_dirs["labelled_images"], img_fname)
-            img = cv2.imread(image)
+            drawing = Drawing()
 
             store_detections = []
             for detection in wds.get_detections_for_image(image, detection_threshold):
@@ -67,14 +65,13 @@ class YoloExportClass(BaseClass):
 
                 # Export debug images
 
-                cv2.rectangle(img, (detection.x_min, detection.y_min), (detection.x_max, detection.y_max), (0, 0, 255), 2)
-                draw_text(
-                    img=img,
+                drawing.rectangle((detection.x_min, detection.y_min), (detection.x_max, detection.y_max), (0, 0, 255), 2)
+                drawing.draw_text(
                     text=f"{class_str} ({class_numeric}, {round(class_probability*100)}%)",
                     pos=(int(detection.x_min+(b_w/2)), int(detection.y_min+(b_h/2)))
                 )
 
-            cv2.imwrite(img_path, img)
+            get_renderer().render(img_path, image, drawing)
 
 
             if len(store_detections):
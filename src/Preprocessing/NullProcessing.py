@@ -30,6 +30,18 @@ class NullPreprocessingClass(BaseClass):
 
         return True, ctx
 
+    def can_stream(self, upstream_output):
+        return upstream_output is not None
+
+    def get_stream_output(self, upstream_output):
+        # We do not change anything
+        return upstream_output
+
+    def stream(self, ctx, inputs):
+        for unit in inputs:
+            yield unit
+        self.run(ctx)
+
 
 if __name__ == "__main__":
     pass
@@ -10,6 +10,12 @@ from imutils import contours
 import logging
 
 from wolf_utils.misc import getter_factory
+from wolf_utils.cache import hash_file
+from wolf_utils.tracing import trace
+from wolf_utils.memory import get_memory_governor
+from wolf_utils.frame_cache import imread
+from wolf_utils.prefetch import prefetch
+from wolf_utils.rendering import get_renderer, get_pending_files, Drawing
 
 logger = logging.getLogger(__name__)
 
@@ -19,7 +25,12 @@ from Storage.DataStorage import SegmentDataStorage
 from wolf_utils.ImageHandling import get_avg_image, filter_small_boxes, group_rectangles, get_greycount, extend_boxes
 
 
-## Does nothing. Is used as kind of a template for other classes
+# The batches as streamed by the TimeBatchingClass and the former getter of the configs giving the same images
+BATCH_STREAM_OUTPUT = ("Storage.DataStorage.BatchingDataStorage", "get_batch_fullpaths")
+LEGACY_BATCH_INPUT = ("Storage.DataStorage.BatchingDataStorage", "get_batches")
+
+
+## Segment the images batch-wise using a MOG2 background subtractor
 class MOG2Class(BaseClass):
     def __init__(self, run_num, config, *args, **kwargs):
         super().__init__(config=config)
@@ -28,15 +39,80 @@ class MOG2Class(BaseClass):
     def run(self, ctx):
         logger.info(f"Identifier: {self.get_step_identifier()}")
         logger.info(f"Config: {self.get_module_config()}")
+
+        self.segments_db = SegmentDataStorage(self.get_sqlite_file(ctx))
+        work_unit_stats = self.run_work_units(ctx)
+
+        self.add_step(ctx, work_unit_stats)
+
+        return True, ctx
+
+    def add_step(self, ctx, stats):
+        ctx["steps"].append({
+            "identifier": self.get_step_identifier(),
+            "sqlite_file": self.get_sqlite_file(ctx),
+            "segment_output_dir": self.get_segment_output_dir(ctx),
+            "extra_images_dir": self.get_extra_images_dir(ctx),
+            **stats,
+        })
+
+    def can_stream(self, upstream_output):
+        if upstream_output is not None and tuple(upstream_output) == BATCH_STREAM_OUTPUT:
+            # Configs with the ORM getter of the batches get the same units
+            inputs = self.get_module_config().get("inputs", [])
+            if len(inputs) and (inputs[0]["dataclass"], inputs[0]["getter"]) == LEGACY_BATCH_INPUT:
+                return True
+        return self.stream_accepts_input(upstream_output)
+
+    def get_stream_output(self, upstream_output):
+        return "Storage.DataStorage.SegmentDataStorage", "get_segments"
+
+    def stream(self, ctx, inputs):
+        logger.info(f"Identifier: {self.get_step_identifier()}")
+        logger.info(f"Config: {self.get_module_config()}")
+
+        self.segments_db = SegmentDataStorage(self.get_sqlite_file(ctx))
+        args = self.get_work_unit_args(ctx)
+        done = self.get_done_work_units(ctx)
+
+        num_batches = 0
+        skipped_batches = 0
+        for images_raw in inputs:
+            num_batches += 1
+            if self.get_work_unit_journal_key(ctx, images_raw) in done:
+                skipped_batches += 1
+                yield from self.segments_db.get_segments_for_images(images_raw)
+                continue
+            logger.info(f"Handling batch number {num_batches}")
+            segments = self.process_work_unit_cached(ctx, images_raw, args)
+            # The segments are passed on once they are in the database
+            for _, stored_segments in self.commit_work_unit_result(ctx, images_raw, segments):
+                for segment in stored_segments:
+                    yield segment["segment_fullpath"]
+        for _, stored_segments in self.flush_work_unit_results(ctx):
+            for segment in stored_segments:
+                yield segment["segment_fullpath"]
+
+        stats = {"num_work_units": num_batches, "skipped_work_units": skipped_batches}
+        if getattr(self, "_work_unit_writer", None) is not None:
+            stats["storage"] = self._work_unit_writer.get_stats()
+        if self.get_result_cache() is not None:
+            stats["cache"] = self.get_result_cache().get_stats()
+        self.add_step(ctx, stats)
+
+    def get_segment_output_dir(self, ctx):
         segment_output_dir = os.path.join(self.get_current_data_dir(ctx), self.get_module_config()["segments_dir"])
         Path(segment_output_dir).mkdir(parents=True, exist_ok=True)
+        return segment_output_dir
 
+    def get_extra_images_dir(self, ctx):
         extra_images_dir = self.get_module_config()["extra_dir"]
         if extra_images_dir is not None:
             extra_images_dir = os.path.join(self.get_current_data_dir(ctx), extra_images_dir)
             Path(extra_images_dir).mkdir(parents=True, exist_ok=True)
+        return extra_images_dir
 
-        segments_db = SegmentDataStorage(self.get_sqlite_file(ctx))
+    def get_work_units(self, ctx):
         inputs = self.get_module_config()["inputs"]
         if len(inputs) != 1:
             raise ValueError(
@@ -45,106 +121,230 @@ class MOG2Class(BaseClass):
 
         batches = getter_factory(inputs[0]["dataclass"], inputs[0]["getter"], self.get_sqlite_file(ctx))()
 
+        # Each batch has its own background model -> the batches are independent
         for batch_num, batch in enumerate(batches):
             logger.info(f"Handling batch number {batch_num + 1}")
-            images_raw = [image.fullpath for image in batch[0].images]
-            bgsubtractor = cv2.createBackgroundSubtractorMOG2(
-                history=self.get_module_config()["segmentation_detector_history"],
-                varThreshold=self.get_module_config()["segmentation_detector_varThreshold"],
-                detectShadows=self.get_module_config()["segmentation_detector_detectShadows"],
-            )  # history=3, varThreshold=75, detectShadows=False
-            bgsubtractor.apply(get_avg_image(
+            if isinstance(batch, list):
+                # get_batch_fullpaths
+                yield batch
+            else:
+                # Rows of ImageBatch objects (get_batches)
+                yield [image.fullpath for image in batch[0].images]
+
+    def get_work_unit_args(self, ctx):
+        return self.get_module_config(), self.get_segment_output_dir(ctx), self.get_extra_images_dir(ctx)
+
+    @staticmethod
+    def process_work_unit(images_raw, config, segment_output_dir, extra_images_dir):
+        """
+        Segment one batch of images
+
+        Parameters
+        ----------
+        images_raw          List of the image paths of this batch
+        config              The module config
+        segment_output_dir  Directory for the segments
+        extra_images_dir    Directory for the debug images or None
+
+        Returns             A list of dicts with the arguments for SegmentDataStorage.store
+        -------
+        """
+        segments = []
+        bgsubtractor = cv2.createBackgroundSubtractorMOG2(
+            history=config["segmentation_detector_history"],
+            varThreshold=config["segmentation_detector_varThreshold"],
+            detectShadows=config["segmentation_detector_detectShadows"],
+        )  # history=3, varThreshold=75, detectShadows=False
+        with trace("average_image"):
+            avg_image = get_avg_image(
                 images_raw,
-                self.get_module_config()["average_image_percentage"],
-                self.get_module_config()["average_image_min_images"]
-            ))  # Feed with reference (avg) image
-
-            for image_n, image in enumerate(images_raw):
-                image_name = os.path.basename(image).split(".")
-                image_name = (".".join(image_name[:-1]), ".".join(image_name[-1:]))
-
-                img_array = cv2.imread(image)
-
-                if img_array is None:
-                    logging.warning(f"{image} is not a valid image. Skipping")
-                    continue
-
-                min_area = int(
-                    img_array.shape[0] * img_array.shape[1] * self.get_module_config()["segmentation_min_area"])
-                extend_box = self.get_module_config()["segmentation_extend_boxes"]
-                frameDelta = bgsubtractor.apply(img_array)
-
-                # Check params: https://docs.opencv.org/3.4/d3/dc0/group__imgproc__shape.html#ga17ed9f5d79ae97bd4c7cf18403e1689a
-                cnts = cv2.findContours(frameDelta, cv2.RETR_LIST, cv2.CHAIN_APPROX_TC89_L1)
-                cnts = imutils.grab_contours(cnts)  # Convenience function for openCV changed behaviour of findContours
-
-                if len(cnts) == 0:
-                    # No contours found. Next image
-                    logging.info("No contours found in image " + str(image))
-                    continue
-
-                (cnts, boundingBoxes) = contours.sort_contours(cnts)
-
-                annotated_img = img_array.copy()  # original image
-                dots_img = frameDelta.copy()  # image from bg subtractor
-
-                for bb_i, bb in enumerate(
-                        group_rectangles(filter_small_boxes(extend_boxes(boundingBoxes, extend_box), min_area), 2)):
-                    c = get_greycount(bb, dots_img)
-                    if c < self.get_module_config()["segmentation_grey_limit"]:
-                        # Most probably leafs or the like -> ignore
-                        continue
-                    (x, y, w, h) = bb
-
-                    if min(w, h) < self.get_module_config()["segmentation_detector_min_wh"]:
-                        # too small boxes
-                        continue
-
-                    # Limit to max image size
-                    y_min = max(y, 0)
-                    y_max = min(y + h, img_array.shape[0])
-                    x_min = max(x, 0)
-                    x_max = min(x + w, img_array.shape[1])
-
-                    if extra_images_dir:
-                        # Store the debug images
-                        cv2.rectangle(annotated_img, (x, y), (x + w, y + h), (0, 0, 255), 2)
-                        cv2.putText(annotated_img, str(int(c)), (x + int(w / 2), y + int(h / 2)),
-                                    cv2.FONT_HERSHEY_DUPLEX, 1, (0, 0, 255))
-                        cv2.rectangle(dots_img, (x, y), (x + w, y + h), (255, 255, 255), 2)
-                        cv2.putText(dots_img, str(int(c)), (x + int(w / 2), y + int(h / 2)), cv2.FONT_HERSHEY_DUPLEX, 1,
-                                    (255, 255, 255))
-
-                    cut_image = img_array[y_min:y_max, x_min:x_max]
-                    filename = os.path.join(segment_output_dir,
-                                            image_name[0] + "_cut_" + str(bb_i + 1) + "." + image_name[1])
-                    cv2.imwrite(filename, cut_image)
-
-                    segments_db.store(
-                        image=image,
-                        segment_fullpath=filename,
-                        y_min=y_min,
-                        y_max=y_max,
-                        x_min=x_min,
-                        x_max=x_max,
-                        output_width=cut_image.shape[1],
-                        output_height=cut_image.shape[0],
-                        creator=__name__,
-                    )
-
-                if extra_images_dir:
-                    cv2.imwrite(os.path.join(extra_images_dir, image_name[0] + "_debug." + image_name[1]),
-                                annotated_img)
-                    cv2.imwrite(os.path.join(extra_images_dir, image_name[0] + "_dots." + image_name[1]), dots_img)
-
-        ctx["steps"].append({
-            "identifier": self.get_step_identifier(),
-            "sqlite_file": self.get_sqlite_file(ctx),
-            "segment_output_dir": segment_output_dir,
-            "extra_images_dir": extra_images_dir,
-        })
-
-        return True, ctx
+                config["average_image_percentage"],
+                config["average_image_min_images"],
+                config.get("prefetch", 0),
+            )
+        bgsubtractor.apply(avg_image)  # Feed with reference (avg) image
+
+        governor = get_memory_governor()
+        # The next images are decoded while the current one is segmented. The order is kept for the background model
+        depth = config.get("prefetch", 0)
+        if depth > 0:
+            depth = lambda: governor.get_batch_size(config["prefetch"], avg_image.nbytes)
+        # The decoded image and the annotated copy are reserved before decoding. The images of a batch have the size
+        # of the average image
+        for image, img_array, _ in prefetch(images_raw, imread, depth, reserve=lambda image: 2 * avg_image.nbytes):
+            segments.extend(MOG2Class.segment_image(
+                image, bgsubtractor, config, segment_output_dir, extra_images_dir, img_array))
+
+        return segments
+
+    @staticmethod
+    def segment_image(image, bgsubtractor, config, segment_output_dir, extra_images_dir, img_array=None):
+        """
+        Segment one image of a batch. Returns a list of dicts with the arguments for SegmentDataStorage.store
+
+        img_array is the decoded image if it is already loaded (e.g. prefetched)
+        """
+        segments = []
+        image_name = os.path.basename(image).split(".")
+        image_name = (".".join(image_name[:-1]), ".".join(image_name[-1:]))
+
+        if img_array is None:
+            with trace("decode"):
+                img_array = imread(image)
+
+        if img_array is None:
+            logger.warning(f"{image} is not a valid image. Skipping")
+            return segments
+
+        min_area = int(
+            img_array.shape[0] * img_array.shape[1] * config["segmentation_min_area"])
+        extend_box = config["segmentation_extend_boxes"]
+        with trace("mog2_apply"):
+            frameDelta = bgsubtractor.apply(img_array)
+
+        # Check params: https://docs.opencv.org/3.4/d3/dc0/group__imgproc__shape.html#ga17ed9f5d79ae97bd4c7cf18403e1689a
+        cnts = cv2.findContours(frameDelta, cv2.RETR_LIST, cv2.CHAIN_APPROX_TC89_L1)
+        cnts = imutils.grab_contours(cnts)  # Convenience function for openCV changed behaviour of findContours
+
+        if len(cnts) == 0:
+            # No contours found. Next image
+            logger.info("No contours found in image " + str(image))
+            return segments
+
+        (cnts, boundingBoxes) = contours.sort_contours(cnts)
+
+        annotated_drawing = Drawing()  # original image
+        dots_img = frameDelta.copy()  # image from bg subtractor
+
+        for bb_i, bb in enumerate(
+                group_rectangles(filter_small_boxes(extend_boxes(boundingBoxes, extend_box), min_area), 2)):
+            c = get_greycount(bb, dots_img)
+            if c < config["segmentation_grey_limit"]:
+                # Most probably leafs or the like -> ignore
+                continue
+            (x, y, w, h) = bb
+
+            if min(w, h) < config["segmentation_detector_min_wh"]:
+                # too small boxes
+                continue
+
+            # Limit to max image size
+            y_min = max(y, 0)
+            y_max = min(y + h, img_array.shape[0])
+            x_min = max(x, 0)
+            x_max = min(x + w, img_array.shape[1])
+
+            if extra_images_dir:
+                # Store the debug images. The boxes in the dots image are part of the grey count of the next boxes:
+                # They are drawn directly
+                annotated_drawing.rectangle((x, y), (x + w, y + h), (0, 0, 255), 2)
+                annotated_drawing.put_text(str(int(c)), (x + int(w / 2), y + int(h / 2)), cv2.FONT_HERSHEY_DUPLEX,
+                                           1, (0, 0, 255))
+                cv2.rectangle(dots_img, (x, y), (x + w, y + h), (255, 255, 255), 2)
+                cv2.putText(dots_img, str(int(c)), (x + int(w / 2), y + int(h / 2)), cv2.FONT_HERSHEY_DUPLEX, 1,
+                            (255, 255, 255))
+
+            cut_image = img_array[y_min:y_max, x_min:x_max]
+            filename = os.path.join(segment_output_dir,
+                                    image_name[0] + "_cut_" + str(bb_i + 1) + "." + image_name[1])
+            with trace("imwrite"):
+                cv2.imwrite(filename, cut_image)
+
+            segments.append({
+                "image": image,
+                "segment_fullpath": filename,
+                "y_min": y_min,
+                "y_max": y_max,
+                "x_min": x_min,
+                "x_max": x_max,
+                "output_width": cut_image.shape[1],
+                "output_height": cut_image.shape[0],
+                "creator": __name__,
+            })
+
+        if extra_images_dir:
+            renderer = get_renderer()
+            renderer.render(os.path.join(extra_images_dir, image_name[0] + "_debug." + image_name[1]), image,
+                            annotated_drawing, img_array)
+            renderer.render(os.path.join(extra_images_dir, image_name[0] + "_dots." + image_name[1]), None,
+                            frame=dots_img)
+
+        return segments
+
+    def get_work_unit_journal_key(self, ctx, images_raw):
+        # An image is only in one batch
+        return images_raw[0] if len(images_raw) else None
+
+    def purge_work_unit(self, ctx, images_raw):
+        self.segments_db.delete_for_images(images_raw, creator=__name__)
+
+    def purge_work_units(self, ctx, items):
+        self.segments_db.delete_for_images([image for images_raw in items for image in images_raw], creator=__name__)
+
+    def get_work_unit_rows(self, ctx, images_raw, segments):
+        return segments
+
+    def store_work_unit_rows(self, ctx, rows):
+        self.segments_db.store_many(rows)
+
+    @staticmethod
+    def get_extra_image_names(image):
+        name, ext = os.path.splitext(os.path.basename(image))
+        return name + "_debug" + ext, name + "_dots" + ext
+
+    def get_work_unit_cache_key(self, ctx, images_raw):
+        # The names of the output files depend on the image names
+        config = {k: v for k, v in self.get_module_config().items()
+                  if k.startswith("segmentation_") or k.startswith("average_image_")}
+        config["extra_images"] = self.get_extra_images_dir(ctx) is not None
+        if config["extra_images"] and get_renderer().get_cache_config() is not None:
+            config["render"] = get_renderer().get_cache_config()
+        return self.get_cache_key(config, [(os.path.basename(i), hash_file(i)) for i in images_raw])
+
+    def to_cache(self, ctx, images_raw, segments):
+        # Store the segments relative to the batch and include the created files
+        cached_segments = []
+        files = dict()
+        for segment in segments:
+            segment = dict(segment)
+            segment["image"] = images_raw.index(segment["image"])
+            with open(segment["segment_fullpath"], "rb") as f:
+                files[("segments", os.path.basename(segment["segment_fullpath"]))] = f.read()
+            segment["segment_fullpath"] = os.path.basename(segment["segment_fullpath"])
+            cached_segments.append(segment)
+
+        extra_images_dir = self.get_extra_images_dir(ctx)
+        if extra_images_dir is not None:
+            # The images of this batch might still be rendered in the background
+            get_renderer().flush()
+            for image in images_raw:
+                for name in self.get_extra_image_names(image):
+                    # Or the files to render it later (c.f. wolf_utils.rendering)
+                    for path in [os.path.join(extra_images_dir, name)] + get_pending_files(
+                            os.path.join(extra_images_dir, name)):
+                        if os.path.isfile(path):
+                            with open(path, "rb") as f:
+                                files[("extra", os.path.relpath(path, extra_images_dir))] = f.read()
+
+        return {"segments": cached_segments, "files": files}
+
+    def from_cache(self, ctx, images_raw, value):
+        dirs = {
+            "segments": self.get_segment_output_dir(ctx),
+            "extra": self.get_extra_images_dir(ctx),
+        }
+        for (d, name), content in value["files"].items():
+            Path(os.path.dirname(os.path.join(dirs[d], name))).mkdir(parents=True, exist_ok=True)
+            with open(os.path.join(dirs[d], name), "wb") as f:
+                f.write(content)
+
+        segments = []
+        for segment in value["segments"]:
+            segment = dict(segment)
+            segment["image"] = images_raw[segment["image"]]
+            segment["segment_fullpath"] = os.path.join(dirs["segments"], segment["segment_fullpath"])
+            segments.append(segment)
+        return segments
 
 
 if __name__ == "__main__":
@@ -4,14 +4,30 @@ import logging
 
 logger = logging.getLogger(__name__)
 
-from sqlalchemy import String, Integer
+from Storage.EngineRegistry import get_engine, create_tables
+from Storage.DatabaseWriter import execute_write
+
+from sqlalchemy import String, Integer, Float, Index, ForeignKey, func
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.orm import mapped_column
-from sqlalchemy import create_engine
 from sqlalchemy.orm import Session
 from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert
+from Storage.Pagination import iter_scalars, count_rows
+from Storage.BulkWriter import MAX_IN_VALUES
+from wolf_utils.misc import batch
+from wolf_utils.types import VoteArrays
 
 import json
+import numpy as np
+
+
+def get_box_center_wh(x_min, x_max, y_min, y_max):
+    w = round(x_max - x_min)
+    h = round(y_max - y_min)
+    x_center = round(x_min + (w/2))
+    y_center = round(y_min + (h/2))
+    return (x_center, y_center, w, h)
 
 
 ## Table definitions
@@ -22,7 +38,7 @@ class Base(DeclarativeBase):
 class Backmapping(Base):
     __tablename__ = "Backmappings"
     id = mapped_column(Integer, primary_key=True)
-    image_fullpath = mapped_column(String())
+    image_fullpath = mapped_column(String(), index=True)
     image_name = mapped_column(String())
     source = mapped_column(String())
     votings = mapped_column(String())
@@ -42,11 +58,7 @@ class Backmapping(Base):
         -------
         """
 
-        w = round(self.x_max - self.x_min)
-        h = round(self.y_max - self.y_min)
-        x_center = round(self.x_min + (w/2))
-        y_center = round(self.y_min + (h/2))
-        return (x_center, y_center, w, h)
+        return get_box_center_wh(self.x_min, self.x_max, self.y_min, self.y_max)
 
     def get_votings(self):
         """
@@ -58,20 +70,81 @@ class Backmapping(Base):
         return json.loads(self.votings)
 
     def get_votings_list(self):
-        if isinstance(self.get_votings(), dict):
-            return list(self.get_votings().items())
-        return list(self.get_votings())
+        votings = self.get_votings()
+        if isinstance(votings, dict):
+            return list(votings.items())
+        return list(votings)
 
 
+class BackmappingVote(Base):
+    """
+    One vote of a mapping: The class probability of a source. entry is the position of the (source, {class: p})
+    tuple in the votings of the mapping. Entries without any class have one vote with class_id None
+    """
+    __tablename__ = "backmapping_vote"
+    id = mapped_column(Integer, primary_key=True)
+    backmapping_id = mapped_column(ForeignKey("Backmappings.id"), index=True)
+    entry = mapped_column(Integer)
+    source = mapped_column(String())
+    class_id = mapped_column(String())
+    probability = mapped_column(Float)
+
+
+
+# Each mapping is only stored once (c.f. Storage.Migrations)
+Index("uq_Backmappings_row", *[func.ifnull(c, "") for c in (
+    Backmapping.image_fullpath, Backmapping.image_name, Backmapping.source, Backmapping.votings,
+    Backmapping.x_min, Backmapping.x_max, Backmapping.y_min, Backmapping.y_max)], unique=True)
 
 ## End Table definitions
 
 
+def encode_votings(votings):
+    """
+    Return the rows of the vote table (without backmapping_id) for the votings of a mapping
+
+    votings is a list of (source, {class: probability}) tuples or a dict source -> {class: probability}
+    """
+    if isinstance(votings, dict):
+        votings = votings.items()
+    votes = []
+    for entry, (source, voting) in enumerate(votings):
+        if not len(voting):
+            votes.append({"entry": entry, "source": source, "class_id": None, "probability": None})
+        for class_id, probability in voting.items():
+            votes.append({"entry": entry, "source": source, "class_id": str(class_id), "probability": probability})
+    return votes
+
+
+def decode_votings(votes):
+    """
+    Return a dict backmapping_id -> votings list [(source, {class: probability}), ...] for VoteArrays
+    """
+    votings = dict()
+    if not len(votes.backmapping_id):
+        return votings
+    # Each entry starts with a new mapping or a new entry number
+    starts = np.flatnonzero(np.concatenate((
+        [True],
+        (np.diff(votes.backmapping_id) != 0) | (np.diff(votes.entry) != 0),
+    )))
+    ends = np.append(starts[1:], len(votes.backmapping_id))
+    backmapping_ids = votes.backmapping_id[starts].tolist()
+    sources = votes.source[starts].tolist()
+    class_ids = votes.class_id.tolist()
+    probabilities = votes.probability.tolist()
+    for backmapping_id, source, start, end in zip(backmapping_ids, sources, starts.tolist(), ends.tolist()):
+        voting = {class_ids[n]: probabilities[n] for n in range(start, end) if class_ids[n] is not None}
+        votings.setdefault(backmapping_id, []).append((source, voting))
+    return votings
+
+
+
 class BackmappingStorage:
     def __init__(self, file):
         self.file = file
-        self.engine = create_engine(self.file)
-        Base.metadata.create_all(self.engine)
+        self.engine = get_engine(self.file)
+        create_tables(Base.metadata, self.engine)
 
     @staticmethod
     def get_class():
@@ -87,38 +160,107 @@ class BackmappingStorage:
               y_min,
               y_max
               ):
-        with Session(self.engine) as session:
-            if session.query(Backmapping).filter_by(
-                    image_fullpath=image_fullpath,
-                    image_name=image_name,
-                    source=source,
-                    votings=json.dumps(votings),
-                    x_min=x_min,
-                    x_max=x_max,
-                    y_min=y_min,
-                    y_max=y_max
-            ).count() == 0:
-                backmapping = Backmapping(
-                    image_fullpath=image_fullpath,
-                    image_name=image_name,
-                    source=source,
-                    votings=json.dumps(votings),
-                    x_min=x_min,
-                    x_max=x_max,
-                    y_min=y_min,
-                    y_max=y_max,
-                )
-                session.add(backmapping)
-                session.commit()
+        self.store_many([{
+            "image_fullpath": image_fullpath,
+            "image_name": image_name,
+            "source": source,
+            "votings": votings,
+            "x_min": x_min,
+            "x_max": x_max,
+            "y_min": y_min,
+            "y_max": y_max,
+        }, ])
+
+    def store_many(self, rows):
+        """
+        Store several mappings in one transaction. Like store, mappings already in the database are dropped
+
+        Parameters
+        ----------
+        rows    Iterable of dicts with the arguments of store (image_fullpath, image_name, source, votings, ...)
+
+        Returns the number of stored mappings
+        -------
+        """
+        rows = list(rows)
+        if not len(rows):
+            return 0
+
+        def write(session):
+            connection = session.connection()
+            stored = 0
+            votes = []
+            for row in rows:
+                # Existing mappings are ignored by the unique index: No id is returned then
+                backmapping_id = connection.execute(
+                    insert(Backmapping.__table__).values(dict(row, votings=json.dumps(row["votings"])))
+                    .on_conflict_do_nothing().returning(Backmapping.id)
+                ).scalar()
+                if backmapping_id is None:
+                    continue
+                stored += 1
+                votes.extend(dict(v, backmapping_id=backmapping_id) for v in encode_votings(row["votings"]))
+            if len(votes):
+                connection.execute(insert(BackmappingVote.__table__), votes)
+            return stored
+        return execute_write(self.engine, write)
 
     def get_all_images(self):
         with Session(self.engine) as session:
             return session.execute(select(Backmapping.image_fullpath).distinct().order_by(Backmapping.image_fullpath)).scalars().all()
 
+    def iter_all_images(self):
+        """
+        Iterator version of get_all_images(): Yields the paths of the images with backmappings page by page
+        """
+        return iter_scalars(self.engine, select(Backmapping.image_fullpath).distinct(), Backmapping.image_fullpath)
+
+    def count_all_images(self):
+        return count_rows(self.engine, select(Backmapping.image_fullpath).distinct())
+
     def get_backmappings_for_image(self, image):
         with Session(self.engine) as session:
             return session.execute(select(Backmapping).filter_by(image_fullpath=image)).scalars().all()
 
+    def get_boxes_for_images(self, image_fullpaths):
+        """
+        Return a dict image_fullpath -> list of (backmapping_id, (x_center, y_center, w, h)) ordered by id
+        """
+        boxes = {image: [] for image in image_fullpaths}
+        with Session(self.engine) as session:
+            for paths in batch(list(boxes), MAX_IN_VALUES):
+                for row in session.execute(
+                        select(Backmapping.image_fullpath, Backmapping.id, Backmapping.x_min, Backmapping.x_max,
+                               Backmapping.y_min, Backmapping.y_max).where(
+                            Backmapping.image_fullpath.in_(paths)).order_by(Backmapping.id)):
+                    boxes[row[0]].append((row[1], get_box_center_wh(*row[2:])))
+        return boxes
+
+    def get_votes_for_images(self, image_fullpaths):
+        """
+        Return the votes of all mappings of the given images as VoteArrays ordered by mapping and vote (c.f.
+        decode_votings)
+        """
+        rows = []
+        with Session(self.engine) as session:
+            for paths in batch(list(image_fullpaths), MAX_IN_VALUES):
+                rows.extend(session.execute(
+                    select(BackmappingVote.backmapping_id, BackmappingVote.entry, BackmappingVote.source,
+                           BackmappingVote.class_id, func.coalesce(BackmappingVote.probability, 0.0)).join(
+                        Backmapping, Backmapping.id == BackmappingVote.backmapping_id).where(
+                        Backmapping.image_fullpath.in_(paths)).order_by(
+                        BackmappingVote.backmapping_id, BackmappingVote.id)
+                ).tuples().all())
+        rows.sort(key=lambda row: row[0])  # The batches are in any order, the votes of a mapping stay in order
+        columns = list(zip(*rows)) if len(rows) else [()] * 5
+        return VoteArrays(
+            backmapping_id=np.array(columns[0], dtype=np.int64),
+            entry=np.array(columns[1], dtype=np.int64),
+            source=np.array(columns[2], dtype=object),
+            class_id=np.array(columns[3], dtype=object),
+            probability=np.array(columns[4], dtype=np.float64),
+        )
+
     def get_backmapping_by_id(self, image_id):
         """
         Return a mapping based on the dataset id
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+from wolf_utils.tracing import trace
+
+# Number of rows written at once if nothing else is configured (c.f. "storage_flush_size")
+DEFAULT_FLUSH_SIZE = 500
+
+# Number of values in one "IN" clause. Stays well below the variable limit of older sqlite versions
+MAX_IN_VALUES = 500
+
+
+class BulkWriter:
+    """
+    Collect the rows of several items and write them with one transaction
+
+    The rows are passed to store_many once flush_size rows are buffered. Items with a journal key are purged before
+    (they might have been stored partially by an interrupted run) and marked done afterwards, i.e. an item is only
+    in the journal if all of its rows are stored.
+    """
+    def __init__(self, store_many, flush_size=DEFAULT_FLUSH_SIZE, purge=None, mark_done=None):
+        """
+        Parameters
+        ----------
+        store_many  Callable storing a list of rows, e.g. SegmentDataStorage.store_many
+        flush_size  Number of rows buffered before they are written. Values below 1 write every item at once
+        purge       Callable removing everything stored for a list of items or None
+        mark_done   Callable adding a list of journal keys to the journal or None
+        """
+        self.store_many = store_many
+        self.flush_size = max(int(flush_size), 1)
+        self.purge = purge
+        self.mark_done = mark_done
+
+        self.rows = []
+        self.items = []
+        self.keys = []
+
+        self.flushes = 0
+        self.stored_rows = 0
+
+    def add(self, rows, item=None, key=None):
+        """
+        Buffer the rows of an item
+
+        Returns the list of items written by this call (i.e. empty if the rows are still buffered)
+        """
+        self.rows.extend(rows)
+        self.items.append(item)
+        self.keys.append(key)
+        if len(self.rows) >= self.flush_size:
+            return self.flush()
+        return []
+
+    def flush(self):
+        """
+        Write all buffered rows. Returns the list of the written items
+        """
+        if not len(self.items):
+            return []
+
+        rows, items, keys = self.rows, self.items, self.keys
+        self.rows, self.items, self.keys = [], [], []
+
+        with trace("db_write", rows=len(rows)):
+            journaled = [item for item, key in zip(items, keys) if key is not None]
+            if self.purge is not None and len(journaled):
+                self.purge(journaled)
+            if len(rows):
+                self.store_many(rows)
+            if self.mark_done is not None:
+                done = [key for key in keys if key is not None]
+                if len(done):
+                    self.mark_done(done)
+
+        self.flushes += 1
+        self.stored_rows += len(rows)
+        logger.debug(f"Stored {len(rows)} rows of {len(items)} items")
+        return items
+
+    def get_stats(self):
+        return {
+            "flush_size": self.flush_size,
+            "flushes": self.flushes,
+            "stored_rows": self.stored_rows,
+        }
+
+
+if __name__ == "__main__":
+    pass
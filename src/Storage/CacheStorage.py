@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+from Storage.EngineRegistry import get_engine, create_tables
+
+import time
+import pickle
+
+from sqlalchemy import String, Integer, Float, LargeBinary
+from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.orm import mapped_column
+from sqlalchemy.orm import Session
+from sqlalchemy import select, delete, update, func
+
+
+## Table definitions
+class Base(DeclarativeBase):
+    pass
+
+
+class CacheEntry(Base):
+    __tablename__ = "result_cache"
+    key = mapped_column(String(), primary_key=True)
+    module = mapped_column(String())
+    size = mapped_column(Integer)
+    last_access = mapped_column(Float, index=True)
+    value = mapped_column(LargeBinary)
+
+    def __repr__(self):
+        return f"Cache entry {self.key} of module {self.module}"
+
+## End Table definitions
+
+
+class ResultCacheStorage:
+    """
+    Persistent cache for results of the modules. Lives outside of the output directory to be shared between runs.
+
+    The least recently used entries are removed if the cache exceeds max_bytes.
+    """
+    def __init__(self, file, max_bytes=10 * 1024 ** 3):
+        self.file = file
+        self.max_bytes = max_bytes
+        self.engine = get_engine(self.file)
+        create_tables(Base.metadata, self.engine)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        with Session(self.engine) as session:
+            self.total_bytes = session.execute(select(func.coalesce(func.sum(CacheEntry.size), 0))).scalar_one()
+
+    @staticmethod
+    def get_class():
+        return CacheEntry
+
+    def get(self, key):
+        """
+        Return the cached value or None
+        """
+        with Session(self.engine) as session:
+            value = session.execute(select(CacheEntry.value).where(CacheEntry.key == key)).scalar_one_or_none()
+            if value is None:
+                self.misses += 1
+                return None
+            session.execute(update(CacheEntry).where(CacheEntry.key == key).values(last_access=time.time()))
+            session.commit()
+        self.hits += 1
+        return pickle.loads(value)
+
+    def put(self, key, module, value):
+        value = pickle.dumps(value)
+        if len(value) > self.max_bytes:
+            logger.warning(f"Value for {module} is larger than the cache. Not caching.")
+            return
+
+        with Session(self.engine) as session:
+            old_size = session.execute(select(CacheEntry.size).where(CacheEntry.key == key)).scalar_one_or_none()
+            session.merge(CacheEntry(
+                key=key,
+                module=module,
+                size=len(value),
+                last_access=time.time(),
+                value=value,
+            ))
+            session.commit()
+        self.total_bytes += len(value) - (old_size or 0)
+
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache is below 90% of its maximum size
+        """
+        with Session(self.engine) as session:
+            for key, size in session.execute(
+                    select(CacheEntry.key, CacheEntry.size).order_by(CacheEntry.last_access)).all():
+                if self.total_bytes <= self.max_bytes * 0.9:
+                    break
+                session.execute(delete(CacheEntry).where(CacheEntry.key == key))
+                self.total_bytes -= size
+                self.evictions += 1
+            session.commit()
+
+    def get_stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size_bytes": self.total_bytes,
+        }
+
+
+if __name__ == "__main__":
+    pass
@@ -4,7 +4,6 @@ import logging
 logger = logging.getLogger(__name__)
 
 import os
-import cv2
 
 from typing import List
 from typing import Optional
@@ -14,11 +13,20 @@ from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.orm import Mapped
 from sqlalchemy.orm import mapped_column
 from sqlalchemy.orm import relationship
-from sqlalchemy import create_engine
 from sqlalchemy.orm import Session
-from sqlalchemy import select
-
-from wolf_utils.types import ReturnDetectionDict
+from sqlalchemy.orm import selectinload
+from sqlalchemy import select, delete, update, func, Index, inspect
+from sqlalchemy.dialects.sqlite import insert
+
+from Storage.EngineRegistry import get_engine, create_tables
+from Storage.DatabaseWriter import execute_write
+from Storage.BulkWriter import MAX_IN_VALUES
+from Storage.Pagination import iter_scalars, count_rows
+from Storage.LineageStorage import LineageStorage
+from Storage.ThumbnailStorage import ThumbnailStorage
+from wolf_utils.misc import batch
+from wolf_utils.image_header import get_image_dimensions
+from wolf_utils.types import ReturnDetectionDict, ImageRecord, SegmentBox
 
 ## Table definitions
 class Base(DeclarativeBase):
@@ -29,16 +37,17 @@ class Image(Base):
     __tablename__ = "image"
     id: Mapped[int] = mapped_column(primary_key=True)
     name: Mapped[str] = mapped_column(String())
-    fullpath: Mapped[str] = mapped_column(String())
+    fullpath: Mapped[str] = mapped_column(String(), index=True, unique=True)
 
     width: Mapped[Optional[int]] = mapped_column(Integer())
     height: Mapped[Optional[int]] = mapped_column(Integer())
     colors: Mapped[Optional[int]] = mapped_column(Integer())
 
     batch: Mapped["ImageBatch"] = relationship(back_populates="images")
-    batch_id: Mapped[Optional[int]] = mapped_column(ForeignKey("image_batch.id"))
+    batch_id: Mapped[Optional[int]] = mapped_column(ForeignKey("image_batch.id"), index=True)
 
-    segments = relationship("Segment", lazy="immediate")
+    # Loaded on access. Use selectinload or the projection getters of the storages to avoid a query per image
+    segments = relationship("Segment", lazy="select")
 
     def __repr__(self):
         return f"Image:  {self.name}"
@@ -49,8 +58,8 @@ class ImageMetadata(Base):
     id: Mapped[int] = mapped_column(primary_key=True)
     image_id: Mapped["Image"] = mapped_column(ForeignKey("image.id"))
     imageIsGray: Mapped[bool] = mapped_column(Boolean())
-    exifs: Mapped[Optional[List["Exif"]]] = relationship(back_populates="image_meta", lazy="immediate")
-    iptcs: Mapped[Optional[List["Iptc"]]] = relationship(back_populates="image_meta", lazy="immediate")
+    exifs: Mapped[Optional[List["Exif"]]] = relationship(back_populates="image_meta", lazy="select")
+    iptcs: Mapped[Optional[List["Iptc"]]] = relationship(back_populates="image_meta", lazy="select")
 
     def __repr__(self) -> str:
         return f"ImageMetadata({self.image_id})"
@@ -71,6 +80,10 @@ class Exif(Base):
         return f"Exif dataset: {self.exif_name} -> {self.exif_value}"
 
 
+# The images ordered by one tag (e.g. the time for the batching, c.f. BatchingDataStorage.get_images_by_exif_value)
+Index("ix_image_exif_name_value", Exif.exif_name, Exif.exif_value)
+
+
 class Iptc(Base):
     __tablename__ = "image_iptc"
 
@@ -88,10 +101,13 @@ class Iptc(Base):
 class ImageBatch(Base):
     __tablename__ = "image_batch"
     id: Mapped[int] = mapped_column(primary_key=True)
-    images: Mapped[List["Image"]] = relationship(back_populates="batch", cascade="all, delete-orphan", lazy="immediate")
+    images: Mapped[List["Image"]] = relationship(back_populates="batch", cascade="all, delete-orphan", lazy="select")
     creator: Mapped[str | None] = mapped_column(String())
 
     def __repr__(self):
+        # The images are not available after the session is closed if they were not loaded
+        if "images" in inspect(self).unloaded:
+            return f"Batch {self.id}"
         return f"Batch with {len(self.images)} images"
 
 
@@ -99,10 +115,10 @@ class Segment(Base):
     __tablename__ = "image_segments"
     id: Mapped[int] = mapped_column(primary_key=True)
     #TODO: Rename to image_fullpath
-    base_image: Mapped["Image"] = mapped_column(ForeignKey("image.id", onupdate="cascade"))
+    base_image: Mapped["Image"] = mapped_column(ForeignKey("image.id", onupdate="cascade"), index=True)
 
     creator: Mapped[Optional[str]] = mapped_column(String())
-    segment_fullpath: Mapped[str] = mapped_column(String())
+    segment_fullpath: Mapped[str] = mapped_column(String(), index=True)
 
     y_min: Mapped[int] = mapped_column(Integer())
     y_max: Mapped[int] = mapped_column(Integer())
@@ -116,57 +132,125 @@ class Segment(Base):
 
 ## End Table definitions
 
-
 class BaseStorage:
     def __init__(self, file):
         self.file = file
-        self.engine = create_engine(self.file)
-        Base.metadata.create_all(self.engine)
+        self.engine = get_engine(self.file)
+        create_tables(Base.metadata, self.engine)
+
+    def get_image(self, fullpath, dimensions=None):
+        """
+        Return the database representation of an image (as a row), add it if required
 
-    def get_image(self, fullpath):
+        Parameters
+        ----------
+        fullpath    The path of the image
+        dimensions  (width, height, colors) of the image if already known. Otherwise, they are read from the file
+                    header for new images
+        """
         with Session(self.engine) as session:
             img = session.execute(select(Image).where(Image.fullpath == fullpath)).one_or_none()
             if img is not None:
                 return img
-            else:  # Image does not exist in DB
-                im = cv2.imread(fullpath)
-                if im is None:
-                    height, width, colors = None, None, None
-                else:
-                    height, width, colors = im.shape
-
-                session.add(
-                    Image(name=os.path.split(fullpath)[1],
-                          fullpath=fullpath,
-                          height=height,
-                          width=width,
-                          colors=colors
-                          )
-                )
-                session.commit()
-                return session.execute(select(Image).where(Image.fullpath == fullpath)).one_or_none()
+
+        # Image does not exist in DB
+        if dimensions is None:
+            dimensions = get_image_dimensions(fullpath)
+        width, height, colors = dimensions if dimensions is not None else (None, None, None)
+
+        def write(session):
+            # Another thread might have added the image in the meantime: Nothing is returned then
+            row = session.execute(
+                insert(Image).values(name=os.path.split(fullpath)[1],
+                                     fullpath=fullpath,
+                                     height=height,
+                                     width=width,
+                                     colors=colors
+                                     ).on_conflict_do_nothing().returning(Image)
+            ).one_or_none()
+            if row is not None:
+                # Keep the loaded attributes after the commit
+                session.expunge(row[0])
+            return row
+
+        img = execute_write(self.engine, write)
+        if img is not None:
+            return img
+        with Session(self.engine) as session:
+            return session.execute(select(Image).where(Image.fullpath == fullpath)).one_or_none()
+
+    def get_image_ids(self, fullpaths, dimensions=None):
+        """
+        Return a dict fullpath -> id for the given images. Images not in the database yet are added, dimensions is an
+        optional dict fullpath -> (width, height, colors) for them
+        """
+        fullpaths = list(dict.fromkeys(fullpaths))
+        image_ids = dict()
+        with Session(self.engine) as session:
+            for paths in batch(fullpaths, MAX_IN_VALUES):
+                image_ids.update(session.execute(
+                    select(Image.fullpath, Image.id).where(Image.fullpath.in_(paths))).tuples().all())
+        for fullpath in fullpaths:
+            if fullpath not in image_ids:
+                image_ids[fullpath] = self.get_image(fullpath, (dimensions or dict()).get(fullpath))[0].id
+        return image_ids
 
     def get_all_images(self, img=None):
         with Session(self.engine) as session:
             if img is None:
                 return session.execute(select(Image.fullpath)).scalars().all()
             else:
-                return session.execute(select(Image).filter_by(fullpath=img)).scalars().all()
+                return session.execute(
+                    select(Image).filter_by(fullpath=img).options(selectinload(Image.segments))).scalars().all()
+
+    def iter_all_images(self):
+        """
+        Iterator version of get_all_images(): Yields the paths of all images page by page
+        """
+        return iter_scalars(self.engine, select(Image.fullpath), Image.id)
+
+    def count_all_images(self):
+        return count_rows(self.engine, select(Image.id))
 
     def get_image_by_id(self, image_id):
         with Session(self.engine) as session:
-            return session.execute(select(Image).where(Image.id == image_id)).scalars().one_or_none()
+            return session.execute(
+                select(Image).where(Image.id == image_id).options(selectinload(Image.segments))).scalars().one_or_none()
 
     def get_image_by_fullpath(self, fullpath):
         with Session(self.engine) as session:
-            return session.execute(select(Image).where(Image.fullpath == fullpath)).scalars().one_or_none()
+            return session.execute(select(Image).where(Image.fullpath == fullpath).options(
+                selectinload(Image.segments))).scalars().one_or_none()
 
     def get_all_images_fullpath(self):
         with Session(self.engine) as session:
             return session.execute(select(Image.fullpath)).scalars().all()
 
+    def get_image_records(self, fullpaths=None):
+        """
+        Return ImageRecords (plain tuples) of the given images or of all images if fullpaths is None
+        """
+        columns = select(Image.id, Image.name, Image.fullpath, Image.width, Image.height)
+        with Session(self.engine) as session:
+            if fullpaths is None:
+                return [ImageRecord(*row) for row in session.execute(columns.order_by(Image.id))]
+            records = []
+            for paths in batch(list(fullpaths), MAX_IN_VALUES):
+                records.extend(ImageRecord(*row) for row in session.execute(columns.where(Image.fullpath.in_(paths))))
+            return records
+
+    def get_image_record_by_id(self, image_id):
+        """
+        Return the ImageRecord of an image or None
+        """
+        with Session(self.engine) as session:
+            row = session.execute(
+                select(Image.id, Image.name, Image.fullpath, Image.width, Image.height).where(Image.id == image_id)
+            ).one_or_none()
+            return ImageRecord(*row) if row is not None else None
+
     @staticmethod
-    def get_fullscale_voting(image: Image, sqlitefile: str) -> ReturnDetectionDict:
+    def get_fullscale_voting(image: Image | ImageRecord, sqlitefile: str) -> ReturnDetectionDict:
         return {
             "orig_image_name": str(image.name),
             "orig_image_fullpath": str(image.fullpath),
@@ -182,30 +266,105 @@ class BaseStorage:
 class BasicAnalysisDataStorage(BaseStorage):
     def __init__(self, file):
         super().__init__(file)
+        self.thumbnails = ThumbnailStorage(file)
 
     @staticmethod
     def get_class():
         return ImageMetadata
 
-    def store(self, fullpath, imageIsGray, exifs, iptcs):
-        img_instance = self.get_image(fullpath)[0]
-        with Session(self.engine) as session:
-            img_object = ImageMetadata(
-                image_id=img_instance.id,
-                imageIsGray=imageIsGray,
-                exifs=[Exif(image_id=img_instance.id, exif_name=exif[0], exif_code=exif[1], exif_value=(exif[2])) for
-                       exif in exifs],
-                iptcs=[Iptc(image_id=img_instance.id, iptc_code=iptc[0], iptc_value=iptc[1]) for iptc in iptcs],
-            )
-            session.add_all([img_object, ])
-            session.commit()
+    def store(self, fullpath, imageIsGray, exifs, iptcs, dimensions=None):
+        self.store_many([{
+            "fullpath": fullpath,
+            "imageIsGray": imageIsGray,
+            "exifs": exifs,
+            "iptcs": iptcs,
+            "dimensions": dimensions,
+        }, ])
+
+    def store_many(self, rows):
+        """
+        Store the metadata of several images in one transaction
+
+        Parameters
+        ----------
+        rows    Iterable of dicts with the arguments of store (fullpath, imageIsGray, exifs, iptcs, optionally
+                dimensions and the thumbnails, a list of dicts for ThumbnailStorage.add_thumbnails)
+
+        Returns the number of stored images
+        -------
+        """
+        rows = list(rows)
+        image_ids = self.get_image_ids(
+            [row["fullpath"] for row in rows],
+            {row["fullpath"]: row["dimensions"] for row in rows if row.get("dimensions") is not None},
+        )
+        objects = []
+        for row in rows:
+            image_id = image_ids[row["fullpath"]]
+            objects.append(ImageMetadata(
+                image_id=image_id,
+                imageIsGray=row["imageIsGray"],
+                exifs=[Exif(image_id=image_id, exif_name=exif[0], exif_code=exif[1], exif_value=(exif[2])) for
+                       exif in row["exifs"]],
+                iptcs=[Iptc(image_id=image_id, iptc_code=iptc[0], iptc_value=iptc[1]) for iptc in row["iptcs"]],
+            ))
+        thumbnails = [dict(t, image_fullpath=row["fullpath"]) for row in rows for t in row.get("thumbnails") or []]
+
+        def write(session):
+            # The unit of work inserts the objects of each table with one executemany
+            session.add_all(objects)
+            self.thumbnails.add_thumbnails(session, thumbnails)
+        execute_write(self.engine, write)
+        return len(rows)
+
+    def delete_for_image(self, fullpath):
+        """
+        Remove the metadata of an image (e.g. stored partially by an interrupted run)
+        """
+        self.delete_for_images([fullpath, ])
+
+    def delete_for_images(self, fullpaths):
+        """
+        Remove the metadata of several images in one transaction
+        """
+        def write(session):
+            for paths in batch(fullpaths, MAX_IN_VALUES):
+                image_ids = select(Image.id).where(Image.fullpath.in_(paths))
+                session.execute(delete(Exif).where(Exif.image_id.in_(image_ids)))
+                session.execute(delete(Iptc).where(Iptc.image_id.in_(image_ids)))
+                session.execute(delete(ImageMetadata).where(ImageMetadata.image_id.in_(image_ids)))
+                self.thumbnails.delete_thumbnails(session, paths)
+        execute_write(self.engine, write)
 
     def get_by_instance(self, img_instance):
+        # The objects are used after the session is closed: The exifs and iptcs of the ImageMetadata are loaded. Use
+        # get_exif_value(s) for single tags
         with Session(self.engine) as session:
-            meta = session.execute(select(ImageMetadata).where(ImageMetadata.image_id == img_instance.id))
+            meta = session.execute(select(ImageMetadata).where(ImageMetadata.image_id == img_instance.id).options(
+                selectinload(ImageMetadata.exifs), selectinload(ImageMetadata.iptcs)))
             exif = session.execute(select(Exif).where(Exif.image_id == img_instance.id))
             return meta.scalars().all(), exif.scalars().all()
 
+    def get_exif_value(self, fullpath, exif_name):
+        """
+        Return the value of one exif tag of an image or None
+        """
+        with Session(self.engine) as session:
+            return session.execute(
+                select(Exif.exif_value).join(Image, Image.id == Exif.image_id).where(
+                    Image.fullpath == fullpath, Exif.exif_name == exif_name)
+            ).scalars().first()
+
+    def get_exif_values(self, exif_name):
+        """
+        Return a dict fullpath -> value of one exif tag for all images having this tag
+        """
+        with Session(self.engine) as session:
+            return dict(session.execute(
+                select(Image.fullpath, Exif.exif_value).join(Image, Image.id == Exif.image_id).where(
+                    Exif.exif_name == exif_name).order_by(Exif.id)
+            ).tuples().all())
+
 
 class BatchingDataStorage(BaseStorage):
     def __init__(self, file):
@@ -216,27 +375,98 @@ class BatchingDataStorage(BaseStorage):
         return ImageBatch
 
     def store(self, instances, creator=None):
+        execute_write(self.engine, lambda session: session.add(ImageBatch(images=instances, creator=creator)))
+
+    def store_fullpaths(self, fullpaths, creator=None):
+        """
+        Store a batch of images given by their paths. The images have to be in the database already
+        """
+        def write(session):
+            batch_id = session.execute(insert(ImageBatch).values(creator=creator).returning(ImageBatch.id)).scalar_one()
+            for paths in batch(list(fullpaths), MAX_IN_VALUES):
+                session.execute(update(Image).where(Image.fullpath.in_(paths)).values(batch_id=batch_id))
+            return batch_id
+        return execute_write(self.engine, write)
+
+    def add_fullpaths(self, batch_id, fullpaths):
+        """
+        Add images given by their paths to an existing batch
+        """
+        def write(session):
+            for paths in batch(list(fullpaths), MAX_IN_VALUES):
+                session.execute(update(Image).where(Image.fullpath.in_(paths)).values(batch_id=batch_id))
+        execute_write(self.engine, write)
+
+    def get_images_by_exif_value(self, exif_name, unbatched_only=False):
+        """
+        Return the tuples (fullpath, value) of all images having an exif tag ordered by the value. The EXIF date format
+        "YYYY:MM:DD HH:MM:SS" is ordered by the time, i.e. the images are sorted by the index on the tag
+
+        Parameters
+        ----------
+        exif_name       The name of the tag, e.g. DateTime
+        unbatched_only  Only images which are not in a batch yet
+        """
+        statement = select(Image.fullpath, Exif.exif_value).join(Image, Image.id == Exif.image_id).where(
+            Exif.exif_name == exif_name)
+        if unbatched_only:
+            statement = statement.where(Image.batch_id.is_(None))
         with Session(self.engine) as session:
-            bds = ImageBatch(images=instances, creator=creator)
-            session.add(bds)
-            session.commit()
+            return session.execute(statement.order_by(Exif.exif_value, Image.id)).tuples().all()
+
+    def get_last_batch(self, creator, exif_name):
+        """
+        Return the tuple (batch id, latest value of the exif tag) of the batch of a creator with the latest value or
+        None if the creator has no batches
+        """
+        latest = func.max(Exif.exif_value)
+        with Session(self.engine) as session:
+            return session.execute(
+                select(ImageBatch.id, latest).join(Image, Image.batch_id == ImageBatch.id).join(
+                    Exif, Exif.image_id == Image.id).where(
+                    ImageBatch.creator == creator, Exif.exif_name == exif_name).group_by(ImageBatch.id).order_by(
+                    latest.desc(), ImageBatch.id.desc()).limit(1)
+            ).tuples().first()
+
+    def delete_batches(self, creator=None):
+        """
+        Remove all batches of a creator. The images are kept
+        """
+        def write(session):
+            batch_ids = select(ImageBatch.id).where(ImageBatch.creator == creator)
+            session.execute(update(Image).where(Image.batch_id.in_(batch_ids)).values(batch_id=None))
+            session.execute(delete(ImageBatch).where(ImageBatch.creator == creator))
+        execute_write(self.engine, write)
 
     def get_batch_from_image(self, image_instance):
+        # The batch is used after the session is closed: Its images and their segments are loaded
         with Session(self.engine) as session:
-            image = session.execute(select(Image).where(Image.id == image_instance.id)).one_or_none()
-            if image is None:
-                return None
-            image = image[0]
-            return image.batch
+            return session.execute(
+                select(ImageBatch).join(Image, Image.batch_id == ImageBatch.id).where(Image.id == image_instance.id)
+                .options(selectinload(ImageBatch.images).selectinload(Image.segments))).scalars().one_or_none()
 
     def get_batches(self):
+        # The images are accessed after the session is closed
         with Session(self.engine) as session:
-            return session.execute(select(ImageBatch)).all()
+            return session.execute(select(ImageBatch).options(selectinload(ImageBatch.images))).all()
+
+    def get_batch_fullpaths(self):
+        """
+        Return the batches as lists of image paths (ordered as the images were added). No ORM objects are loaded
+        """
+        batches = dict()
+        with Session(self.engine) as session:
+            for batch_id, fullpath in session.execute(
+                    select(Image.batch_id, Image.fullpath).where(Image.batch_id.is_not(None)).order_by(
+                        Image.batch_id, Image.id)):
+                batches.setdefault(batch_id, []).append(fullpath)
+        return list(batches.values())
 
 
 class SegmentDataStorage(BaseStorage):
     def __init__(self, file):
         super().__init__(file)
+        self.lineage = LineageStorage(file)
 
     @staticmethod
     def get_class():
@@ -244,24 +474,58 @@ class SegmentDataStorage(BaseStorage):
 
 
     def store(self, image, segment_fullpath, y_min, y_max, x_min, x_max, output_width, output_height, creator=None):
-        with Session(self.engine) as session:
-            # Make sure we have an instance of the image db representation
-            if not isinstance(image, Image):
-                image = self.get_image(image)[0]
-
-            seg = Segment(
-                base_image=image.id,
-                segment_fullpath=segment_fullpath,
-                creator=creator,
-                y_min=y_min,
-                y_max=y_max,
-                x_min=x_min,
-                x_max=x_max,
-                output_width=output_width,
-                output_height=output_height,
-            )
-            session.add(seg)
-            session.commit()
+        self.store_many([{
+            "image": image,
+            "segment_fullpath": segment_fullpath,
+            "creator": creator,
+            "y_min": y_min,
+            "y_max": y_max,
+            "x_min": x_min,
+            "x_max": x_max,
+            "output_width": output_width,
+            "output_height": output_height,
+        }, ])
+
+    def store_many(self, rows):
+        """
+        Store several segments in one transaction
+
+        Parameters
+        ----------
+        rows    Iterable of dicts with the arguments of store (image, segment_fullpath, y_min, ..., creator)
+
+        Returns the number of stored segments
+        -------
+        """
+        rows = list(rows)
+        if not len(rows):
+            return 0
+        image_ids = self.get_image_ids([row["image"] for row in rows if not isinstance(row["image"], Image)])
+        values = []
+        lineage = []
+        for row in rows:
+            row = dict(row)
+            image = row.pop("image")
+            row["base_image"] = image.id if isinstance(image, Image) else image_ids[image]
+            row.setdefault("creator", None)
+            values.append(row)
+            image_fullpath = image.fullpath if isinstance(image, Image) else image
+            lineage.append({
+                "artifact_fullpath": row["segment_fullpath"],
+                "artifact_class": Segment.__name__,
+                "base_image_fullpath": image_fullpath,
+                "base_image_name": os.path.split(image_fullpath)[1],
+                "x_min": row["x_min"],
+                "x_max": row["x_max"],
+                "y_min": row["y_min"],
+                "y_max": row["y_max"],
+            })
+
+        def write(session):
+            session.execute(insert(Segment), values)
+            self.lineage.add_base_lineage(session, lineage)
+        execute_write(self.engine, write)
+        return len(values)
 
     def get_segments(self, img=None):
         """
@@ -282,6 +546,52 @@ class SegmentDataStorage(BaseStorage):
                 q = session.execute(select(Segment).filter_by(segment_fullpath=img)).scalars().all()
             return q
 
+    def get_segment_boxes(self, segment_fullpaths=None):
+        """
+        Return SegmentBoxes (plain tuples) of the given segments or of all segments if segment_fullpaths is None
+        """
+        columns = select(Segment.segment_fullpath, Image.fullpath, Image.name, Segment.x_min, Segment.x_max,
+                         Segment.y_min, Segment.y_max).join(Image, Image.id == Segment.base_image)
+        with Session(self.engine) as session:
+            if segment_fullpaths is None:
+                return [SegmentBox(*row) for row in session.execute(columns.order_by(Segment.id))]
+            boxes = []
+            for paths in batch(list(segment_fullpaths), MAX_IN_VALUES):
+                boxes.extend(SegmentBox(*row) for row in session.execute(
+                    columns.where(Segment.segment_fullpath.in_(paths)).order_by(Segment.id)))
+            return boxes
+
+    def iter_segments(self):
+        """
+        Iterator version of get_segments(): Yields the paths of all segments page by page
+        """
+        return iter_scalars(self.engine, select(Segment.segment_fullpath), Segment.id)
+
+    def count_segments(self):
+        return count_rows(self.engine, select(Segment.id))
+
+    def get_segments_for_images(self, fullpaths):
+        """
+        Return the paths of the segments of the given base images
+        """
+        with Session(self.engine) as session:
+            return session.execute(
+                select(Segment.segment_fullpath).join(Image, Image.id == Segment.base_image).where(
+                    Image.fullpath.in_(fullpaths)).order_by(Segment.id)
+            ).scalars().all()
+
+    def delete_for_images(self, fullpaths, creator=None):
+        """
+        Remove the segments of the given base images (e.g. stored partially by an interrupted run)
+        """
+        def write(session):
+            for paths in batch(fullpaths, MAX_IN_VALUES):
+                segments = Segment.base_image.in_(select(Image.id).where(Image.fullpath.in_(paths)))
+                self.lineage.delete_artifacts(
+                    session, select(Segment.segment_fullpath).where(segments, Segment.creator == creator))
+                session.execute(delete(Segment).where(segments, Segment.creator == creator))
+        execute_write(self.engine, write)
+
     def get_images(self, img=None):
         logger.warning(f"Deprecation warning: Please use get_segments instead of  get_images for the class {__name__}")
         return self.get_segments(img)
@@ -289,8 +599,8 @@ class SegmentDataStorage(BaseStorage):
     @staticmethod
     def get_fullscale_voting(image: Segment, sqlitefile: str) -> ReturnDetectionDict:
         # Base image of segment is immer the direct image class. So get it by the id:
-        base_image = BaseStorage(sqlitefile).get_image_by_id(image.base_image)
-        if isinstance(base_image, Image):
+        base_image = BaseStorage(sqlitefile).get_image_record_by_id(image.base_image)
+        if base_image is not None:
             votings = BaseStorage.get_fullscale_voting(base_image, sqlitefile)
 
             votings["x_min"] = image.x_min
@@ -300,7 +610,7 @@ class SegmentDataStorage(BaseStorage):
 
             return votings
         else:
-            raise ValueError(f"Unhandled class: {type(image.base_image)}")
+            raise ValueError(f"Base image {image.base_image} of segment {image.segment_fullpath} not found")
 
 
 
@@ -310,6 +620,4 @@ if __name__ == "__main__":
     img_instance2 = ds.get_image("/test/files/testfile2.jpg")[0]
     ds.store(img_instance1, "ABC", 1, 2, 3, 4, 5, 6)
 
-    img_instance1 = ds.get_image("/test/files/testfile1.jpg")[0]
-
-    print(img_instance1.segments)
+    print(ds.get_segment_boxes())
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+"""
+Funnel the database writes of all threads through one writer thread
+
+If the writer is started (c.f. "sqlite_single_writer" in the main config), the storages pass their writes to
+execute_write. The writer thread executes them in the order they were submitted. Writes of other threads queued in the
+meantime are grouped into one transaction (group commit), i.e. the modules of the streaming mode do not compete for
+the write lock of the sqlite file. The worker processes of wolf_utils.parallel do not write: their results are stored
+by the main process.
+"""
+
+import os
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+
+class DatabaseWriter:
+    def __init__(self, max_group_size=64):
+        """
+        Parameters
+        ----------
+        max_group_size  Maximum number of writes committed with one transaction
+        """
+        self.max_group_size = max_group_size
+        self.queue = queue.Queue()
+        self.writes = 0
+        self.transactions = 0
+        self.thread = threading.Thread(target=self._run, name="DatabaseWriter", daemon=True)
+        self.thread.start()
+
+    def submit(self, engine, func):
+        """
+        Queue func(session) for the engine. Returns a Future with the result of func
+        """
+        future = Future()
+        self.queue.put((engine, func, future))
+        return future
+
+    def stop(self):
+        """
+        Execute the queued writes and stop the thread
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        next_write = None
+        while True:
+            write = next_write if next_write is not None else self.queue.get()
+            next_write = None
+            if write is None:
+                return
+
+            # Group the writes queued for the same engine
+            group = [write]
+            while len(group) < self.max_group_size:
+                try:
+                    write = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if write is None or write[0] is not group[0][0]:
+                    next_write = write
+                    break
+                group.append(write)
+
+            self._execute(group)
+
+    def _execute(self, group):
+        engine = group[0][0]
+        try:
+            with Session(engine) as session:
+                results = [func(session) for _, func, _ in group]
+                session.commit()
+        except BaseException as e:
+            if len(group) == 1:
+                group[0][2].set_exception(e)
+                return
+            # Nothing of the group is stored: repeat the writes one by one to report the error to the right caller
+            logger.debug(f"Group of {len(group)} writes failed, repeating them one by one: {e}")
+            for write in group:
+                self._execute([write])
+            return
+
+        self.writes += len(group)
+        self.transactions += 1
+        for (_, _, future), result in zip(group, results):
+            future.set_result(result)
+
+    def get_stats(self):
+        return {
+            "writes": self.writes,
+            "transactions": self.transactions,
+        }
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def start_writer():
+    """
+    Start the writer thread for this process (if not already running)
+    """
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = DatabaseWriter()
+        return _writer
+
+
+def stop_writer():
+    """
+    Stop the writer thread. Further writes are executed directly by the calling thread. Returns the statistics of the
+    writer or None if it was not running
+    """
+    global _writer
+    with _writer_lock:
+        writer, _writer = _writer, None
+    if writer is None:
+        return None
+    writer.stop()
+    logger.info(f"Database writer: {writer.get_stats()}")
+    return writer.get_stats()
+
+
+def execute_write(engine, func):
+    """
+    Execute func(session) in a transaction and return its result
+
+    func must not commit and should return plain values: the session is closed afterwards. Blocks until the write is
+    committed, i.e. the order of the writes of one thread is kept.
+    """
+    writer = _writer
+    if writer is None or threading.current_thread() is writer.thread:
+        with Session(engine) as session:
+            result = func(session)
+            session.commit()
+            return result
+    return writer.submit(engine, func).result()
+
+
+def _after_fork_in_child():
+    # The thread does not exist in the child
+    global _writer, _writer_lock
+    _writer = None
+    _writer_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+if __name__ == "__main__":
+    pass
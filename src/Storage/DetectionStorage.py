@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
-import json
 import logging
 
 from Storage.DataStorage import Image, SegmentDataStorage, BaseStorage
-from wolf_utils.misc import getter_factory
+from Storage.EngineRegistry import get_engine, create_tables
+from Storage.DatabaseWriter import execute_write
+from wolf_utils.misc import getter_factory, batch
 from wolf_utils.types import ReturnDetectionDict
 
 logger = logging.getLogger(__name__)
@@ -11,9 +12,11 @@ logger = logging.getLogger(__name__)
 from sqlalchemy import String, Integer, Float
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.orm import mapped_column
-from sqlalchemy import create_engine
 from sqlalchemy.orm import Session
-from sqlalchemy import select
+from sqlalchemy import select, delete, insert
+from Storage.BulkWriter import MAX_IN_VALUES
+from Storage.Pagination import iter_scalars, count_rows
+from Storage.LineageStorage import LineageStorage, Lineage, get_fullscale_voting
 
 
 ## Table definitions
@@ -24,8 +27,8 @@ class Base(DeclarativeBase):
 class Detection(Base):
     __tablename__ = "detected_image"
     id = mapped_column(Integer, primary_key=True)
-    image_fullpath = mapped_column(String()) # The original image in the fullpath format
-    cut_image = mapped_column(String())
+    image_fullpath = mapped_column(String(), index=True) # The original image in the fullpath format
+    cut_image = mapped_column(String(), index=True)
     source_class = mapped_column(String())
     source_getter = mapped_column(String())
     detection_class = mapped_column(String)
@@ -46,8 +49,9 @@ class Detection(Base):
 class DetectionStorage:
     def __init__(self, file, source_class=None, source_getter=None):
         self.file = file
-        self.engine = create_engine(self.file)
-        Base.metadata.create_all(self.engine)
+        self.engine = get_engine(self.file)
+        create_tables(Base.metadata, self.engine)
+        self.lineage = LineageStorage(file)
         self.source_class = source_class
         self.source_getter = source_getter
 
@@ -78,7 +82,6 @@ class DetectionStorage:
             return votings
         elif isinstance(src_image, SegmentDataStorage.get_class()):
             votings = SegmentDataStorage.get_fullscale_voting(src_image, sqlitefile)
-            print(votings)
             if votings["x_min"] is None:
                 votings["x_min"] = image.x_min
                 votings["x_max"] = image.x_max
@@ -104,23 +107,102 @@ class DetectionStorage:
 
     def store(self, fullpath, cut_image, detection_class, detection_class_numeric, confidence, x_min, y_min, x_max,
               y_max):
+        self.store_many([{
+            "fullpath": fullpath,
+            "cut_image": cut_image,
+            "detection_class": detection_class,
+            "detection_class_numeric": detection_class_numeric,
+            "confidence": confidence,
+            "x_min": x_min,
+            "y_min": y_min,
+            "x_max": x_max,
+            "y_max": y_max,
+        }, ])
+
+    def store_many(self, rows):
+        """
+        Store several detections in one transaction
+
+        Parameters
+        ----------
+        rows    Iterable of dicts with the arguments of store (fullpath, cut_image, detection_class, ...)
+
+        Returns the number of stored detections
+        -------
+        """
+        values = []
+        for row in rows:
+            row = dict(row)
+            row["image_fullpath"] = row.pop("fullpath")
+            row["source_class"] = self.source_class
+            row["source_getter"] = self.source_getter
+            values.append(row)
+        if not len(values):
+            return 0
+
+        def write(session):
+            session.execute(insert(Detection), values)
+            self.lineage.add_derived_lineage(session, [{
+                "artifact_fullpath": value["cut_image"],
+                "artifact_class": Detection.__name__,
+                "parent_fullpath": value["image_fullpath"],
+                "x_min": value["x_min"],
+                "x_max": value["x_max"],
+                "y_min": value["y_min"],
+                "y_max": value["y_max"],
+            } for value in values])
+        execute_write(self.engine, write)
+        return len(values)
+
+    def delete_for_image(self, fullpath):
+        """
+        Remove the detections of an image from the source of this storage (e.g. stored partially by an interrupted
+        run)
+        """
+        self.delete_for_images([fullpath, ])
+
+    def delete_for_images(self, fullpaths):
+        """
+        Remove the detections of several images from the source of this storage in one transaction
+        """
+        def write(session):
+            for paths in batch(fullpaths, MAX_IN_VALUES):
+                detections = (
+                    Detection.image_fullpath.in_(paths),
+                    Detection.source_class == self.source_class,
+                    Detection.source_getter == self.source_getter,
+                )
+                self.lineage.delete_artifacts(session, select(Detection.cut_image).where(*detections))
+                session.execute(delete(Detection).where(*detections))
+        execute_write(self.engine, write)
+
+    def get_fullscale_votings(self):
+        """
+        Return a dict cut_image -> ReturnDetectionDict for all detections with a lineage (one join instead of
+        get_fullscale_voting per detection)
+        """
+        votings = dict()
         with Session(self.engine) as session:
-            detection = Detection(
-                image_fullpath=fullpath,
-                cut_image=cut_image,
-                source_class=self.source_class,
-                source_getter=self.source_getter,
-                detection_class=detection_class,
-                detection_class_numeric=detection_class_numeric,
-                confidence=confidence,
-                x_min=x_min,
-                y_min=y_min,
-                x_max=x_max,
-                y_max=y_max,
-            )
-
-            session.add(detection)
-            session.commit()
+            for lineage, cut_image, class_numeric, confidence in session.execute(
+                    select(Lineage, Detection.cut_image, Detection.detection_class_numeric, Detection.confidence).join(
+                        Lineage, Lineage.artifact_fullpath == Detection.cut_image).where(
+                        Lineage.artifact_class == Detection.__name__).order_by(Lineage.id)):
+                voting = get_fullscale_voting(lineage)
+                # "Detection is used for the weights later on
+                voting["votings"].append(("Detection", {str(class_numeric): confidence}))
+                votings.setdefault(cut_image, voting)
+        return votings
+
+    def get_cut_images_for_image(self, fullpath):
+        """
+        Return the cut images of the detections in an image from the source of this storage
+        """
+        with Session(self.engine) as session:
+            return session.execute(select(Detection.cut_image).where(
+                Detection.image_fullpath == fullpath,
+                Detection.source_class == self.source_class,
+                Detection.source_getter == self.source_getter,
+            ).order_by(Detection.id)).scalars().all()
 
     def get_images(self, img=None):
         with Session(self.engine) as session:
@@ -137,6 +219,24 @@ class DetectionStorage:
         else:
             return self.get_images(img)
 
+    def iter_images(self):
+        """
+        Iterator version of get_images(): Yields all detections page by page
+        """
+        return iter_scalars(self.engine, select(Detection), Detection.id)
+
+    def count_images(self):
+        return count_rows(self.engine, select(Detection.id))
+
+    def iter_cut_images(self):
+        """
+        Iterator version of get_cut_images(): Yields the paths of all cut images page by page
+        """
+        return iter_scalars(self.engine, select(Detection.cut_image), Detection.id)
+
+    def count_cut_images(self):
+        return count_rows(self.engine, select(Detection.id))
+
     def get_all_detections(self):
         with Session(self.engine) as session:
             return session.execute(select(Detection)).all()
@@ -4,6 +4,9 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+from Storage.EngineRegistry import get_engine, create_tables
+from Storage.DatabaseWriter import execute_write
+
 from sqlalchemy import Column
 from sqlalchemy import ForeignKey
 from sqlalchemy import Table
@@ -11,9 +14,13 @@ from sqlalchemy import String, Integer
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.orm import mapped_column
 from sqlalchemy.orm import relationship
-from sqlalchemy import create_engine
 from sqlalchemy.orm import Session
-from sqlalchemy import select
+from sqlalchemy import select, update, or_
+from sqlalchemy.orm import aliased
+from sqlalchemy.dialects.sqlite import insert
+from Storage.Pagination import iter_rows, count_rows
+from Storage.BulkWriter import MAX_IN_VALUES
+from wolf_utils.misc import batch
 
 
 ## Table definitions
@@ -32,9 +39,11 @@ image_to_image = Table(
 class DuplicateImage(Base):
     __tablename__ = "duplicate_image"
     id = mapped_column(Integer, primary_key=True)
-    fullpath = mapped_column(String())
+    fullpath = mapped_column(String(), index=True, unique=True)
     dataclass = mapped_column(String())
     getter = mapped_column(String())
+    # The id of the representative of the group of duplicates (the member with the lowest id, c.f. find_clusters)
+    cluster_id = mapped_column(Integer, ForeignKey("duplicate_image.id"), index=True)
     right_images = relationship(
         "DuplicateImage",
         secondary=image_to_image,
@@ -50,11 +59,35 @@ class DuplicateImage(Base):
 ## End Table definitions
 
 
+def find_clusters(pairs):
+    """
+    Return a dict id -> cluster id for the ids in pairs (union-find). The ids of a cluster are connected by pairs,
+    the cluster id is the lowest id of the cluster
+    """
+    parents = dict()
+
+    def find(node):
+        root = node
+        while parents[root] != root:
+            root = parents[root]
+        while parents[node] != root:
+            parents[node], node = root, parents[node]
+        return root
+
+    for left, right in pairs:
+        parents.setdefault(left, left)
+        parents.setdefault(right, right)
+        left, right = find(left), find(right)
+        if left != right:
+            parents[max(left, right)] = min(left, right)
+    return {node: find(node) for node in parents}
+
+
 class DuplicateImageStorage:
     def __init__(self, file):
         self.file = file
-        self.engine = create_engine(self.file)
-        Base.metadata.create_all(self.engine)
+        self.engine = get_engine(self.file)
+        create_tables(Base.metadata, self.engine)
 
     @staticmethod
     def get_class():
@@ -65,61 +98,94 @@ class DuplicateImageStorage:
             return session.execute(select(DuplicateImage).where(DuplicateImage.fullpath == fullpath)).one_or_none()
 
     def add_duplicate(self, original_image, duplicate):
-        with Session(self.engine) as session:
-            orig_image = session.execute(
-                select(DuplicateImage).where(DuplicateImage.fullpath == original_image[0])).one_or_none()
-            if orig_image is None:
-                session.add(DuplicateImage(
-                    fullpath=original_image[0],
-                    dataclass=original_image[1],
-                    getter=original_image[2],
-                ))
-                session.commit()
-                orig_image = session.execute(
-                    select(DuplicateImage).where(DuplicateImage.fullpath == original_image[0])).one_or_none()
-
-            dup_image = session.execute(
-                select(DuplicateImage).where(DuplicateImage.fullpath == duplicate[0])).one_or_none()
-            if dup_image is None:
-                session.add(DuplicateImage(
-                    fullpath=duplicate[0],
-                    dataclass=duplicate[1],
-                    getter=duplicate[2],
-                ))
-                session.commit()
-                dup_image = session.execute(
-                    select(DuplicateImage).where(DuplicateImage.fullpath == duplicate[0])).one_or_none()
-
-            orig_image = orig_image[0]
-            dup_image = dup_image[0]
-            if dup_image not in orig_image.left_images:
-                orig_image.left_images.append(dup_image)
-            session.add(orig_image)
-            session.commit()
+        self.add_duplicates([(original_image, duplicate), ])
+
+    def add_duplicates(self, pairs):
+        """
+        Store pairs of duplicates in one transaction and update the clusters
+
+        Parameters
+        ----------
+        pairs   Iterable of tuples (original_image, duplicate), each a tuple (fullpath, dataclass, getter)
+
+        Returns the number of stored pairs
+        -------
+        """
+        pairs = list(pairs)
+        if not len(pairs):
+            return 0
+
+        images = dict()
+        for original_image, duplicate in pairs:
+            for fullpath, dataclass, getter in (original_image, duplicate):
+                images.setdefault(fullpath, {"fullpath": fullpath, "dataclass": dataclass, "getter": getter})
+
+        def write(session):
+            # Existing images are ignored by the unique index
+            session.execute(insert(DuplicateImage).on_conflict_do_nothing(), list(images.values()))
+            image_ids = dict()
+            clusters = dict()
+            for paths in batch(list(images), MAX_IN_VALUES):
+                for image_id, fullpath, cluster_id in session.execute(select(
+                        DuplicateImage.id, DuplicateImage.fullpath, DuplicateImage.cluster_id).where(
+                        DuplicateImage.fullpath.in_(paths))):
+                    image_ids[fullpath] = image_id
+                    if cluster_id is not None:
+                        clusters[image_id] = cluster_id
+
+            # The duplicate is one of the left_images of the original
+            edges = [(image_ids[duplicate[0]], image_ids[original_image[0]]) for original_image, duplicate in pairs]
+            session.execute(insert(image_to_image).on_conflict_do_nothing(), [
+                {"left_image_id": left, "right_image_id": right} for left, right in dict.fromkeys(edges)])
+
+            # Existing clusters are joined via their representatives: All their members get the new cluster id
+            members = dict()
+            for image_id, cluster_id in find_clusters(edges + list(clusters.items())).items():
+                members.setdefault(cluster_id, []).append(image_id)
+            for cluster_id, ids in members.items():
+                for ids_batch in batch(ids, MAX_IN_VALUES):
+                    session.execute(update(DuplicateImage).where(or_(
+                        DuplicateImage.id.in_(ids_batch), DuplicateImage.cluster_id.in_(ids_batch))).values(
+                        cluster_id=cluster_id))
+            return len(edges)
+        return execute_write(self.engine, write)
 
     def get_similar(self, fullname):
+        """
+        Return all other images of the cluster of an image or None if the image has no duplicates
+        """
+        cluster_id = select(DuplicateImage.cluster_id).where(DuplicateImage.fullpath == fullname).scalar_subquery()
         with Session(self.engine) as session:
-            img = session.execute(select(DuplicateImage).where(DuplicateImage.fullpath == fullname)).one_or_none()
-            if img is None:
-                return None
-            similar_images = [i for i in img[0].right_images]
-            similar_images.extend([i for i in img[0].left_images])
-            return list(set(similar_images))
+            cluster = session.execute(select(DuplicateImage).where(
+                DuplicateImage.cluster_id == cluster_id).order_by(DuplicateImage.id)).scalars().all()
+        if not len(cluster):
+            return None
+        return [image for image in cluster if image.fullpath != fullname]
 
     def get_main_similar(self, fullname) -> str:
-        img = self.get_image(fullname) # Get image id
-        similar_images = self.get_similar(fullname)
-        if similar_images is None:
-            return fullname
-        if img is not None:
-            similar_images.append(img[0])
-        similar_images.sort(key=lambda db_entry: db_entry.id)
-        return similar_images[0].fullpath
+        """
+        Return the representative of the cluster of an image or the image itself if it has no duplicates
+        """
+        representative = aliased(DuplicateImage)
+        with Session(self.engine) as session:
+            main_similar = session.execute(select(representative.fullpath).join(
+                DuplicateImage, DuplicateImage.cluster_id == representative.id).where(
+                DuplicateImage.fullpath == fullname)).scalar_one_or_none()
+        return fullname if main_similar is None else main_similar
 
     def get_all_images(self):
         with Session(self.engine) as session:
             return session.execute(select(DuplicateImage)).all()
 
+    def iter_all_images(self):
+        """
+        Iterator version of get_all_images(): Yields the rows of all duplicates page by page
+        """
+        return iter_rows(self.engine, select(DuplicateImage), DuplicateImage.id)
+
+    def count_all_images(self):
+        return count_rows(self.engine, select(DuplicateImage.id))
+
 
 if __name__ == "__main__":
     dis = DuplicateImageStorage("sqlite:///test.sqlite")
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+"""
+Process-wide registry of the database engines
+
+All storages of one sqlite file share one engine (and therefore one connection pool). The tables of a storage are
+created only once per file and process. The sqlite connections use the write-ahead log: Readers (e.g. the other
+modules in the streaming mode) do not block the writer and vice versa. The pragmas can be changed by "sqlite_pragmas"
+in the main config.
+"""
+
+import os
+import logging
+import threading
+
+from sqlalchemy import create_engine, event
+
+from wolf_utils.tracing import count_sql_statement
+from wolf_utils.misc import clear_shared_instances
+
+logger = logging.getLogger(__name__)
+
+_engines = dict()
+_created_tables = set()
+_migrated = set()
+
+# Applied to every new sqlite connection
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",
+    # With the write-ahead log, NORMAL is safe against corruption. Only the last transactions may be lost on a power
+    # failure, which the journal of the steps handles
+    "synchronous": "NORMAL",
+    # Wait for locks held by other connections instead of failing with "database is locked"
+    "busy_timeout": 60000,
+    "temp_store": "MEMORY",
+    # In KiB
+    "cache_size": -16384,
+}
+_pragmas = dict(DEFAULT_PRAGMAS)
+
+# Creating the tables from several threads at the same time fails (c.f. streaming mode)
+_lock = threading.RLock()
+
+
+def get_engine(url):
+    """
+    Return the engine for a database url, create it if required
+    """
+    with _lock:
+        if url not in _engines:
+            logger.debug(f"Creating engine for {url}")
+            _engines[url] = create_engine(url)
+            event.listen(_engines[url], "before_cursor_execute", count_sql_statement)
+            if _engines[url].dialect.name == "sqlite":
+                event.listen(_engines[url], "connect", _set_sqlite_pragmas)
+        return _engines[url]
+
+
+def configure_sqlite(pragmas=None):
+    """
+    Set the pragmas for new sqlite connections. The given pragmas update the defaults, None removes a pragma
+    """
+    with _lock:
+        _pragmas.clear()
+        _pragmas.update(DEFAULT_PRAGMAS)
+        _pragmas.update(pragmas or dict())
+        for name in [name for name, value in _pragmas.items() if value is None]:
+            del _pragmas[name]
+    logger.debug(f"sqlite pragmas: {_pragmas}")
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in _pragmas.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+
+def create_tables(metadata, engine):
+    """
+    Create all tables of the metadata if this was not already done for this engine
+
+    Tables of older versions are migrated once per engine (c.f. Storage.Migrations).
+    """
+    with _lock:
+        key = (str(engine.url), id(metadata))
+        if key in _created_tables:
+            return
+        metadata.create_all(engine)
+        _created_tables.add(key)
+        if str(engine.url) not in _migrated:
+            from Storage.Migrations import migrate
+            migrate(engine)
+            _migrated.add(str(engine.url))
+
+
+def dispose_engines():
+    """
+    Close and remove all engines. Closing the last connection of a file merges the write-ahead log into the database
+    file, i.e. the output directory can be copied afterwards
+    """
+    with _lock:
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
+        _created_tables.clear()
+        _migrated.clear()
+    # The shared storages keep their engine: The next run creates new ones with the new engines
+    clear_shared_instances()
+
+
+def _after_fork_in_child():
+    # The pooled connections of the parent must neither be used nor closed in a forked child (c.f.
+    # wolf_utils.parallel). The engines get a new pool and can be used further on.
+    global _lock
+    _lock = threading.RLock()
+    for engine in _engines.values():
+        engine.dispose(close=False)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+if __name__ == "__main__":
+    pass
@@ -3,12 +3,18 @@ import logging
 
 logger = logging.getLogger(__name__)
 
-from sqlalchemy import String, Integer, Float
+from Storage.EngineRegistry import get_engine, create_tables
+from Storage.DatabaseWriter import execute_write
+
+from sqlalchemy import String, Integer, Float, Index, func
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.orm import mapped_column
-from sqlalchemy import create_engine
 from sqlalchemy.orm import Session
-from sqlalchemy import select
+from sqlalchemy import select, delete
+from sqlalchemy.dialects.sqlite import insert
+from Storage.BulkWriter import MAX_IN_VALUES
+from Storage.Pagination import iter_scalars, count_rows
+from wolf_utils.misc import batch
 
 
 ## Table definitions
@@ -19,7 +25,7 @@ class Base(DeclarativeBase):
 class WeightedDecision(Base):
     __tablename__ = "FinalDetectionStorage"
     id                      = mapped_column(Integer, primary_key=True)
-    image_fullpath          = mapped_column(String())
+    image_fullpath          = mapped_column(String(), index=True)
     image_name              = mapped_column(String())
     detection_class_numeric = mapped_column(Integer)
     detection_class_str     = mapped_column(String)
@@ -55,14 +61,20 @@ class WeightedDecision(Base):
         """
         return self.x_min, self.x_max, self.y_min, self.y_max
 
+# Each decision is only stored once (c.f. Storage.Migrations)
+Index("uq_FinalDetectionStorage_row", *[func.ifnull(c, "") for c in (
+    WeightedDecision.image_fullpath, WeightedDecision.image_name, WeightedDecision.detection_class_numeric,
+    WeightedDecision.detection_class_str, WeightedDecision.detection_probability,
+    WeightedDecision.x_min, WeightedDecision.x_max, WeightedDecision.y_min, WeightedDecision.y_max)], unique=True)
+
 ## End Table definitions
 
 
 class WeightedDecisionStorage:
     def __init__(self, file):
         self.file = file
-        self.engine = create_engine(self.file)
-        Base.metadata.create_all(self.engine)
+        self.engine = get_engine(self.file)
+        create_tables(Base.metadata, self.engine)
 
     @staticmethod
     def get_class():
@@ -79,38 +91,62 @@ class WeightedDecisionStorage:
               y_min,
               y_max
               ):
-        with Session(self.engine) as session:
-            if session.query(WeightedDecision).filter_by(
-                    image_fullpath=image_fullpath,
-                    image_name=image_name,
-                    detection_class_numeric=detection_class_numeric,
-                    detection_class_str=detection_class_str,
-                    detection_probability=detection_probability,
-                    x_min=x_min,
-                    x_max=x_max,
-                    y_min=y_min,
-                    y_max=y_max
-            ).count() == 0:
-                weighted_decision = WeightedDecision(
-                    image_fullpath=image_fullpath,
-                    image_name=image_name,
-                    detection_class_numeric=detection_class_numeric,
-                    detection_class_str=detection_class_str,
-                    detection_probability=detection_probability,
-                    x_min=x_min,
-                    x_max=x_max,
-                    y_min=y_min,
-                    y_max=y_max,
-                )
-                session.add(weighted_decision)
-                session.commit()
-            else:
-                logger.info("Dropping already existing decision entry.")
+        self.store_many([{
+            "image_fullpath": image_fullpath,
+            "image_name": image_name,
+            "detection_class_numeric": detection_class_numeric,
+            "detection_class_str": detection_class_str,
+            "detection_probability": detection_probability,
+            "x_min": x_min,
+            "x_max": x_max,
+            "y_min": y_min,
+            "y_max": y_max,
+        }, ])
+
+    def store_many(self, rows):
+        """
+        Store several decisions in one transaction. Like store, decisions already in the database are dropped
+
+        Parameters
+        ----------
+        rows    Iterable of dicts with the arguments of store (image_fullpath, image_name, detection_class_numeric, ...)
+
+        Returns the number of stored decisions
+        -------
+        """
+        rows = list(rows)
+        if not len(rows):
+            return 0
+        # Existing decisions are ignored by the unique index
+        stored = execute_write(self.engine, lambda session: session.connection().execute(
+            insert(WeightedDecision.__table__).on_conflict_do_nothing(), rows).rowcount)
+        if stored < len(rows):
+            logger.info(f"Dropping {len(rows) - stored} already existing decision entries.")
+        return stored
+
+    def delete_for_image(self, image_fullpath):
+        self.delete_for_images([image_fullpath, ])
+
+    def delete_for_images(self, image_fullpaths):
+        def write(session):
+            for paths in batch(image_fullpaths, MAX_IN_VALUES):
+                session.execute(delete(WeightedDecision).where(WeightedDecision.image_fullpath.in_(paths)))
+        execute_write(self.engine, write)
 
     def get_all_images(self):
         with Session(self.engine) as session:
             return session.execute(select(WeightedDecision.image_fullpath).distinct().order_by(WeightedDecision.image_fullpath)).scalars().all()
 
+    def iter_all_images(self):
+        """
+        Iterator version of get_all_images(): Yields the paths of the images with detections page by page
+        """
+        return iter_scalars(self.engine, select(WeightedDecision.image_fullpath).distinct(),
+                            WeightedDecision.image_fullpath)
+
+    def count_all_images(self):
+        return count_rows(self.engine, select(WeightedDecision.image_fullpath).distinct())
+
     def get_detections_for_image(self, image, detection_threshold=0):
         with Session(self.engine) as session:
             return session.execute(select(WeightedDecision).filter(WeightedDecision.image_fullpath==image, WeightedDecision.detection_probability >= detection_threshold)).scalars().all()
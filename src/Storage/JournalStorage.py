@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+import time
+
+from Storage.EngineRegistry import get_engine, create_tables
+from Storage.DatabaseWriter import execute_write
+
+from sqlalchemy import String, Integer, Float, UniqueConstraint
+from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.orm import mapped_column
+from sqlalchemy.orm import Session
+from sqlalchemy import select, delete
+from sqlalchemy.dialects.sqlite import insert
+
+
+## Table definitions
+class Base(DeclarativeBase):
+    pass
+
+
+class JournalEntry(Base):
+    __tablename__ = "step_journal"
+    __table_args__ = (UniqueConstraint("step", "item"),)
+    id = mapped_column(Integer, primary_key=True)
+    step = mapped_column(String(), index=True)
+    item = mapped_column(String())
+    done = mapped_column(Float)
+
+    def __repr__(self):
+        return f"Item {self.item} of step {self.step} done"
+
+## End Table definitions
+
+
+class JournalStorage:
+    """
+    Journal of the items (images, batches, ...) a step has completely stored
+
+    If a step is interrupted, the items in the journal do not have to be processed again when the step is continued.
+    The journal of a step is cleared once the step is finished.
+    """
+    def __init__(self, file):
+        self.file = file
+        self.engine = get_engine(self.file)
+        create_tables(Base.metadata, self.engine)
+
+    @staticmethod
+    def get_class():
+        return JournalEntry
+
+    def mark_done(self, step, item):
+        self.mark_done_many(step, [item, ])
+
+    def mark_done_many(self, step, items):
+        """
+        Add several items of a step to the journal in one transaction
+        """
+        done = time.time()
+        execute_write(self.engine, lambda session: session.execute(
+            insert(JournalEntry).on_conflict_do_nothing(),
+            [{"step": step, "item": item, "done": done} for item in items]
+        ))
+
+    def get_done(self, step):
+        """
+        Return the set of items already done in a step
+        """
+        with Session(self.engine) as session:
+            return set(session.execute(select(JournalEntry.item).where(JournalEntry.step == step)).scalars().all())
+
+    def clear(self, step):
+        execute_write(self.engine, lambda session: session.execute(delete(JournalEntry).where(JournalEntry.step == step)))
+
+
+if __name__ == "__main__":
+    pass
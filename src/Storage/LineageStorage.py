@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+from Storage.EngineRegistry import get_engine, create_tables
+from Storage.BulkWriter import MAX_IN_VALUES
+from wolf_utils.misc import batch
+from wolf_utils.types import ReturnDetectionDict
+
+from sqlalchemy import String, Integer
+from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.orm import mapped_column
+from sqlalchemy.orm import Session
+from sqlalchemy import select, delete, insert, table, column, inspect
+
+
+## Table definitions
+class Base(DeclarativeBase):
+    pass
+
+
+class Lineage(Base):
+    """
+    The base image of a derived artifact (segment, cut image of a detection, SimpleEval copy) and the box of the
+    artifact in the base image. The box is None if the artifact covers the whole base image
+    """
+    __tablename__ = "lineage"
+    id = mapped_column(Integer, primary_key=True)
+    artifact_fullpath = mapped_column(String(), index=True)
+    artifact_class = mapped_column(String())
+    parent_fullpath = mapped_column(String())
+    base_image_fullpath = mapped_column(String())
+    base_image_name = mapped_column(String())
+    x_min = mapped_column(Integer)
+    x_max = mapped_column(Integer)
+    y_min = mapped_column(Integer)
+    y_max = mapped_column(Integer)
+
+    def __repr__(self):
+        return f"Lineage of {self.artifact_fullpath}: {self.base_image_fullpath}"
+
+## End Table definitions
+
+
+# The images of Storage.DataStorage. Not imported: The storages import this module
+_image_table = table("image", column("fullpath"), column("name"))
+
+
+class LineageStorage:
+    """
+    Lineage of the derived artifacts, written by the storages of the artifacts together with the artifacts
+
+    The backmapping gets the full-scale boxes of all artifacts with one join instead of following the chain of
+    getters for each artifact.
+    """
+    def __init__(self, file):
+        self.file = file
+        self.engine = get_engine(self.file)
+        create_tables(Base.metadata, self.engine)
+
+    @staticmethod
+    def get_class():
+        return Lineage
+
+    @staticmethod
+    def add_base_lineage(session, rows):
+        """
+        Add the lineage of artifacts cut directly from a base image (e.g. segments)
+
+        Parameters
+        ----------
+        session     The session of the transaction storing the artifacts
+        rows        Iterable of dicts with artifact_fullpath, artifact_class, base_image_fullpath, base_image_name
+                    and the box in the base image (x_min, x_max, y_min, y_max, None for the whole image)
+        """
+        values = [dict(row, parent_fullpath=row["base_image_fullpath"]) for row in rows]
+        if len(values):
+            session.execute(insert(Lineage), values)
+
+    @staticmethod
+    def add_derived_lineage(session, rows):
+        """
+        Add the lineage of artifacts cut from a parent artifact or a base image (e.g. detections)
+
+        The parents are looked up in the lineage and the images. Artifacts of unknown parents get no lineage, the
+        backmapping uses the getters for them.
+
+        Parameters
+        ----------
+        session     The session of the transaction storing the artifacts
+        rows        Iterable of dicts with artifact_fullpath, artifact_class, parent_fullpath and the box in the
+                    parent (x_min, x_max, y_min, y_max, None for the whole parent)
+
+        Returns the number of artifacts with a lineage
+        -------
+        """
+        rows = list(rows)
+        parents = dict()
+        parent_fullpaths = list(dict.fromkeys(row["parent_fullpath"] for row in rows))
+        has_images = inspect(session.connection()).has_table(_image_table.name)
+        for paths in batch(parent_fullpaths, MAX_IN_VALUES):
+            for fullpath, name in session.execute(
+                    select(_image_table.c.fullpath, _image_table.c.name).where(_image_table.c.fullpath.in_(paths))
+            ) if has_images else []:
+                parents[fullpath] = {"base_image_fullpath": fullpath, "base_image_name": name, "x_min": None,
+                                     "x_max": None, "y_min": None, "y_max": None}
+            for parent in session.execute(select(Lineage).where(Lineage.artifact_fullpath.in_(paths)).order_by(
+                    Lineage.id)).scalars():
+                parents[parent.artifact_fullpath] = {c: getattr(parent, c) for c in (
+                    "base_image_fullpath", "base_image_name", "x_min", "x_max", "y_min", "y_max")}
+
+        values = []
+        for row in rows:
+            parent = parents.get(row["parent_fullpath"])
+            if parent is None:
+                continue
+            value = dict(row, base_image_fullpath=parent["base_image_fullpath"],
+                         base_image_name=parent["base_image_name"])
+            if row.get("x_min") is None:
+                # The whole parent, e.g. a copy
+                value.update(x_min=parent["x_min"], x_max=parent["x_max"], y_min=parent["y_min"],
+                             y_max=parent["y_max"])
+            elif parent["x_min"] is not None:
+                # The box is relative to the box of the parent
+                value.update(x_min=parent["x_min"] + row["x_min"], x_max=parent["x_min"] + row["x_max"],
+                             y_min=parent["y_min"] + row["y_min"], y_max=parent["y_min"] + row["y_max"])
+            values.append(value)
+        if len(values):
+            session.execute(insert(Lineage), values)
+        return len(values)
+
+    @staticmethod
+    def delete_artifacts(session, fullpaths):
+        """
+        Remove the lineage of the given artifacts (a list or a select of their paths)
+        """
+        if isinstance(fullpaths, (list, tuple, set)):
+            for paths in batch(list(fullpaths), MAX_IN_VALUES):
+                session.execute(delete(Lineage).where(Lineage.artifact_fullpath.in_(paths)))
+        else:
+            session.execute(delete(Lineage).where(Lineage.artifact_fullpath.in_(fullpaths)))
+
+    def get_lineage(self, fullpath):
+        with Session(self.engine) as session:
+            return session.execute(
+                select(Lineage).where(Lineage.artifact_fullpath == fullpath).order_by(Lineage.id.desc())
+            ).scalars().first()
+
+    def get_fullscale_votings(self, artifact_class=None):
+        """
+        Return a dict artifact_fullpath -> ReturnDetectionDict without any votes for all artifacts with a lineage (of
+        the given class)
+        """
+        statement = select(Lineage)
+        if artifact_class is not None:
+            statement = statement.where(Lineage.artifact_class == artifact_class)
+        votings = dict()
+        with Session(self.engine) as session:
+            for lineage in session.execute(statement.order_by(Lineage.id)).scalars():
+                votings.setdefault(lineage.artifact_fullpath, get_fullscale_voting(lineage))
+        return votings
+
+
+def get_fullscale_voting(lineage) -> ReturnDetectionDict:
+    """
+    Return the voting dict (c.f. BaseStorage.get_fullscale_voting) of a lineage row without any votes
+    """
+    return {
+        "orig_image_name": str(lineage.base_image_name),
+        "orig_image_fullpath": str(lineage.base_image_fullpath),
+        "x_max": lineage.x_max,
+        "x_min": lineage.x_min,
+        "y_max": lineage.y_max,
+        "y_min": lineage.y_min,
+        "votings": [],
+        "source": None,
+    }
+
+
+if __name__ == "__main__":
+    pass
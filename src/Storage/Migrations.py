@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+"""
+Versioned migrations of the database schema
+
+The storages create their tables on first use with the current schema (c.f. the table definitions). The migrations
+bring tables created by older versions to the same state. A migration skips tables which do not exist yet: They get
+the current schema once a storage creates them. The applied versions are stored in the table schema_migration, new
+migrations are appended to MIGRATIONS with the next version number.
+"""
+
+import json
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+from sqlalchemy import text, inspect
+
+
+def _get_columns(connection, table):
+    inspector = inspect(connection)
+    if not inspector.has_table(table):
+        return None
+    return [c["name"] for c in inspector.get_columns(table)]
+
+
+def _create_index(connection, name, table, columns, unique=False):
+    if _get_columns(connection, table) is None:
+        return
+    connection.execute(text(
+        f'CREATE {"UNIQUE " if unique else ""}INDEX IF NOT EXISTS "{name}" ON "{table}" ({", ".join(columns)})'
+    ))
+
+
+def _deduplicate(connection, table, columns, references=(), owned=()):
+    """
+    Remove rows with the same values in columns (NULL equals NULL), the row with the lowest id is kept
+
+    references are (table, column) tuples referring to the ids of table. They are updated to the kept rows, references
+    which would be duplicates afterwards (e.g. in association tables) are removed.
+
+    owned are (table, column, dependents) tuples of which only one row may refer to a row of table (e.g. the metadata
+    of an image). The row of the kept row is kept (or the one with the lowest id), the others are deleted with the rows
+    of dependents, (table, column) tuples referring to them. The column has to be in references as well to move the
+    row of a removed row if the kept row has none.
+    """
+    if _get_columns(connection, table) is None:
+        return 0
+    connection.execute(text("DROP TABLE IF EXISTS temp._dedup"))
+    connection.execute(text(
+        f'CREATE TEMP TABLE _dedup AS SELECT id AS old_id, keep_id FROM '
+        f'(SELECT id, MIN(id) OVER (PARTITION BY {", ".join(columns)}) AS keep_id FROM "{table}") '
+        f'WHERE id != keep_id'
+    ))
+    removed = connection.execute(text("SELECT COUNT(*) FROM temp._dedup")).scalar_one()
+    for owned_table, owned_column, dependents in owned:
+        if _get_columns(connection, owned_table) is None:
+            continue
+        connection.execute(text("DROP TABLE IF EXISTS temp._dedup_owned"))
+        connection.execute(text(
+            f'CREATE TEMP TABLE _dedup_owned AS SELECT id FROM '
+            f'(SELECT o.id, ROW_NUMBER() OVER (PARTITION BY IFNULL(d.keep_id, o.{owned_column}) '
+            f'ORDER BY d.keep_id IS NOT NULL, o.id) AS n '
+            f'FROM "{owned_table}" o LEFT JOIN temp._dedup d ON d.old_id = o.{owned_column} '
+            f'WHERE o.{owned_column} IS NOT NULL) '
+            f'WHERE n > 1'
+        ))
+        surplus = connection.execute(text("SELECT COUNT(*) FROM temp._dedup_owned")).scalar_one()
+        if surplus:
+            logger.info(f"Removing {surplus} surplus rows from {owned_table}")
+            for dependent_table, dependent_column in dependents:
+                if _get_columns(connection, dependent_table) is None:
+                    continue
+                connection.execute(text(
+                    f'DELETE FROM "{dependent_table}" WHERE {dependent_column} IN (SELECT id FROM temp._dedup_owned)'
+                ))
+            connection.execute(text(f'DELETE FROM "{owned_table}" WHERE id IN (SELECT id FROM temp._dedup_owned)'))
+        connection.execute(text("DROP TABLE temp._dedup_owned"))
+    if removed:
+        logger.info(f"Removing {removed} duplicate rows from {table}")
+        for ref_table, ref_column in references:
+            if _get_columns(connection, ref_table) is None:
+                continue
+            connection.execute(text(
+                f'UPDATE OR IGNORE "{ref_table}" SET {ref_column} = '
+                f'(SELECT keep_id FROM temp._dedup WHERE old_id = "{ref_table}".{ref_column}) '
+                f'WHERE {ref_column} IN (SELECT old_id FROM temp._dedup)'
+            ))
+            connection.execute(text(
+                f'DELETE FROM "{ref_table}" WHERE {ref_column} IN (SELECT old_id FROM temp._dedup)'
+            ))
+        connection.execute(text(f'DELETE FROM "{table}" WHERE id IN (SELECT old_id FROM temp._dedup)'))
+    connection.execute(text("DROP TABLE temp._dedup"))
+    return removed
+
+
+def _check_unique(connection, table, column):
+    """
+    Raise a ValueError if several rows of table have the same value in column (NULLs are ignored)
+    """
+    if _get_columns(connection, table) is None:
+        return
+    duplicates = connection.execute(text(
+        f'SELECT COUNT(*) FROM (SELECT {column} FROM "{table}" WHERE {column} IS NOT NULL '
+        f'GROUP BY {column} HAVING COUNT(*) > 1)'
+    )).scalar_one()
+    if duplicates:
+        raise ValueError(f"{duplicates} values of {table}.{column} are not unique")
+
+
+def rename_legacy_getters(connection):
+    # Formerly manual updates (c.f. README). Older versions of the detected_image table named the column
+    # source_datagetter
+    detection_columns = _get_columns(connection, "detected_image") or []
+    for column in ("source_datagetter", "source_getter"):
+        if column in detection_columns:
+            connection.execute(text(
+                f"UPDATE detected_image SET {column} = 'get_images' WHERE {column} = 'getImages'"))
+    if _get_columns(connection, "simple_label_split") is not None:
+        connection.execute(text(
+            "UPDATE simple_label_split SET source_getter = 'get_cut_images' WHERE source_getter = 'getCutImages'"))
+        connection.execute(text(
+            "UPDATE simple_label_split SET source_getter = 'get_images' WHERE source_getter = 'getImages'"))
+
+
+def add_lookup_indexes(connection):
+    _create_index(connection, "ix_image_segments_segment_fullpath", "image_segments", ["segment_fullpath"])
+    _create_index(connection, "ix_image_segments_base_image", "image_segments", ["base_image"])
+    _create_index(connection, "ix_detected_image_cut_image", "detected_image", ["cut_image"])
+    _create_index(connection, "ix_detected_image_image_fullpath", "detected_image", ["image_fullpath"])
+    _create_index(connection, "ix_simple_label_split_dest_fullpath", "simple_label_split", ["dest_fullpath"])
+    _create_index(connection, "ix_Backmappings_image_fullpath", "Backmappings", ["image_fullpath"])
+    _create_index(connection, "ix_FinalDetectionStorage_image_fullpath", "FinalDetectionStorage", ["image_fullpath"])
+
+
+# The rows of these tables are unique. The columns are compared with IFNULL: sqlite treats NULLs as distinct
+BACKMAPPING_UNIQUE_COLUMNS = [f"IFNULL({c}, '')" for c in (
+    "image_fullpath", "image_name", "source", "votings", "x_min", "x_max", "y_min", "y_max")]
+DECISION_UNIQUE_COLUMNS = [f"IFNULL({c}, '')" for c in (
+    "image_fullpath", "image_name", "detection_class_numeric", "detection_class_str", "detection_probability",
+    "x_min", "x_max", "y_min", "y_max")]
+
+
+def add_unique_constraints(connection):
+    # The metadata of the copies of an image are the same: Only one is kept
+    _deduplicate(connection, "image", ["fullpath"], references=[
+        ("image_segments", "base_image"),
+        ("image_meta", "image_id"),
+        ("image_exif", "image_id"),
+        ("image_iptc", "image_id"),
+    ], owned=[
+        ("image_meta", "image_id", [("image_exif", "image_meta_id"), ("image_iptc", "image_meta_id")]),
+    ])
+    _check_unique(connection, "image_meta", "image_id")
+    _create_index(connection, "ix_image_fullpath", "image", ["fullpath"], unique=True)
+
+    _deduplicate(connection, "duplicate_image", ["fullpath"], references=[
+        ("image_to_image", "left_image_id"),
+        ("image_to_image", "right_image_id"),
+    ])
+    _create_index(connection, "ix_duplicate_image_fullpath", "duplicate_image", ["fullpath"], unique=True)
+
+    _deduplicate(connection, "Backmappings", BACKMAPPING_UNIQUE_COLUMNS)
+    _create_index(connection, "uq_Backmappings_row", "Backmappings", BACKMAPPING_UNIQUE_COLUMNS, unique=True)
+
+    _deduplicate(connection, "FinalDetectionStorage", DECISION_UNIQUE_COLUMNS)
+    _create_index(connection, "uq_FinalDetectionStorage_row", "FinalDetectionStorage", DECISION_UNIQUE_COLUMNS,
+                  unique=True)
+
+
+def normalize_backmapping_votes(connection):
+    # The votes are stored in the table backmapping_vote in addition to the json column votings (c.f.
+    # Storage.BackmappingStorage)
+    if _get_columns(connection, "Backmappings") is None:
+        return
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS backmapping_vote (id INTEGER NOT NULL, backmapping_id INTEGER, entry INTEGER, '
+        'source VARCHAR, class_id VARCHAR, probability FLOAT, PRIMARY KEY (id), '
+        'FOREIGN KEY(backmapping_id) REFERENCES "Backmappings" (id))'
+    ))
+    _create_index(connection, "ix_backmapping_vote_backmapping_id", "backmapping_vote", ["backmapping_id"])
+
+    from Storage.BackmappingStorage import encode_votings
+    votes = []
+    for backmapping_id, votings in connection.execute(text(
+            'SELECT id, votings FROM "Backmappings" WHERE id NOT IN (SELECT backmapping_id FROM backmapping_vote) '
+            'ORDER BY id')):
+        votes.extend(dict(v, backmapping_id=backmapping_id) for v in encode_votings(json.loads(votings or "[]")))
+    if len(votes):
+        logger.info(f"Adding {len(votes)} votes to backmapping_vote")
+        connection.execute(text(
+            "INSERT INTO backmapping_vote (backmapping_id, entry, source, class_id, probability) "
+            "VALUES (:backmapping_id, :entry, :source, :class_id, :probability)"
+        ), votes)
+
+
+def add_batching_indexes(connection):
+    _create_index(connection, "ix_image_exif_name_value", "image_exif", ["exif_name", "exif_value"])
+    _create_index(connection, "ix_image_batch_id", "image", ["batch_id"])
+
+
+def add_duplicate_clusters(connection):
+    # The groups of duplicates are stored as clusters (c.f. Storage.DuplicateStorage)
+    columns = _get_columns(connection, "duplicate_image")
+    if columns is None:
+        return
+    if "cluster_id" not in columns:
+        connection.execute(text(
+            'ALTER TABLE duplicate_image ADD COLUMN cluster_id INTEGER REFERENCES duplicate_image (id)'))
+    _create_index(connection, "ix_duplicate_image_cluster_id", "duplicate_image", ["cluster_id"])
+    if _get_columns(connection, "image_to_image") is None:
+        return
+
+    from Storage.DuplicateStorage import find_clusters
+    clusters = find_clusters(connection.execute(text(
+        "SELECT left_image_id, right_image_id FROM image_to_image")).tuples().all())
+    if len(clusters):
+        logger.info(f"Adding {len(set(clusters.values()))} clusters of {len(clusters)} duplicates")
+        connection.execute(text("UPDATE duplicate_image SET cluster_id = :cluster_id WHERE id = :id"), [
+            {"id": image_id, "cluster_id": cluster_id} for image_id, cluster_id in clusters.items()])
+
+
+# (version, description, function(connection)). Never change a released migration, add a new one instead
+MIGRATIONS = [
+    (1, "Rename the getters changed in August 2023", rename_legacy_getters),
+    (2, "Indexes on the lookup columns", add_lookup_indexes),
+    (3, "Unique rows instead of count-then-insert", add_unique_constraints),
+    (4, "Votes of the backmappings in their own table", normalize_backmapping_votes),
+    (5, "Indexes for the time batching", add_batching_indexes),
+    (6, "Clusters of duplicates", add_duplicate_clusters),
+]
+
+
+def get_schema_version(connection):
+    """
+    Return the latest applied migration or 0
+    """
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_migration "
+        "(version INTEGER PRIMARY KEY, description VARCHAR, applied FLOAT)"
+    ))
+    return connection.execute(text("SELECT COALESCE(MAX(version), 0) FROM schema_migration")).scalar_one()
+
+
+def migrate(engine):
+    """
+    Apply all migrations the database does not have yet. Each migration runs in its own transaction
+
+    Returns the list of the applied versions
+    """
+    applied = []
+    for version, description, func in MIGRATIONS:
+        with engine.begin() as connection:
+            # Checked within the transaction: Another process might have migrated the database meanwhile
+            if get_schema_version(connection) >= version:
+                continue
+            logger.info(f"Migrating {engine.url} to version {version}: {description}")
+            func(connection)
+            connection.execute(
+                text("INSERT OR IGNORE INTO schema_migration (version, description, applied) VALUES (:v, :d, :a)"),
+                {"v": version, "d": description, "a": time.time()},
+            )
+            applied.append(version)
+    return applied
+
+
+if __name__ == "__main__":
+    pass
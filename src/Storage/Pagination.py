@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+"""
+Iterate over large query results page by page
+
+The getters of the storages return lists, i.e. the whole result is in memory before the first row is used. The iter_*
+getters use iter_rows instead: The rows are read in pages ordered by a unique key column (keyset pagination), each
+page with its own short session. No read transaction stays open while the consumer writes to the same database and
+the memory used is bounded by the page size.
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+# Number of rows read at once if nothing else is given
+DEFAULT_PAGE_SIZE = 1000
+
+
+def iter_rows(engine, statement, key_column, page_size=DEFAULT_PAGE_SIZE):
+    """
+    Yield the rows of a select statement ordered by key_column
+
+    Parameters
+    ----------
+    engine      The engine of the database
+    statement   A select without order_by and limit
+    key_column  A column unique within the result, e.g. the primary key
+    page_size   Number of rows per page
+
+    Rows added after the iteration started with a key above the current maximum are not returned, i.e. a consumer
+    can write to the table it iterates.
+    """
+    with Session(engine) as session:
+        upper = session.execute(statement.with_only_columns(func.max(key_column)).order_by(None)).scalar()
+    if upper is None:
+        return
+
+    last = None
+    while True:
+        page = statement.add_columns(key_column).where(key_column <= upper)
+        if last is not None:
+            page = page.where(key_column > last)
+        with Session(engine) as session:
+            rows = session.execute(page.order_by(key_column).limit(page_size)).all()
+        for row in rows:
+            yield row[:-1]
+        if len(rows) < page_size:
+            return
+        last = rows[-1][-1]
+
+
+def iter_scalars(engine, statement, key_column, page_size=DEFAULT_PAGE_SIZE):
+    """
+    As iter_rows but yields the first column of each row (e.g. the ORM objects of select(Class))
+    """
+    for row in iter_rows(engine, statement, key_column, page_size):
+        yield row[0]
+
+
+def count_rows(engine, statement):
+    """
+    Return the number of rows of a select statement
+    """
+    with Session(engine) as session:
+        return session.execute(func.count().select().select_from(statement.subquery())).scalar_one()
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+from Storage.EngineRegistry import get_engine
+
+from sqlalchemy import MetaData, Integer
+from sqlalchemy import select, insert, func
+
+# Tables which are not merged: The journal is only valid for the run it was written by, the schema version is set
+# by the migrations of the target
+SKIP_TABLES = {"step_journal", "schema_migration"}
+
+# Rows identified by these columns are only stored once, e.g. an image found in several shards
+NATURAL_KEYS = {
+    "image": ("fullpath",),
+    "duplicate_image": ("fullpath",),
+}
+
+
+def get_remapped_pk(table):
+    """
+    Return the integer primary key column which gets new ids in the target or None
+
+    Primary keys which are foreign keys at the same time (e.g. association tables) are remapped as foreign keys.
+    """
+    pks = list(table.primary_key.columns)
+    if len(pks) == 1 and isinstance(pks[0].type, Integer) and not len(pks[0].foreign_keys):
+        return pks[0]
+    return None
+
+
+def merge_database(source, target, chunk_size=10000):
+    """
+    Copy all rows of the sqlite database source to target
+
+    The tables are reflected from the source, i.e. all storages are handled the same way. The integer ids of the
+    source are shifted behind the ids already in the target and all foreign keys are remapped accordingly.
+
+    Parameters
+    ----------
+    source      Database url of the source
+    target      Database url of the target. Missing tables are created
+    chunk_size  Number of rows inserted at once
+
+    Returns     Dict with the number of copied rows per table
+    -------
+    """
+    source_engine = get_engine(source)
+    target_engine = get_engine(target)
+
+    metadata = MetaData()
+    metadata.reflect(source_engine)
+    metadata.create_all(target_engine, checkfirst=True)
+
+    id_maps = dict()
+    copied = dict()
+    with source_engine.connect() as source_conn, target_engine.begin() as target_conn:
+        for table in metadata.sorted_tables:
+            if table.name in SKIP_TABLES:
+                continue
+
+            pk = get_remapped_pk(table)
+            offset = 0
+            if pk is not None:
+                offset = target_conn.execute(select(func.coalesce(func.max(pk), 0))).scalar_one()
+            id_map = id_maps.setdefault(table.name, dict())
+
+            existing = dict()
+            natural_key = NATURAL_KEYS.get(table.name)
+            if natural_key is not None and pk is not None:
+                for row in target_conn.execute(select(pk, *[table.c[c] for c in natural_key])):
+                    existing[tuple(row[1:])] = row[0]
+
+            foreign_keys = [(fk.parent.name, fk.column.table.name) for fk in table.foreign_keys]
+
+            rows = []
+            copied[table.name] = 0
+            for row in source_conn.execute(select(table)).mappings():
+                row = dict(row)
+                for column, referred_table in foreign_keys:
+                    if row[column] is not None and referred_table in id_maps:
+                        row[column] = id_maps[referred_table].get(row[column], row[column])
+
+                if pk is not None:
+                    key = tuple(row[c] for c in natural_key) if natural_key is not None else None
+                    if key is not None and key in existing:
+                        id_map[row[pk.name]] = existing[key]
+                        continue
+                    id_map[row[pk.name]] = row[pk.name] + offset
+                    row[pk.name] += offset
+
+                rows.append(row)
+                if len(rows) >= chunk_size:
+                    target_conn.execute(insert(table), rows)
+                    copied[table.name] += len(rows)
+                    rows = []
+            if len(rows):
+                target_conn.execute(insert(table), rows)
+                copied[table.name] += len(rows)
+
+    logger.info(f"Merged {source} into {target}: {copied}")
+    return copied
+
+
+if __name__ == "__main__":
+    pass
@@ -4,6 +4,7 @@ import logging
 import sys
 
 from Storage.DataStorage import SegmentDataStorage
+from Storage.EngineRegistry import get_engine, create_tables
 from Storage.DetectionStorage import DetectionStorage
 from wolf_utils.misc import getter_factory
 from wolf_utils.types import ReturnDetectionDict
@@ -17,9 +18,12 @@ from sqlalchemy import String, Integer, Float
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.orm import mapped_column
 from sqlalchemy.orm import relationship
-from sqlalchemy import create_engine
 from sqlalchemy.orm import Session
 from sqlalchemy import select
+from Storage.Pagination import iter_scalars, count_rows
+from Storage.LineageStorage import LineageStorage, Lineage, get_fullscale_voting
+from Storage.DatabaseWriter import execute_write
+from Storage.DetectionStorage import Detection
 
 
 ## Table definitions
@@ -33,7 +37,7 @@ class SimpleEvalSplit(Base):
     source_class = mapped_column(String())
     source_getter = mapped_column(String())
     source_fullpath = mapped_column(String())
-    dest_fullpath = mapped_column(String())
+    dest_fullpath = mapped_column(String(), index=True)
     relative_votings = mapped_column(String())
 
     def __repr__(self):
@@ -45,8 +49,9 @@ class SimpleEvalSplit(Base):
 class SimpleLabelStorage:
     def __init__(self, file):
         self.file = file
-        self.engine = create_engine(self.file)
-        Base.metadata.create_all(self.engine)
+        self.engine = get_engine(self.file)
+        create_tables(Base.metadata, self.engine)
+        self.lineage = LineageStorage(file)
 
     @staticmethod
     def get_class():
@@ -70,7 +75,7 @@ class SimpleLabelStorage:
         return votings
 
     def store(self, source_class, source_getter, src_file, dest_file):
-        with Session(self.engine) as session:
+        def write(session):
             detection = SimpleEvalSplit(
                 source_class = source_class,
                 source_getter = source_getter,
@@ -79,12 +84,49 @@ class SimpleLabelStorage:
             )
 
             session.add(detection)
-            session.commit()
+            # The copy has the box of its source
+            self.lineage.add_derived_lineage(session, [{
+                "artifact_fullpath": dest_file,
+                "artifact_class": SimpleEvalSplit.__name__,
+                "parent_fullpath": src_file,
+            }])
+        execute_write(self.engine, write)
+
+    def get_fullscale_votings(self):
+        """
+        Return a dict dest_fullpath -> ReturnDetectionDict for all splits with a lineage (one join instead of
+        get_fullscale_voting per split)
+        """
+        votings = dict()
+        with Session(self.engine) as session:
+            for lineage, dest_fullpath, relative_votings, class_numeric, confidence in session.execute(
+                    select(Lineage, SimpleEvalSplit.dest_fullpath, SimpleEvalSplit.relative_votings,
+                           Detection.detection_class_numeric, Detection.confidence).join(
+                        Lineage, Lineage.artifact_fullpath == SimpleEvalSplit.dest_fullpath).outerjoin(
+                        Detection, Detection.cut_image == SimpleEvalSplit.source_fullpath).where(
+                        Lineage.artifact_class == SimpleEvalSplit.__name__).order_by(Lineage.id)):
+                voting = get_fullscale_voting(lineage)
+                if class_numeric is not None:
+                    # The source is a detection
+                    voting["votings"].append(("Detection", {str(class_numeric): confidence}))
+                # "Segment" is used for the weights later on
+                voting["votings"].append(("Segment", json.loads(relative_votings)))
+                votings.setdefault(dest_fullpath, voting)
+        return votings
 
     def get_images(self):
         with Session(self.engine) as session:
             return session.execute(select(SimpleEvalSplit)).scalars().all()
 
+    def iter_images(self):
+        """
+        Iterator version of get_images(): Yields all splits page by page
+        """
+        return iter_scalars(self.engine, select(SimpleEvalSplit), SimpleEvalSplit.id)
+
+    def count_images(self):
+        return count_rows(self.engine, select(SimpleEvalSplit.id))
+
     def set_relative_voting(self, image_name, votings):
         if type(votings) is not str:
             votings = json.dumps(votings)
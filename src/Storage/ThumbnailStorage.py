@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+from Storage.EngineRegistry import get_engine, create_tables
+from Storage.BulkWriter import MAX_IN_VALUES
+from wolf_utils.misc import batch
+from wolf_utils.thumbnails import PACK_FILE, read_thumbnail
+
+from sqlalchemy import String, Integer, Index
+from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.orm import mapped_column
+from sqlalchemy.orm import Session
+from sqlalchemy import select, delete, insert
+
+
+## Table definitions
+class Base(DeclarativeBase):
+    pass
+
+
+class Thumbnail(Base):
+    """
+    The position of a thumbnail of an image in a pack file (c.f. wolf_utils.thumbnails)
+    """
+    __tablename__ = "thumbnail"
+    id = mapped_column(Integer, primary_key=True)
+    image_fullpath = mapped_column(String())
+    level = mapped_column(String())
+    pack_file = mapped_column(String())
+    offset = mapped_column(Integer)
+    width = mapped_column(Integer)
+    height = mapped_column(Integer)
+    channels = mapped_column(Integer)
+
+    def __repr__(self):
+        return f"Thumbnail {self.level} of {self.image_fullpath}"
+
+
+Index("ix_thumbnail_image_level", Thumbnail.image_fullpath, Thumbnail.level)
+
+## End Table definitions
+
+
+class ThumbnailStorage:
+    """
+    Index of the thumbnails of the original images, written together with the metadata by the BasicAnalysisClass
+    """
+    def __init__(self, file):
+        self.file = file
+        self.engine = get_engine(self.file)
+        create_tables(Base.metadata, self.engine)
+
+    @staticmethod
+    def get_class():
+        return Thumbnail
+
+    def get_pack_file(self):
+        """
+        Return the pack file for new thumbnails: next to the database
+        """
+        return os.path.join(os.path.dirname(os.path.abspath(self.engine.url.database)), PACK_FILE)
+
+    @staticmethod
+    def add_thumbnails(session, rows):
+        """
+        Add the index of thumbnails already written to a pack file
+
+        Parameters
+        ----------
+        session     The session of the transaction storing the images
+        rows        Iterable of dicts with image_fullpath, level and the dict returned by ThumbnailPack.append
+        """
+        values = list(rows)
+        if len(values):
+            session.execute(insert(Thumbnail), values)
+
+    @staticmethod
+    def delete_thumbnails(session, fullpaths):
+        """
+        Remove the index of the thumbnails of the given images. The data stays in the pack file
+        """
+        for paths in batch(list(fullpaths), MAX_IN_VALUES):
+            session.execute(delete(Thumbnail).where(Thumbnail.image_fullpath.in_(paths)))
+
+    def get_fullpaths(self):
+        """
+        Return the set of images having thumbnails
+        """
+        with Session(self.engine) as session:
+            return set(session.execute(select(Thumbnail.image_fullpath).distinct()).scalars())
+
+    def get_thumbnail(self, fullpath, level):
+        """
+        Return a thumbnail as a read only uint8 array (BGR) or None if there is no thumbnail of this level
+        """
+        with Session(self.engine) as session:
+            thumbnail = session.execute(select(
+                Thumbnail.pack_file, Thumbnail.offset, Thumbnail.width, Thumbnail.height, Thumbnail.channels).where(
+                Thumbnail.image_fullpath == fullpath, Thumbnail.level == level).order_by(
+                Thumbnail.id.desc()).limit(1)).first()
+        if thumbnail is None:
+            return None
+        return read_thumbnail(*thumbnail)
+
+
+if __name__ == "__main__":
+    pass
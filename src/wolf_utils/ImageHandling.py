@@ -2,15 +2,31 @@ import random
 import cv2
 import numpy as np
 
-def get_avg_image(images, percentage=20, min_images = 5):
+from wolf_utils.memory import estimate_frame_bytes
+from wolf_utils.frame_cache import imread
+from wolf_utils.prefetch import prefetch
+
+def get_avg_image(images, percentage=20, min_images = 5, prefetch_depth=0):
     number = int(len(images)*percentage/100.0)
     number = min(max(number, min_images), len(images))
     subset = random.sample(images, number)
-    img_sub = [cv2.imread(s, 1) for s in subset]
-    img = [i for i in img_sub if i is not None] # Make sure all images can be opened
 
-    img = np.mean(img, axis=0)
-    return img.astype("uint8")
+    # Running sum: Only one decoded image is kept in memory. uint32 is exact for up to 16M images
+    img_sum = None
+    num_images = 0
+    # The next prefetch_depth images are decoded in the background. The memory of an image is reserved before it is
+    # decoded
+    for s, img, _ in prefetch(subset, imread, prefetch_depth, reserve=estimate_frame_bytes):
+        if img is None: # Make sure all images can be opened
+            continue
+        if img_sum is None:
+            img_sum = np.zeros(img.shape, dtype=np.uint32)
+        img_sum += img
+        num_images += 1
+
+    if num_images == 0:
+        raise ValueError("None of the images for the average image can be opened")
+    return (img_sum // num_images).astype("uint8")
 
 def filter_small_boxes(boxes, min_area):
     output_boxes = []
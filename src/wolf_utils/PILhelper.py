@@ -44,3 +44,30 @@ def get_all_iptcs(i):
             else:
                 ret.append((":".join(map(str, k)), v.decode()))
     return ret
+
+
+## Get one exif tag
+#
+# returns the value of the exif tag with the given name or None
+def get_exif_value(i, name):
+    import PIL.ExifTags
+    exif_data_PIL = i._getexif()
+    if exif_data_PIL is None:
+        return None
+
+    for k, v in PIL.ExifTags.TAGS.items():
+        if v == name:
+            return exif_data_PIL.get(k, None)
+    return None
+
+
+## Get the dimensions of an opened image
+#
+# returns (width, height, colors) as cv2.imread would return the image:
+# rotated according to the exif orientation and with three colors
+def get_dimensions(i):
+    from wolf_utils.image_header import is_rotated, COLORS
+    width, height = i.size
+    if is_rotated(i.getexif().get(0x0112)):
+        width, height = height, width
+    return width, height, COLORS
@@ -0,0 +1,51 @@
+"""
+Helpers for the content-addressed result cache (c.f. Storage.CacheStorage)
+"""
+
+import os
+import json
+import hashlib
+import threading
+
+_file_hashes = dict()
+_file_hashes_lock = threading.Lock()
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    """
+    Return the sha256 of the content of a file
+
+    The hash is remembered for the process as long as the size and the modification time of the file do not change.
+    """
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _file_hashes_lock:
+        if memo_key in _file_hashes:
+            return _file_hashes[memo_key]
+
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+
+    with _file_hashes_lock:
+        _file_hashes[memo_key] = h.hexdigest()
+    return h.hexdigest()
+
+
+def make_cache_key(module, config, *parts):
+    """
+    Create a cache key
+
+    Parameters
+    ----------
+    module  The name of the module creating the results
+    config  The part of the config influencing the results (has to be json serializable)
+    parts   Further parts like file hashes
+
+    Returns The key as a string
+    -------
+    """
+    return hashlib.sha256(
+        json.dumps([module, config, parts], sort_keys=True, default=str).encode()
+    ).hexdigest()
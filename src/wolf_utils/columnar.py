@@ -0,0 +1,91 @@
+"""
+Load the tables exported by the ColumnarExportGenerator
+
+Only numpy is required for the .npy format (pandas for the parquet format and load_dataframe), i.e. the results can be
+analysed without the dependencies of the pipeline:
+
+    from wolf_utils.columnar import load_table
+    detections = load_table("out/12_ColumnarExportClass/columnar", "FinalDetectionStorage")
+    detections["detection_probability"].mean()
+"""
+
+import os
+import json
+
+import numpy as np
+
+MANIFEST_FILE = "manifest.json"
+
+# Increased if the layout of the files changes
+FORMAT_VERSION = 1
+
+
+def load_manifest(directory):
+    """
+    Return the manifest of an export
+    """
+    with open(os.path.join(directory, MANIFEST_FILE), "r") as f:
+        manifest = json.load(f)
+    if manifest.get("version", 0) > FORMAT_VERSION:
+        raise ValueError(f"Export in {directory} has the unknown version {manifest.get('version')}")
+    return manifest
+
+
+def get_tables(directory):
+    """
+    Return the names of the exported tables
+    """
+    return list(load_manifest(directory)["tables"])
+
+
+def load_table(directory, table, mmap=True):
+    """
+    Return a dict column -> numpy array for one table of an npy export
+
+    Columns with NULL values are masked arrays. If mmap is True, the arrays are memory mapped (read only), i.e. only
+    the accessed parts are read from the disk.
+    """
+    manifest = load_manifest(directory)
+    if manifest["format"] != "npy":
+        raise ValueError(f"Export in {directory} has the format {manifest['format']}. Use load_dataframe")
+    if table not in manifest["tables"]:
+        raise KeyError(f"Table {table} not in the export. Available: {list(manifest['tables'])}")
+
+    mmap_mode = "r" if mmap else None
+    columns = dict()
+    for name, column in manifest["tables"][table]["columns"].items():
+        data = np.load(os.path.join(directory, column["file"]), mmap_mode=mmap_mode)
+        if column.get("mask") is not None:
+            data = np.ma.MaskedArray(data, mask=np.load(os.path.join(directory, column["mask"]), mmap_mode=mmap_mode))
+        columns[name] = data
+    return columns
+
+
+def load_dataframe(directory, table):
+    """
+    Return one table as a pandas DataFrame (npy and parquet exports)
+    """
+    import pandas as pd
+
+    manifest = load_manifest(directory)
+    if table not in manifest["tables"]:
+        raise KeyError(f"Table {table} not in the export. Available: {list(manifest['tables'])}")
+    if manifest["format"] == "parquet":
+        return pd.read_parquet(os.path.join(directory, manifest["tables"][table]["file"]))
+
+    columns = dict()
+    for name, data in load_table(directory, table, mmap=False).items():
+        if isinstance(data, np.ma.MaskedArray):
+            data = pd.Series(data.data, dtype=_get_nullable_dtype(data.dtype)).mask(data.mask)
+        columns[name] = data
+    return pd.DataFrame(columns)
+
+
+def _get_nullable_dtype(dtype):
+    if dtype.kind == "i":
+        return "Int64"
+    if dtype.kind == "b":
+        return "boolean"
+    if dtype.kind == "U":
+        return "string"
+    return dtype
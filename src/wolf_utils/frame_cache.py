@@ -0,0 +1,246 @@
+"""
+Cache of decoded images shared by the modules
+
+The same original image is decoded by several modules (e.g. the average image and the segmentation, the detection,
+the debug images of the backmapping and the decision). imread returns the decoded frame from a least recently used
+cache limited by "frame_cache_mb" in the main config. The frames are read only: Use writable=True to draw into a copy.
+Without a budget, nothing is cached.
+
+With "frame_cache_shared" in the main config, the decoded frames are additionally written to a directory in the
+shared memory (/dev/shm if available). The worker processes and the main process memory map the frames decoded by
+the others instead of decoding them again.
+
+The hits, misses and evictions are counted per step (c.f. wolf_utils.tracing).
+"""
+
+import os
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+_SHARED_MEMORY_DIR = "/dev/shm"
+
+
+class FrameCache:
+    def __init__(self, budget_bytes=None, shared_dir=None):
+        self.lock = threading.Lock()
+        self.frames = OrderedDict()
+        self.own_files = set()
+        self.bytes = 0
+        self.peak_bytes = 0
+        self.budget_bytes = None
+        self.shared_dir = None
+        self.step_stats = dict()
+        self.configure(budget_bytes, shared_dir)
+
+    def configure(self, budget_bytes, shared_dir=None):
+        """
+        Set the budget in bytes (None disables the cache) and the directory of the shared frames (None: not shared)
+        """
+        with self.lock:
+            self.budget_bytes = budget_bytes if budget_bytes else None
+            self.shared_dir = shared_dir if self.budget_bytes is not None else None
+            self._evict(self.budget_bytes or 0)
+
+    @property
+    def enabled(self):
+        return self.budget_bytes is not None
+
+    @staticmethod
+    def get_key(fullpath, flags):
+        stat = os.stat(fullpath)
+        return os.path.abspath(fullpath), flags, stat.st_mtime_ns, stat.st_size
+
+    def _count(self, counter, value=1):
+        # Counted for the step of the calling thread
+        from wolf_utils.tracing import get_tracer
+        stats = self.step_stats.setdefault(get_tracer().get_current_step(), dict())
+        stats[counter] = stats.get(counter, 0) + value
+
+    def _evict(self, budget_bytes):
+        while len(self.frames) and self.bytes > budget_bytes:
+            key, frame = self.frames.popitem(last=False)
+            self.bytes -= frame.nbytes
+            self._count("evictions")
+            shared_file = self._get_shared_file(key)
+            if shared_file in self.own_files:
+                self.own_files.discard(shared_file)
+                # Other processes keep their memory mapped copy
+                try:
+                    os.remove(shared_file)
+                except OSError:
+                    pass
+
+    def _get_shared_file(self, key):
+        if self.shared_dir is None:
+            return None
+        return os.path.join(self.shared_dir, hashlib.sha1(repr(key).encode()).hexdigest() + ".npy")
+
+    def _load_shared(self, key):
+        shared_file = self._get_shared_file(key)
+        if shared_file is None:
+            return None
+        import numpy as np
+        try:
+            return np.load(shared_file, mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+
+    def _store_shared(self, key, frame):
+        shared_file = self._get_shared_file(key)
+        if shared_file is None:
+            return
+        import numpy as np
+        # Written to a temporary file first: The others only see complete frames
+        tmp_file = f"{shared_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_file, "wb") as f:
+                np.save(f, frame)
+            os.replace(tmp_file, shared_file)
+            with self.lock:
+                self.own_files.add(shared_file)
+        except OSError as e:
+            logger.debug(f"Cannot share frame {key[0]}: {e}")
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    def _add(self, key, frame):
+        """
+        Add a frame to the cache. Returns False if the frame is larger than the budget
+        """
+        with self.lock:
+            if key in self.frames:
+                return True
+            if frame.nbytes > self.budget_bytes:
+                return False
+            self.frames[key] = frame
+            self.bytes += frame.nbytes
+            self.peak_bytes = max(self.peak_bytes, self.bytes)
+            self._evict(self.budget_bytes)
+            return True
+
+    def imread(self, fullpath, flags=None, writable=False):
+        """
+        Return the image as cv2.imread(fullpath, flags) or None if it cannot be read. flags defaults to
+        cv2.IMREAD_COLOR
+
+        The cached frames are read only. If writable is True, a copy is returned which can be modified.
+        """
+        import cv2
+        import numpy as np
+        flags = cv2.IMREAD_COLOR if flags is None else flags
+        if not self.enabled:
+            return cv2.imread(fullpath, flags)
+
+        try:
+            key = self.get_key(fullpath, flags)
+        except OSError:
+            return cv2.imread(fullpath, flags)
+
+        with self.lock:
+            frame = self.frames.get(key)
+            if frame is not None:
+                self.frames.move_to_end(key)
+                self._count("hits")
+        if frame is None:
+            frame = self._load_shared(key)
+            if frame is not None:
+                with self.lock:
+                    self._count("shared_hits")
+                self._add(key, frame)
+        if frame is None:
+            with self.lock:
+                self._count("misses")
+            frame = cv2.imread(fullpath, flags)
+            if frame is None:
+                return None
+            frame.setflags(write=False)
+            if self._add(key, frame):
+                self._store_shared(key, frame)
+        return np.array(frame) if writable else frame
+
+    def pop_step_stats(self, step):
+        """
+        Return and reset the counters of a step
+        """
+        with self.lock:
+            stats = self.step_stats.pop(step, dict())
+            return {
+                "hits": stats.get("hits", 0),
+                "shared_hits": stats.get("shared_hits", 0),
+                "misses": stats.get("misses", 0),
+                "evictions": stats.get("evictions", 0),
+                "bytes": self.bytes,
+                "peak_bytes": self.peak_bytes,
+                "budget_bytes": self.budget_bytes,
+            }
+
+    def pop_all_stats(self):
+        """
+        Return and reset the counters of all steps (e.g. to return them from a worker process)
+        """
+        with self.lock:
+            stats, self.step_stats = self.step_stats, dict()
+            return stats
+
+    def add_stats(self, stats, step=None):
+        """
+        Add the counters returned by pop_all_stats of another process to the given step
+        """
+        with self.lock:
+            for counters in (stats or dict()).values():
+                for counter, value in counters.items():
+                    step_stats = self.step_stats.setdefault(step, dict())
+                    step_stats[counter] = step_stats.get(counter, 0) + value
+
+    def clear(self):
+        with self.lock:
+            self._evict(0)
+
+
+_frame_cache = FrameCache()
+
+
+def get_frame_cache():
+    return _frame_cache
+
+
+def imread(fullpath, flags=None, writable=False):
+    """
+    cv2.imread using the frame cache of this process
+    """
+    return _frame_cache.imread(fullpath, flags, writable)
+
+
+def create_shared_dir():
+    """
+    Return a new directory for the shared frames, in the shared memory if available
+    """
+    parent = _SHARED_MEMORY_DIR if os.path.isdir(_SHARED_MEMORY_DIR) else None
+    return tempfile.mkdtemp(prefix="shadowwolf_frames_", dir=parent)
+
+
+def remove_shared_dir():
+    """
+    Empty the cache and remove the directory of the shared frames
+    """
+    shared_dir = _frame_cache.shared_dir
+    _frame_cache.clear()
+    _frame_cache.configure(_frame_cache.budget_bytes)
+    if shared_dir is not None:
+        shutil.rmtree(shared_dir, ignore_errors=True)
+
+
+def _after_fork_in_child():
+    # The frames of the parent are not counted in the child. The shared frames are still available
+    global _frame_cache
+    _frame_cache = FrameCache(_frame_cache.budget_bytes, _frame_cache.shared_dir)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -0,0 +1,131 @@
+"""
+Read the dimensions of an image from the file header without decoding the image
+
+The dimensions are given as cv2.imread returns the image: The EXIF orientation is applied (i.e. width and height are
+swapped for rotated images) and all images have three color channels.
+"""
+
+import struct
+import logging
+
+logger = logging.getLogger(__name__)
+
+# cv2.imread converts all images to BGR
+COLORS = 3
+
+# JPEG start of frame markers. C4 (huffman table), C8 (reserved) and CC (arithmetic coding) are no frames
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+# Markers without a length field
+_JPEG_STANDALONE_MARKERS = {0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7, 0xD8}
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+_EXIF_ORIENTATION_TAG = 0x0112
+
+
+def is_rotated(orientation):
+    """
+    True if the EXIF orientation swaps width and height (orientations 5 to 8)
+    """
+    return orientation in (5, 6, 7, 8)
+
+
+def _get_exif_orientation(exif):
+    """
+    Return the orientation from the content of an APP1 Exif segment (without the "Exif\\0\\0" header) or None
+    """
+    if len(exif) < 8 or exif[:2] not in (b"II", b"MM"):
+        return None
+    endian = "<" if exif[:2] == b"II" else ">"
+    ifd_offset = struct.unpack(endian + "I", exif[4:8])[0]
+    if ifd_offset + 2 > len(exif):
+        return None
+    num_entries = struct.unpack(endian + "H", exif[ifd_offset:ifd_offset + 2])[0]
+    for n in range(num_entries):
+        entry = ifd_offset + 2 + n * 12
+        if entry + 12 > len(exif):
+            return None
+        tag, value_type = struct.unpack(endian + "HH", exif[entry:entry + 4])
+        if tag == _EXIF_ORIENTATION_TAG and value_type == 3:  # SHORT
+            return struct.unpack(endian + "H", exif[entry + 8:entry + 10])[0]
+    return None
+
+
+def _read_jpeg(f):
+    orientation = None
+    f.read(2)  # SOI
+    while True:
+        byte = f.read(1)
+        if not byte:
+            return None
+        if byte != b"\xff":
+            continue
+        marker = f.read(1)
+        while marker == b"\xff":  # Fill bytes
+            marker = f.read(1)
+        if not marker:
+            return None
+        marker = marker[0]
+        if marker in _JPEG_STANDALONE_MARKERS:
+            continue
+        if marker == 0xD9:  # EOI
+            return None
+
+        length = f.read(2)
+        if len(length) != 2:
+            return None
+        length = struct.unpack(">H", length)[0] - 2
+        if marker in _JPEG_SOF_MARKERS:
+            data = f.read(5)
+            if len(data) != 5:
+                return None
+            _, height, width = struct.unpack(">BHH", data)
+            if is_rotated(orientation):
+                width, height = height, width
+            return width, height
+        if marker == 0xE1 and orientation is None:
+            data = f.read(length)
+            if data[:6] == b"Exif\x00\x00":
+                orientation = _get_exif_orientation(data[6:])
+        else:
+            f.seek(length, 1)
+
+
+def _read_png(f):
+    header = f.read(24)
+    if len(header) != 24 or header[12:16] != b"IHDR":
+        return None
+    return struct.unpack(">II", header[16:24])
+
+
+def _read_other(fullpath):
+    # Other formats: PIL reads only the header as well
+    import PIL.Image
+    with PIL.Image.open(fullpath) as img:
+        width, height = img.size
+        if is_rotated(img.getexif().get(_EXIF_ORIENTATION_TAG)):
+            width, height = height, width
+        return width, height
+
+
+def get_image_dimensions(fullpath):
+    """
+    Return the tuple (width, height, colors) of an image or None if the image cannot be read
+    """
+    try:
+        with open(fullpath, "rb") as f:
+            start = f.read(8)
+            f.seek(0)
+            if start[:2] == b"\xff\xd8":
+                size = _read_jpeg(f)
+            elif start == _PNG_SIGNATURE:
+                size = _read_png(f)
+            else:
+                size = _read_other(fullpath)
+    except Exception as e:
+        logger.debug(f"Cannot read the header of {fullpath}: {e}")
+        return None
+    if size is None or not size[0] or not size[1]:
+        return None
+    return size[0], size[1], COLORS
@@ -0,0 +1,114 @@
+"""
+Lightweight description of modules and storages
+
+The classes given in the config (e.g. "Storage.DataStorage.BasicAnalysisDataStorage") are resolved by parsing the
+source files instead of importing them. This way, a config can be checked without importing heavy dependencies like
+torch or cv2.
+"""
+
+import os
+import ast
+import sys
+import logging
+import threading
+import importlib.util
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+# name: the full name, file: the source file, methods: the names of all methods including inherited ones,
+# imports: the top level names of all modules imported in the file
+ClassManifest = namedtuple("ClassManifest", ["name", "file", "methods", "imports"])
+
+_manifests = dict()
+_lock = threading.RLock()
+
+
+class ManifestError(Exception):
+    """A class cannot be resolved"""
+    pass
+
+
+def _parse_module(module_path):
+    try:
+        spec = importlib.util.find_spec(module_path)
+    except ModuleNotFoundError:
+        spec = None
+    if spec is None or spec.origin is None or not spec.origin.endswith(".py"):
+        raise ManifestError(f"Module {module_path} not found")
+    with open(spec.origin, "r") as f:
+        return spec.origin, ast.parse(f.read(), filename=spec.origin)
+
+
+def _get_imports(tree):
+    """Return the imported names (name -> module path) and the top level names of all imported modules"""
+    names = dict()
+    modules = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                modules.add(alias.name.split(".")[0])
+        elif isinstance(node, ast.ImportFrom) and node.module is not None and node.level == 0:
+            modules.add(node.module.split(".")[0])
+            for alias in node.names:
+                names[alias.asname or alias.name] = f"{node.module}.{alias.name}"
+    return names, modules
+
+
+def get_class_manifest(dataclass):
+    """
+    Return the ClassManifest for a string in the format "module.path.ClassName"
+
+    Raises a ManifestError if the module or the class does not exist.
+    """
+    with _lock:
+        if dataclass in _manifests:
+            return _manifests[dataclass]
+
+        try:
+            module_path, class_name = dataclass.rsplit(".", 1)
+        except ValueError:
+            raise ManifestError(f"Invalid class name {dataclass}")
+        file, tree = _parse_module(module_path)
+        imported_names, imported_modules = _get_imports(tree)
+
+        cls = None
+        for node in tree.body:
+            if isinstance(node, ast.ClassDef) and node.name == class_name:
+                cls = node
+        if cls is None:
+            raise ManifestError(f"Class {class_name} not found in {file}")
+
+        methods = set()
+        for base in cls.bases:
+            if not isinstance(base, ast.Name):
+                continue
+            if base.id in imported_names:
+                base_name = imported_names[base.id]
+            elif any(isinstance(n, ast.ClassDef) and n.name == base.id for n in tree.body):
+                base_name = f"{module_path}.{base.id}"
+            else:
+                continue  # Base from a third party package we cannot parse, e.g. DeclarativeBase
+            try:
+                methods.update(get_class_manifest(base_name).methods)
+            except ManifestError:
+                pass
+        methods.update(n.name for n in cls.body if isinstance(n, (ast.FunctionDef, ast.AsyncFunctionDef)))
+
+        _manifests[dataclass] = ClassManifest(dataclass, file, frozenset(methods), frozenset(imported_modules))
+        return _manifests[dataclass]
+
+
+def get_missing_modules(manifest):
+    """
+    Return the names of the modules imported by a class which are not installed
+    """
+    return sorted(m for m in manifest.imports
+                  if m not in sys.builtin_module_names and importlib.util.find_spec(m) is None)
+
+
+def get_module_directory(dataclass):
+    """
+    Return the directory of the source file of a class
+    """
+    return os.path.dirname(os.path.realpath(get_class_manifest(dataclass).file))
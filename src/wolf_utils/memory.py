@@ -0,0 +1,180 @@
+"""
+Keep the decoded images within a memory budget
+
+The budget is given by "memory_budget_mb" in the main config. Code decoding full images reserves the size of the
+decoded frames before decoding them (c.f. estimate_frame_bytes and wolf_utils.prefetch). If the budget is exhausted, it waits until other threads (e.g. other modules in
+the streaming mode) release their frames. Batch sizes are reduced if the resident memory of the process gets close
+to the budget. Without a budget, nothing is limited.
+"""
+
+import os
+import logging
+import threading
+from contextlib import contextmanager
+
+from wolf_utils.image_header import get_image_dimensions
+
+logger = logging.getLogger(__name__)
+
+_page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def get_rss():
+    """
+    Return the resident memory of this process in bytes (Linux only, None otherwise)
+    """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * _page_size
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def estimate_frame_bytes(image):
+    """
+    Return the size of an image decoded by cv2.imread. Only the header is read. 0 if the size is unknown
+    """
+    dimensions = get_image_dimensions(image)
+    if dimensions is None:
+        return 0
+    width, height, colors = dimensions
+    return width * height * colors
+
+
+class Reservation:
+    """
+    Memory reserved from a MemoryGovernor until release is called. Releasing it again does nothing
+    """
+    def __init__(self, governor, nbytes):
+        self.governor = governor
+        self.nbytes = nbytes
+
+    def release(self):
+        nbytes, self.nbytes = self.nbytes, 0
+        self.governor.release(nbytes)
+
+
+class MemoryGovernor:
+    def __init__(self, budget_bytes=None):
+        self.condition = threading.Condition()
+        self.budget_bytes = None
+        self.reserved = 0
+        self.baseline_rss = 0
+        self.peak_rss = 0
+        self.peak_reserved = 0
+        self.waits = 0
+        self.reduced_batches = 0
+        self.set_budget(budget_bytes)
+
+    def set_budget(self, budget_bytes):
+        """
+        Set the budget for the whole process. None disables the governor
+        """
+        with self.condition:
+            self.budget_bytes = budget_bytes
+            # Memory used by the interpreter, libraries, models, ... is not available for frames
+            self.baseline_rss = get_rss() or 0
+            self.condition.notify_all()
+
+    @property
+    def enabled(self):
+        return self.budget_bytes is not None
+
+    def get_frame_budget(self):
+        return max(self.budget_bytes - self.baseline_rss, 0)
+
+    def update_rss(self):
+        rss = get_rss()
+        if rss is not None:
+            self.peak_rss = max(self.peak_rss, rss)
+        return rss
+
+    def acquire(self, nbytes, blocking=True):
+        """
+        Reserve memory for decoded frames until release is called
+
+        Waits until enough of the budget is free. A reservation is always granted if nothing else is reserved, i.e.
+        a single frame larger than the budget is still processed. Without blocking, False is returned instead of
+        waiting.
+        """
+        if not self.enabled or nbytes <= 0:
+            return True
+
+        with self.condition:
+            if self.reserved > 0 and self.reserved + nbytes > self.get_frame_budget():
+                if not blocking:
+                    return False
+                self.waits += 1
+                while self.reserved > 0 and self.reserved + nbytes > self.get_frame_budget():
+                    self.condition.wait()
+            self.reserved += nbytes
+            self.peak_reserved = max(self.peak_reserved, self.reserved)
+        return True
+
+    def release(self, nbytes):
+        """
+        Release a reservation of acquire
+        """
+        if not self.enabled or nbytes <= 0:
+            return
+        with self.condition:
+            self.reserved = max(self.reserved - nbytes, 0)
+            self.condition.notify_all()
+        self.update_rss()
+
+    @contextmanager
+    def reserve(self, nbytes):
+        """
+        Reserve memory for decoded frames for the duration of the block (c.f. acquire)
+        """
+        self.acquire(nbytes)
+        try:
+            yield
+        finally:
+            self.release(nbytes)
+
+    def get_batch_size(self, requested, frame_bytes):
+        """
+        Return the number of frames of the given size which should be processed at once (at least 1)
+
+        The size is limited by the free frame budget and by the headroom between the resident memory and the budget.
+        """
+        if not self.enabled or frame_bytes <= 0:
+            return requested
+
+        rss = self.update_rss()
+        with self.condition:
+            available = self.get_frame_budget() - self.reserved
+        if rss is not None:
+            available = min(available, self.budget_bytes - rss)
+        size = max(min(requested, int(available // frame_bytes)), 1)
+        if size < requested:
+            self.reduced_batches += 1
+            logger.debug(f"Reduced batch size from {requested} to {size} to stay within the memory budget")
+        return size
+
+    def get_stats(self):
+        return {
+            "budget_bytes": self.budget_bytes,
+            "peak_rss_bytes": self.peak_rss,
+            "peak_reserved_bytes": self.peak_reserved,
+            "waits": self.waits,
+            "reduced_batches": self.reduced_batches,
+        }
+
+
+_governor = MemoryGovernor()
+
+
+def get_memory_governor():
+    return _governor
+
+
+def _after_fork_in_child():
+    # Reservations of other threads of the parent do not exist in the child
+    global _governor
+    _governor = MemoryGovernor(_governor.budget_bytes)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -1,9 +1,9 @@
 import importlib
+import itertools
+import threading
 import unicodedata
 import re
 
-import cv2
-
 import logging
 
 logger = logging.getLogger(__file__)
@@ -28,27 +28,93 @@ def slugify(value, allow_unicode=False):
 
 def batch(iterable, n=4):
     """Return a batch of iterables
-    Returns a batch of iterables with a given size
+    Returns a batch of iterables with a given size. Works also for iterators and generators. n can be a callable
+    returning the size of the next batch.
+    """
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, n() if callable(n) else n))
+        if not len(chunk):
+            return
+        yield chunk
+
+
+_classes = dict()
+_instances = dict()
+_factory_lock = threading.RLock()
+
+
+def resolve_class(dataclass):
+    """Return the class for a string in the format "module.path.ClassName"
+
+    The class is only resolved once per process.
     """
-    l = len(iterable)
-    for ndx in range(0, l, n):
-        yield iterable[ndx:min(ndx + n, l)]
+    with _factory_lock:
+        if dataclass not in _classes:
+            module_path, class_name = dataclass.rsplit('.', 1)
+            module = importlib.import_module(module_path)
+            _classes[dataclass] = getattr(module, class_name)
+        return _classes[dataclass]
+
+
+def instance_factory(dataclass, *args, **kwargs):
+    """Return a new instance of a given dataclass
+
+    The dataclass is given as a string in the format "module.path.ClassName".
+    """
+    return resolve_class(dataclass)(*args, **kwargs)
+
+
+def shared_instance(dataclass, *args, **kwargs):
+    """Return an instance of a given dataclass shared within the process
+
+    One instance is created per dataclass and arguments, e.g. one storage per sqlite file. Therefore, the arguments
+    have to be hashable.
+    """
+    key = (dataclass, args, tuple(sorted(kwargs.items())))
+    with _factory_lock:
+        if key not in _instances:
+            logger.info(f"Creating instance of \"{dataclass}\"")
+            _instances[key] = instance_factory(dataclass, *args, **kwargs)
+        return _instances[key]
+
+
+def clear_shared_instances():
+    """Forget all shared instances, e.g. after their engines were disposed (c.f. Storage.EngineRegistry)
+    """
+    with _factory_lock:
+        _instances.clear()
 
 
 def getter_factory(dataclass, getter, *args, **kwargs):
     """Return a getter from a given dataclass
 
-    Create an instance of a dataclass and return the corresponding getter.
+    The instance of the dataclass is shared, c.f. shared_instance.
     """
-    logging.info(f"Getting \"{getter}\" for \"{dataclass}\"")
-    module_path, class_name = dataclass.rsplit('.', 1)
-    module = importlib.import_module(module_path, class_name)
-    importlib.invalidate_caches()
-    cls = getattr(module, class_name)
-    instance = cls(*args, **kwargs)
+    return getattr(shared_instance(dataclass, *args, **kwargs), getter)
+
+
+def iter_getter_factory(dataclass, getter, *args, **kwargs):
+    """Return the iterator version of a getter if the dataclass has one, otherwise the getter itself
+
+    The iterator versions are named iter_* instead of get_* (e.g. iter_segments for get_segments) and yield the
+    results page by page instead of returning a list.
+    """
+    instance = shared_instance(dataclass, *args, **kwargs)
+    if getter.startswith("get_") and hasattr(instance, "iter_" + getter[len("get_"):]):
+        return getattr(instance, "iter_" + getter[len("get_"):])
     return getattr(instance, getter)
 
 
+def count_factory(dataclass, getter, *args, **kwargs):
+    """Return a function counting the results of a getter (named count_* instead of get_*) or None
+    """
+    instance = shared_instance(dataclass, *args, **kwargs)
+    if getter.startswith("get_") and hasattr(instance, "count_" + getter[len("get_"):]):
+        return getattr(instance, "count_" + getter[len("get_"):])
+    return None
+
+
 def delta_time_format(seconds):
     """Return a meaningful string for the time left
     Returns a meaningful stream if the number of seconds is given (i.e. 3 minutes and 2 seconds)
@@ -89,7 +155,7 @@ def delta_time_format(seconds):
 
 def draw_text(img, text,
           pos=(0, 0),
-          font=cv2.FONT_HERSHEY_PLAIN,
+          font=None,
           font_scale=1,
           font_thickness=1,
           text_color=(0, 0, 0),
@@ -113,6 +179,10 @@ def draw_text(img, text,
     -------
     """
 
+    import cv2
+    if font is None:
+        font = cv2.FONT_HERSHEY_PLAIN
+
     x, y = pos
     text_size, _ = cv2.getTextSize(text, font, font_scale, font_thickness)
     text_w, text_h = text_size
@@ -0,0 +1,146 @@
+"""
+Distribute independent work units over several processes
+"""
+
+import os
+import logging
+import traceback
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from wolf_utils.tracing import get_tracer
+from wolf_utils.memory import get_memory_governor
+from wolf_utils.frame_cache import get_frame_cache
+from wolf_utils.rendering import get_renderer
+
+logger = logging.getLogger(__name__)
+
+# item: the input, result: the return value of the function (None on error), error: formatted traceback or None
+WorkUnitResult = namedtuple("WorkUnitResult", ["item", "result", "error"])
+
+
+def get_num_workers(workers=1):
+    """Return the number of worker processes
+
+    None or 1 means "run in the main process", 0 or negative values use all available cores.
+    """
+    if workers is None:
+        return 1
+    workers = int(workers)
+    if workers <= 0:
+        return os.cpu_count() or 1
+    return workers
+
+
+def _call_work_unit(func, item, args, collect_trace=False):
+    # The trace events and the frame cache counters of a worker process are returned to the main process
+    if collect_trace:
+        get_tracer().pop_events()
+        get_frame_cache().pop_all_stats()
+
+    # Exceptions are converted to strings: Not all exceptions can be pickled
+    try:
+        result, error = func(item, *args), None
+    except Exception:
+        result, error = None, traceback.format_exc()
+    # The images rendered in the background are complete with the result (e.g. for the result cache)
+    get_renderer().flush()
+
+    if collect_trace:
+        return result, error, get_tracer().pop_events(), get_frame_cache().pop_all_stats()
+    return result, error, None, None
+
+
+def _init_worker(budget_bytes, frame_cache_bytes=None, frame_cache_dir=None, render_settings=None):
+    get_memory_governor().set_budget(budget_bytes)
+    get_frame_cache().configure(frame_cache_bytes, frame_cache_dir)
+    get_renderer().configure(**(render_settings or dict()))
+
+
+def _get_result(future):
+    result, error, events, frame_cache_stats = future.result()
+    get_tracer().add_events(*events)
+    get_frame_cache().add_stats(frame_cache_stats, get_tracer().get_current_step())
+    return result, error
+
+
+def map_work_units(func, items, args=(), workers=1, window=4):
+    """Apply func(item, *args) to all items
+
+    Yields a WorkUnitResult per item in the order of the input. An exception in one item does not stop the others,
+    it is returned as the error of this item. If more than one worker is requested, the items are processed in a
+    process pool. In this case, func, the items, the args and the results have to be picklable. At most
+    workers * window items are in flight at the same time to keep the memory bounded. If a worker process dies (e.g.
+    killed by the OOM killer), the pool is started again and the unfinished items are retried one by one. An item
+    which kills a worker again is returned as failed.
+
+    Parameters
+    ----------
+    func        The function handling one item. Has to be defined on module level
+    items       Iterable of items
+    args        Additional arguments for each call of func
+    workers     Number of processes (c.f. get_num_workers)
+    window      Number of items per worker which are submitted in advance
+
+    Returns     Generator of WorkUnitResult
+    -------
+    """
+    workers = get_num_workers(workers)
+
+    if workers == 1:
+        for item in items:
+            result, error, _, _ = _call_work_unit(func, item, args)
+            yield WorkUnitResult(item, result, error)
+        return
+
+    logger.info(f"Starting process pool with {workers} workers")
+    # The memory budget is shared by the workers
+    budget = get_memory_governor().budget_bytes
+    budget = budget // workers if budget is not None else None
+    # As well as the budget of the frame cache. The shared frames are available to all workers
+    frame_cache = get_frame_cache()
+    frame_cache_budget = frame_cache.budget_bytes // workers if frame_cache.enabled else None
+    initargs = (budget, frame_cache_budget, frame_cache.shared_dir, get_renderer().get_settings())
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=initargs)
+    pending = deque()
+
+    def next_result():
+        nonlocal executor
+        item, future = pending.popleft()
+        try:
+            return [WorkUnitResult(item, *_get_result(future))]
+        except BrokenProcessPool:
+            pass
+        # The pool is unusable: All items in flight are lost except the ones already done
+        logger.error(f"A worker process terminated abruptly. Restarting the pool and retrying {len(pending) + 1} "
+                     f"work units one by one")
+        lost = [(item, future)] + list(pending)
+        pending.clear()
+        executor.shutdown(wait=False, cancel_futures=True)
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=initargs)
+        results = []
+        for item, future in lost:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                results.append(WorkUnitResult(item, *_get_result(future)))
+                continue
+            try:
+                results.append(WorkUnitResult(
+                    item, *_get_result(executor.submit(_call_work_unit, func, item, args, True))))
+            except BrokenProcessPool:
+                logger.error(f"Work unit {item} terminated the worker process again")
+                results.append(WorkUnitResult(item, None, "The worker process terminated abruptly (e.g. killed by "
+                                                           "the operating system because of the memory usage)"))
+                executor.shutdown(wait=False, cancel_futures=True)
+                executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=initargs)
+        return results
+
+    try:
+        for item in items:
+            pending.append((item, executor.submit(_call_work_unit, func, item, args, True)))
+            if len(pending) >= workers * window:
+                yield from next_result()
+        while pending:
+            yield from next_result()
+    finally:
+        executor.shutdown()
@@ -0,0 +1,101 @@
+"""
+Load the next items in the background while the current one is processed
+
+The images are often read from slow (e.g. network attached) storage. prefetch decodes the next images in a thread pool
+(cv2 releases the GIL while decoding) while the caller processes the current one. The items are returned in their
+original order, i.e. order dependent processing like the background model of the MOG2 segmentation is not affected.
+"""
+
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from wolf_utils.tracing import get_tracer, trace
+from wolf_utils.memory import get_memory_governor, Reservation
+
+logger = logging.getLogger(__name__)
+
+
+def prefetch(items, load, depth=2, workers=None, reserve=None):
+    """
+    Yield the tuples (item, load(item)) in the order of items
+
+    Parameters
+    ----------
+    items       Iterable of items, consumed at most depth items ahead
+    load        Function loading one item, e.g. wolf_utils.frame_cache.imread
+    depth       Number of items loaded ahead of the current one. Can be a callable returning the depth (e.g. limited by
+                the memory budget). 0 loads each item in the calling thread when it is reached
+    workers     Number of threads, defaults to depth
+    reserve     Function returning the memory needed by an item once loaded (e.g. wolf_utils.memory.
+                estimate_frame_bytes) or None. The memory is reserved from the memory governor before the item is
+                loaded. Items are only loaded ahead if they fit into the budget. The tuples are (item, load(item),
+                reservation): The reservation (c.f. wolf_utils.memory.Reservation) is released when the next item is
+                requested or earlier by the caller
+
+    An exception of load is raised when its item is reached.
+    """
+    governor = get_memory_governor()
+
+    def get_reservation(item):
+        return Reservation(governor, reserve(item) if reserve is not None and governor.enabled else 0)
+
+    def result(item, loaded, reservation):
+        return (item, loaded) if reserve is None else (item, loaded, reservation)
+
+    get_depth = depth if callable(depth) else lambda: depth
+    if not callable(depth) and depth <= 0:
+        for item in items:
+            reservation = get_reservation(item)
+            governor.acquire(reservation.nbytes)
+            try:
+                yield result(item, load(item), reservation)
+            finally:
+                reservation.release()
+        return
+
+    # The spans and counters of the threads belong to the step of the caller
+    step = get_tracer().get_current_step()
+
+    def load_item(item):
+        get_tracer().set_current_step(step)
+        with trace("prefetch"):
+            return load(item)
+
+    items = iter(items)
+    pending = deque()
+    exhausted = False
+    waiting = None # The next item with its reservation if it did not fit into the budget yet
+    current = None # The reservation of the item given to the caller
+    with ThreadPoolExecutor(max_workers=workers or max(get_depth(), 1)) as pool:
+        try:
+            while True:
+                if current is not None:
+                    current.release()
+                # The current item and depth items ahead
+                while not exhausted and len(pending) <= max(get_depth(), 0):
+                    if waiting is None:
+                        try:
+                            item = next(items)
+                        except StopIteration:
+                            exhausted = True
+                            break
+                        waiting = (item, get_reservation(item))
+                    item, reservation = waiting
+                    # Only wait for the budget if nothing is loaded ahead: The memory of the loaded items is released
+                    # only after they are given to the caller
+                    if not governor.acquire(reservation.nbytes, blocking=not len(pending)):
+                        break
+                    waiting = None
+                    pending.append((item, reservation, pool.submit(load_item, item)))
+                if not len(pending):
+                    return
+                item, current, future = pending.popleft()
+                yield result(item, future.result(), current)
+        finally:
+            # The consumer stopped early: Items not started yet are not loaded anymore
+            if current is not None:
+                current.release()
+            for _, reservation, future in pending:
+                future.cancel()
+                reservation.release()
@@ -0,0 +1,343 @@
+"""
+Rendering of the debug and annotated images
+
+The modules do not draw into the images themselves: They record the drawing operations (c.f. Drawing) and pass them
+to the renderer with the source image. The renderer is configured by the main config:
+
+    "render"                "inline" (default): Render immediately in the calling thread
+                            "background": Render in a pool of "render_workers" threads (default 2). The images of
+                            a step are complete at the end of the step (and of each work unit)
+                            "lazy": Only store the operations next to the output (in the directory .render). The
+                            images are rendered by "BaseClass.py -o <output> --render"
+    "render_scale"          Scale the images down, e.g. 0.25. The thumbnails of the images are used if available
+    "render_jpeg_quality"   The JPEG quality of the images (default: The default of OpenCV)
+"""
+
+import os
+import json
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from wolf_utils.misc import draw_text
+from wolf_utils.tracing import get_tracer, trace
+from wolf_utils.frame_cache import imread
+
+logger = logging.getLogger(__name__)
+
+RENDER_MODES = ("inline", "background", "lazy")
+
+# The pending images of the lazy mode, next to the output
+PENDING_DIR = ".render"
+
+
+class Drawing:
+    """
+    The drawing operations for one image. The coordinates are given in the size of the source image
+    """
+    def __init__(self, operations=None):
+        self.operations = list(operations) if operations is not None else []
+
+    def rectangle(self, pt1, pt2, color, thickness=1):
+        self.operations.append(["rectangle", {
+            "pt1": [int(v) for v in pt1],
+            "pt2": [int(v) for v in pt2],
+            "color": [int(v) for v in color],
+            "thickness": int(thickness),
+        }])
+
+    def put_text(self, text, org, font, font_scale, color):
+        self.operations.append(["put_text", {
+            "text": str(text),
+            "org": [int(v) for v in org],
+            "font": int(font),
+            "font_scale": font_scale,
+            "color": [int(v) for v in color],
+        }])
+
+    def draw_text(self, text, pos):
+        """
+        A text with a background, c.f. wolf_utils.misc.draw_text
+        """
+        self.operations.append(["draw_text", {"text": str(text), "pos": [int(v) for v in pos]}])
+
+    def apply(self, img, scale=1.0):
+        """
+        Draw into img, which is scale times the size of the source image. Texts keep their size
+        """
+        import cv2
+
+        def point(p):
+            return tuple(int(round(v * scale)) for v in p) if scale != 1.0 else tuple(p)
+
+        for name, args in self.operations:
+            if name == "rectangle":
+                thickness = max(int(round(args["thickness"] * scale)), 1) if scale != 1.0 else args["thickness"]
+                cv2.rectangle(img, point(args["pt1"]), point(args["pt2"]), tuple(args["color"]), thickness)
+            elif name == "put_text":
+                cv2.putText(img, args["text"], point(args["org"]), args["font"], args["font_scale"],
+                            tuple(args["color"]))
+            elif name == "draw_text":
+                draw_text(img=img, text=args["text"], pos=point(args["pos"]))
+            else:
+                raise ValueError(f"Unknown drawing operation {name}")
+        return img
+
+    def __len__(self):
+        return len(self.operations)
+
+
+def get_pending_files(output):
+    """
+    Return the files of an image not rendered yet (lazy mode): The operations and the stored source if any
+    """
+    directory, name = os.path.split(output)
+    files = [os.path.join(directory, PENDING_DIR, name + ".json"), os.path.join(directory, PENDING_DIR, name + ".png")]
+    return [f for f in files if os.path.isfile(f)]
+
+
+class Renderer:
+    def __init__(self, mode="inline", workers=None, scale=None, jpeg_quality=None, thumbnails=None):
+        self.lock = threading.Lock()
+        self.pool = None
+        self.pending = deque()
+        self.mode = "inline"
+        self.workers = 2
+        self.scale = 1.0
+        self.jpeg_quality = None
+        self.thumbnails = None
+        self.thumbnail_storages = dict()
+        self.configure(mode, workers, scale, jpeg_quality, thumbnails)
+
+    def configure(self, mode="inline", workers=None, scale=None, jpeg_quality=None, thumbnails=None):
+        """
+        Set the render mode and the options (c.f. the module documentation). thumbnails is the database with the
+        thumbnails of the source images (c.f. Storage.ThumbnailStorage) or None
+        """
+        mode = mode or "inline"
+        if mode not in RENDER_MODES:
+            raise ValueError(f"Unknown render mode {mode}. Available: {', '.join(RENDER_MODES)}")
+        self.flush()
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        self.mode = mode
+        self.workers = max(int(workers), 1) if workers else 2
+        self.scale = float(scale) if scale else 1.0
+        self.jpeg_quality = int(jpeg_quality) if jpeg_quality is not None else None
+        self.thumbnails = thumbnails
+
+    def get_settings(self):
+        """
+        Return the arguments of configure, e.g. to configure the renderer of a worker process
+        """
+        return {
+            "mode": self.mode,
+            "workers": self.workers,
+            "scale": self.scale,
+            "jpeg_quality": self.jpeg_quality,
+            "thumbnails": self.thumbnails,
+        }
+
+    def get_cache_config(self):
+        """
+        Return the settings changing the created files or None for the defaults, e.g. for the cache keys
+        """
+        if self.mode != "lazy" and self.scale == 1.0 and self.jpeg_quality is None:
+            return None
+        return {"lazy": self.mode == "lazy", "scale": self.scale, "jpeg_quality": self.jpeg_quality}
+
+    def render(self, output, source, drawing=None, frame=None):
+        """
+        Render an image to the file output
+
+        Parameters
+        ----------
+        output      The file to write
+        source      The path of the source image or None if the source is only given as frame
+        drawing     The Drawing with the operations or None for a copy of the source
+        frame       The decoded source image if already loaded (not modified). Required if source is None
+        """
+        drawing = drawing if drawing is not None else Drawing()
+        if source is None and frame is None:
+            raise ValueError(f"No source for {output}")
+
+        if self.mode == "lazy":
+            self.store_pending(output, source, drawing, frame)
+        elif self.mode == "background":
+            self.submit(output, source, drawing, frame)
+        else:
+            self.render_now(output, source, drawing, frame)
+
+    def submit(self, output, source, drawing, frame):
+        # The caller continues while the image is rendered. The number of pending images (and their frames) is
+        # limited
+        step = get_tracer().get_current_step()
+
+        def render_in_thread():
+            get_tracer().set_current_step(step)
+            try:
+                self.render_now(output, source, drawing, frame)
+            except Exception as e:
+                logger.error(f"Cannot render {output}: {e}")
+
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="render")
+            self.pending.append(self.pool.submit(render_in_thread))
+        while True:
+            with self.lock:
+                if len(self.pending) <= 2 * self.workers:
+                    break
+                future = self.pending.popleft()
+            future.result()
+
+    def flush(self):
+        """
+        Wait until all images submitted in the background mode are written
+        """
+        while True:
+            with self.lock:
+                if not len(self.pending):
+                    return
+                future = self.pending.popleft()
+            future.result()
+
+    def get_thumbnail(self, thumbnails, source, scale):
+        # A thumbnail level "1/N" of the scale
+        if thumbnails is None or scale >= 1.0 or abs(1.0 / scale - round(1.0 / scale)) > 1e-6:
+            return None
+        from Storage.ThumbnailStorage import ThumbnailStorage
+        with self.lock:
+            storage = self.thumbnail_storages.get(thumbnails)
+            if storage is None:
+                storage = self.thumbnail_storages[thumbnails] = ThumbnailStorage(thumbnails)
+        return storage.get_thumbnail(source, f"1/{round(1.0 / scale)}")
+
+    def render_now(self, output, source, drawing, frame, settings=None):
+        """
+        Render an image in the calling thread. Returns False if the source cannot be read
+
+        settings overrides scale, jpeg_quality and thumbnails of the renderer (c.f. get_settings)
+        """
+        import cv2
+        import numpy as np
+
+        settings = dict(self.get_settings(), **(settings or dict()))
+        scale = settings["scale"]
+        jpeg_quality = settings["jpeg_quality"]
+        with trace("render"):
+            img = None
+            if frame is None and scale != 1.0:
+                img = self.get_thumbnail(settings["thumbnails"], source, scale)
+            if img is None:
+                if frame is None:
+                    with trace("decode"):
+                        frame = imread(source)
+                if frame is None:
+                    logger.warning(f"Cannot read {source}. {output} not rendered")
+                    return False
+                if scale != 1.0:
+                    size = (max(int(round(frame.shape[1] * scale)), 1), max(int(round(frame.shape[0] * scale)), 1))
+                    img = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+                else:
+                    img = frame
+            if len(drawing):
+                # The source frames are shared (e.g. with the frame cache)
+                img = drawing.apply(np.array(img), scale)
+
+            params = []
+            if jpeg_quality is not None and os.path.splitext(output)[1].lower() in (".jpg", ".jpeg"):
+                params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality]
+            with trace("imwrite"):
+                cv2.imwrite(output, img, params)
+        return True
+
+    def store_pending(self, output, source, drawing, frame):
+        # Lazy mode: The operations are stored as json. Sources without a file (e.g. masks) are stored losslessly
+        import cv2
+
+        directory, name = os.path.split(output)
+        pending_dir = os.path.join(directory, PENDING_DIR)
+        os.makedirs(pending_dir, exist_ok=True)
+        job = {
+            "source": os.path.abspath(source) if source is not None else None,
+            "operations": drawing.operations,
+            "scale": self.scale,
+            "jpeg_quality": self.jpeg_quality,
+            "thumbnails": self.thumbnails,
+        }
+        if source is None:
+            with trace("imwrite"):
+                cv2.imwrite(os.path.join(pending_dir, name + ".png"), frame, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        with open(os.path.join(pending_dir, name + ".json"), "w") as f:
+            json.dump(job, f)
+        # An image of a previous run is outdated
+        if os.path.isfile(output):
+            os.remove(output)
+
+    def render_pending_file(self, job_file):
+        """
+        Render an image stored by the lazy mode and remove its pending files. Returns False if it cannot be rendered
+        """
+        import cv2
+
+        pending_dir, job_name = os.path.split(job_file)
+        name = job_name[:-len(".json")]
+        output = os.path.join(os.path.dirname(pending_dir), name)
+        with open(job_file, "r") as f:
+            job = json.load(f)
+
+        frame = None
+        source_file = os.path.join(pending_dir, name + ".png")
+        if job["source"] is None:
+            frame = cv2.imread(source_file, cv2.IMREAD_UNCHANGED)
+            if frame is None:
+                logger.warning(f"Cannot read {source_file}. {output} not rendered")
+                return False
+
+        # Rendered with the settings of the run which stored the image
+        settings = {k: job[k] for k in ("scale", "jpeg_quality", "thumbnails")}
+        if not self.render_now(output, job["source"], Drawing(job["operations"]), frame, settings):
+            return False
+        for f in (job_file, source_file):
+            if os.path.isfile(f):
+                os.remove(f)
+        return True
+
+    def render_pending(self, directory):
+        """
+        Render all images stored by the lazy mode below directory. Returns the number of rendered images
+        """
+        job_files = []
+        for root, dirs, files in os.walk(directory):
+            if os.path.basename(root) == PENDING_DIR:
+                job_files.extend(os.path.join(root, f) for f in sorted(files) if f.endswith(".json"))
+
+        logger.info(f"Rendering {len(job_files)} images in {directory}")
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="render") as pool:
+            rendered = sum(pool.map(self.render_pending_file, job_files))
+
+        for root, dirs, files in os.walk(directory, topdown=False):
+            if os.path.basename(root) == PENDING_DIR and not len(os.listdir(root)):
+                os.rmdir(root)
+        return rendered
+
+
+_renderer = Renderer()
+
+
+def get_renderer():
+    return _renderer
+
+
+def _after_fork_in_child():
+    # The threads of the parent do not exist in the child
+    global _renderer
+    settings = _renderer.get_settings()
+    _renderer = Renderer(**settings)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
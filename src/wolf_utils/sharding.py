@@ -0,0 +1,56 @@
+"""
+Split the input images into shards which can be processed by independent runs (c.f. BaseClass --shard and --merge)
+"""
+
+import os
+import hashlib
+
+
+def parse_shard(value):
+    """
+    Parse a shard given as "i/N" (i from 0 to N-1). Returns the tuple (i, N)
+    """
+    try:
+        index, count = (int(v) for v in value.split("/"))
+    except ValueError:
+        raise ValueError(f"Invalid shard {value}. Use the format i/N, e.g. 0/4")
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Invalid shard {value}: i has to be between 0 and N-1")
+    return index, count
+
+
+def get_shard_of_path(path, base_dir, count):
+    """
+    Assign an image to a shard by the hash of its path relative to the image directory
+
+    The relative path is used as the hosts might mount the images at different locations.
+    """
+    relpath = os.path.relpath(path, base_dir)
+    return int(hashlib.sha1(relpath.encode()).hexdigest(), 16) % count
+
+
+def get_shards_of_batches(timestamps, max_timediff_s, count):
+    """
+    Assign complete time batches to the shards (round robin)
+
+    Parameters
+    ----------
+    timestamps      List of the timestamps of the images sorted by time (datetime or None for images without one)
+    max_timediff_s  The max_timediff_s of the TimeBatchingClass
+    count           Number of shards
+
+    Returns         A list with the shard of each image. Images without timestamp are assigned to shard 0
+    -------
+    """
+    shards = []
+    batch_num = -1
+    last = None
+    for dt in timestamps:
+        if dt is None:
+            shards.append(0)
+            continue
+        if last is None or (dt - last).total_seconds() > max_timediff_s:
+            batch_num += 1
+        last = dt
+        shards.append(batch_num % count)
+    return shards
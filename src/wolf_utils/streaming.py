@@ -0,0 +1,114 @@
+"""
+Run several modules concurrently, connected by bounded queues
+"""
+
+import queue
+import logging
+import threading
+import traceback
+
+from wolf_utils.tracing import get_tracer
+
+logger = logging.getLogger(__name__)
+
+_END_OF_STREAM = object()
+
+
+class StreamAborted(Exception):
+    """Another stage of the pipeline failed"""
+    pass
+
+
+class StreamingPipeline:
+    """A chain of modules where each module runs in its own thread
+
+    Each stage has to implement stream(ctx, inputs): a generator consuming the units of the previous stage (None for
+    the first stage) and yielding the units for the next one. The queues between the stages are bounded, i.e., a
+    fast stage has to wait for a slow successor (backpressure).
+    """
+
+    def __init__(self, stages, queue_size=2):
+        self.stages = stages
+        self.queue_size = max(int(queue_size), 1)
+        self.abort = threading.Event()
+        self.errors = []
+
+    def _put(self, q, unit):
+        while True:
+            if self.abort.is_set():
+                raise StreamAborted()
+            try:
+                q.put(unit, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _get(self, q):
+        while True:
+            if self.abort.is_set():
+                raise StreamAborted()
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+    def _iterate(self, q):
+        while True:
+            unit = self._get(q)
+            if unit is _END_OF_STREAM:
+                return
+            yield unit
+
+    def _run_stage(self, stage, stage_ctx, in_q, out_q):
+        try:
+            inputs = self._iterate(in_q) if in_q is not None else None
+            with get_tracer().step(stage.get_step_identifier()) as stats:
+                for unit in stage.stream(stage_ctx, inputs):
+                    if out_q is not None:
+                        self._put(out_q, unit)
+            if len(stage_ctx["steps"]):
+                stage_ctx["steps"][-1]["trace"] = stats
+
+            # Make sure the previous stage is not blocked if we did not consume everything
+            if inputs is not None:
+                for _ in inputs:
+                    pass
+            if out_q is not None:
+                self._put(out_q, _END_OF_STREAM)
+        except StreamAborted:
+            pass
+        except BaseException as e:
+            logger.error(f"Streaming stage {stage.get_step_identifier()} failed:\n{traceback.format_exc()}")
+            self.errors.append(e)
+            self.abort.set()
+
+    def run(self, ctx):
+        """Run all stages
+
+        Each stage works on its own copy of the ctx. Returns a list with the new steps of each stage, in the order of
+        the stages.
+        """
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages[:-1]]
+        stage_ctxs = []
+        threads = []
+        for n, stage in enumerate(self.stages):
+            stage_ctx = dict(ctx)
+            stage_ctx["steps"] = list(ctx["steps"])
+            stage_ctxs.append(stage_ctx)
+            in_q = queues[n - 1] if n > 0 else None
+            out_q = queues[n] if n < len(queues) else None
+            threads.append(threading.Thread(
+                target=self._run_stage,
+                args=(stage, stage_ctx, in_q, out_q),
+                name=f"stream-{stage.get_step_identifier()}",
+            ))
+
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        if len(self.errors):
+            raise self.errors[0]
+
+        return [stage_ctx["steps"][len(ctx["steps"]):] for stage_ctx in stage_ctxs]
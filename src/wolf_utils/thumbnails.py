@@ -0,0 +1,137 @@
+"""
+Thumbnail pyramids of the original images
+
+If enabled ("thumbnails" in its config), the BasicAnalysisClass creates small versions of each image (by default 1/4
+and 1/8 of the size and 256 pixels for the longer side) once. The thumbnails are stored decoded (uint8, BGR as cv2.imread returns them) in one append-only
+pack file per database, the offsets are in the table thumbnail (c.f. Storage.ThumbnailStorage). Reading a thumbnail is
+a view into the memory mapped pack file.
+
+Levels are given as "1/N" (a fraction of the size) or "N" (the size of the longer side in pixels).
+"""
+
+import os
+import mmap
+import logging
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LEVELS = ["1/4", "1/8", "256"]
+
+PACK_FILE = "thumbnails.pack"
+
+
+def get_level_size(level, width, height):
+    """
+    Return the size (width, height) of a level for an image of the given size. Never larger than the image
+    """
+    level = str(level)
+    if level.startswith("1/"):
+        factor = 1.0 / int(level[2:])
+    else:
+        factor = int(level) / max(width, height)
+    factor = min(factor, 1.0)
+    return max(round(width * factor), 1), max(round(height * factor), 1)
+
+
+def make_pyramid(fullpath, levels=None):
+    """
+    Return a list of (level, array) for an image, ordered by the given levels (None: DEFAULT_LEVELS)
+
+    JPEG images are only decoded at the size of the largest level (DCT scaling). The EXIF orientation is applied as
+    by cv2.imread.
+    """
+    import PIL.Image
+    import PIL.ImageOps
+    from wolf_utils.image_header import is_rotated
+
+    levels = DEFAULT_LEVELS if levels is None else levels
+    with PIL.Image.open(fullpath) as img:
+        width, height = img.size
+        rotated = is_rotated(img.getexif().get(0x0112))
+        # The size of the largest level in the stored orientation
+        img.draft("RGB", max(get_level_size(level, width, height) for level in levels))
+        img = PIL.ImageOps.exif_transpose(img).convert("RGB")
+    if rotated:
+        width, height = height, width
+    sizes = [get_level_size(level, width, height) for level in levels]
+
+    # From the largest to the smallest level, each one resized from the previous one
+    pyramid = dict()
+    for n in sorted(range(len(levels)), key=lambda n: sizes[n], reverse=True):
+        if img.size != sizes[n]:
+            img = img.resize(sizes[n], PIL.Image.BOX)
+        # RGB -> BGR
+        pyramid[n] = np.ascontiguousarray(np.asarray(img)[:, :, ::-1])
+    return [(level, pyramid[n]) for n, level in enumerate(levels)]
+
+
+class ThumbnailPack:
+    """
+    Appends thumbnails to a pack file
+    """
+    def __init__(self, pack_file):
+        self.pack_file = pack_file
+        self.lock = threading.Lock()
+        self.file = None
+
+    def append(self, frame):
+        """
+        Append a frame. Returns the dict pack_file, offset, width, height, channels for the index
+        """
+        frame = np.ascontiguousarray(frame, dtype=np.uint8)
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.pack_file, "ab")
+            offset = self.file.seek(0, os.SEEK_END)
+            self.file.write(frame.tobytes())
+            # Readers map the file: The data has to be written before the index is
+            self.file.flush()
+        height, width = frame.shape[:2]
+        return {
+            "pack_file": self.pack_file,
+            "offset": offset,
+            "width": width,
+            "height": height,
+            "channels": frame.shape[2] if frame.ndim == 3 else 1,
+        }
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+_maps = dict()
+_maps_lock = threading.Lock()
+
+
+def _get_map(pack_file, end):
+    # The pack only grows: It is mapped again if a thumbnail is behind the end of the current map. Older maps are
+    # released as soon as no thumbnail refers to them
+    with _maps_lock:
+        pack_map = _maps.get(pack_file)
+        if pack_map is None or len(pack_map) < end:
+            with open(pack_file, "rb") as f:
+                pack_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            _maps[pack_file] = pack_map
+        return pack_map
+
+
+def read_thumbnail(pack_file, offset, width, height, channels):
+    """
+    Return a thumbnail from a pack file (read only) or None if the pack file does not contain it
+    """
+    size = width * height * channels
+    try:
+        pack_map = _get_map(pack_file, offset + size)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Cannot read thumbnail pack {pack_file}: {e}")
+        return None
+    if len(pack_map) < offset + size:
+        return None
+    frame = np.frombuffer(pack_map, dtype=np.uint8, count=size, offset=offset)
+    return frame.reshape((height, width, channels) if channels > 1 else (height, width))
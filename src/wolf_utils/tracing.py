@@ -0,0 +1,199 @@
+"""
+Timing instrumentation for the modules
+
+Collects spans (e.g. decoding, inference, database writes per image), the wall and CPU time per step, the number of
+SQL statements and the bytes read and written. The number and the total duration of the spans are summed up per step.
+The single spans are only kept with "trace": true in the main config. They can be exported in the Chrome trace format
+(open with chrome://tracing or https://ui.perfetto.dev).
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+from wolf_utils.memory import get_rss
+from wolf_utils.frame_cache import get_frame_cache
+
+logger = logging.getLogger(__name__)
+
+
+def get_io_counters():
+    """
+    Return the bytes read and written by this process (Linux only, None otherwise)
+    """
+    try:
+        with open("/proc/self/io", "r") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+        return int(counters["read_bytes"]), int(counters["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+class Tracer:
+    def __init__(self):
+        self.events = []
+        self.enabled = True
+        # Keep the single events for the export. Otherwise, only the summary per step is kept
+        self.keep_events = False
+        self.span_stats = dict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.t0 = time.perf_counter()
+        self.sql_statements = dict()
+
+    def get_current_step(self):
+        return getattr(self.local, "step", None)
+
+    def set_current_step(self, step):
+        """
+        Assign the spans of the calling thread to a step, e.g. in the helper threads of a step
+        """
+        self.local.step = step
+
+    @contextmanager
+    def span(self, name, category="image", **args):
+        """
+        Measure the time of a code block
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_event(name, category, start, time.perf_counter() - start, args)
+
+    def add_event(self, name, category, start, duration, args=None):
+        args = dict(args or {})
+        args.setdefault("step", self.get_current_step())
+        with self.lock:
+            if category != "module":
+                self._add_span_stats(args["step"], name, 1, duration)
+            if not self.keep_events:
+                return
+            self.events.append({
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": (start - self.t0) * 1e6,
+                "dur": duration * 1e6,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": args,
+            })
+
+    def _add_span_stats(self, step, name, count, total_s):
+        s = self.span_stats.setdefault(step, dict()).setdefault(name, [0, 0.0])
+        s[0] += count
+        s[1] += total_s
+
+    def add_events(self, events, span_stats=None):
+        """
+        Add events and span statistics recorded in another process (c.f. wolf_utils.parallel). They are assigned to
+        the current step.
+        """
+        step = self.get_current_step()
+        with self.lock:
+            for spans in (span_stats or dict()).values():
+                for name, (count, total_s) in spans.items():
+                    self._add_span_stats(step, name, count, total_s)
+            if not self.keep_events:
+                return
+            for e in events or []:
+                e["args"]["step"] = step
+                self.events.append(e)
+
+    def pop_events(self):
+        """
+        Return and reset the events and the span statistics (e.g. to return them from a worker process)
+        """
+        with self.lock:
+            events, self.events = self.events, []
+            span_stats, self.span_stats = self.span_stats, dict()
+        return events, span_stats
+
+    def count_sql_statement(self):
+        step = self.get_current_step()
+        with self.lock:
+            self.sql_statements[step] = self.sql_statements.get(step, 0) + 1
+
+    @contextmanager
+    def step(self, identifier):
+        """
+        Measure a complete step. Yields a dict which is filled with the statistics once the step is done.
+
+        The CPU time is the one of the calling thread plus the one of finished child processes. The I/O counters are
+        for the whole process.
+        """
+        stats = dict()
+        self.local.step = identifier
+        start = time.perf_counter()
+        start_cpu = time.thread_time()
+        start_children = os.times()
+        start_read, start_write = get_io_counters()
+        try:
+            yield stats
+        finally:
+            end = time.perf_counter()
+            end_children = os.times()
+            end_read, end_write = get_io_counters()
+            self.add_event(identifier, "module", start, end - start)
+            self.local.step = None
+
+            stats["wall_s"] = end - start
+            stats["cpu_s"] = time.thread_time() - start_cpu
+            stats["children_cpu_s"] = (end_children.children_user + end_children.children_system) - \
+                                      (start_children.children_user + start_children.children_system)
+            if start_read is not None and end_read is not None:
+                stats["read_bytes"] = end_read - start_read
+                stats["write_bytes"] = end_write - start_write
+            with self.lock:
+                stats["sql_statements"] = self.sql_statements.pop(identifier, 0)
+            if get_frame_cache().enabled:
+                stats["frame_cache"] = get_frame_cache().pop_step_stats(identifier)
+            stats["rss_bytes"] = get_rss()
+            stats["spans"] = self.get_span_summary(identifier)
+
+    def get_span_summary(self, identifier):
+        """
+        Number and total duration of the spans per name for one step. The statistics of the step are reset
+        """
+        with self.lock:
+            span_stats = self.span_stats.pop(identifier, dict())
+        return {name: {"count": count, "total_s": total_s, "mean_ms": total_s / count * 1000.0}
+                for name, (count, total_s) in span_stats.items()}
+
+    def export(self, filename):
+        """
+        Write all events to a file in the Chrome trace format
+        """
+        with self.lock:
+            events = list(self.events)
+        with open(filename, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        logger.info(f"Stored trace with {len(events)} events to {filename}")
+
+
+_tracer = Tracer()
+
+
+def get_tracer():
+    return _tracer
+
+
+def trace(name, **args):
+    """
+    Shortcut for a span of the global tracer, e.g. with trace("decode"): ...
+    """
+    return _tracer.span(name, **args)
+
+
+def count_sql_statement(conn, cursor, statement, parameters, context, executemany):
+    """
+    Listener for the before_cursor_execute event of the engines (c.f. Storage.EngineRegistry)
+    """
+    _tracer.count_sql_statement()
@@ -4,6 +4,7 @@ Some classes for typing
 
 from typing import TypedDict
 from typing import Optional
+from typing import NamedTuple
 
 class ReturnDetectionDict(TypedDict):
     orig_image_name : str
@@ -14,3 +15,32 @@ class ReturnDetectionDict(TypedDict):
     y_min: Optional[int]
     votings: list
     source: Optional[str]
+
+
+class ImageRecord(NamedTuple):
+    """The columns of an image without the ORM object and its relationships"""
+    id: int
+    name: str
+    fullpath: str
+    width: Optional[int]
+    height: Optional[int]
+
+
+class SegmentBox(NamedTuple):
+    """A segment with the box in its base image"""
+    segment_fullpath: str
+    image_fullpath: str
+    image_name: str
+    x_min: int
+    x_max: int
+    y_min: int
+    y_max: int
+
+
+class VoteArrays(NamedTuple):
+    """The votes of several backmappings, one array element per vote (c.f. BackmappingStorage.get_votes_for_images)"""
+    backmapping_id: "numpy.ndarray"
+    entry: "numpy.ndarray"
+    source: "numpy.ndarray"
+    class_id: "numpy.ndarray"
+    probability: "numpy.ndarray"
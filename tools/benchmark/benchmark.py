@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+"""
+End-to-end benchmark of ShadowWolf using synthetic images and a stub detector
+
+For each combination of dataset (resolution and images per sequence) and pipeline (one of the config-*.json in src),
+ShadowWolf is run in a separate process. The throughput (images/s), the peak RSS of the process and the per-module
+trace (wall and CPU time, SQL statements, spans; c.f. wolf_utils.tracing) are written to a json file. Runs offline:
+the YOLO model is replaced by stub_detector.
+
+Example:
+    ./benchmark.py -w /tmp/sw-bench -o before.json
+    ... change something ...
+    ./benchmark.py -w /tmp/sw-bench -o after.json --compare before.json
+"""
+
+import os
+import sys
+import json
+import glob
+import time
+import pickle
+import shutil
+import argparse
+import datetime
+import platform
+import statistics
+import subprocess
+
+from synthetic import get_dataset
+
+BENCHMARK_DIR = os.path.dirname(os.path.realpath(__file__))
+SRC_DIR = os.path.realpath(os.path.join(BENCHMARK_DIR, "..", "..", "src"))
+
+PIPELINES = {
+    "yolo-only": "config-yolo-only.json",
+    "yolo-segments": "config-yolo-segments.json",
+    "yolo-segments-dedup": "config-yolo-segments-dedup.json",
+}
+
+STUB_LOADER = "stub_detector.load_stub_model"
+
+
+def parse_resolution(value):
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+
+def parse_value(value):
+    """Values of --set are parsed as json if possible, e.g. 2 -> int, true -> bool"""
+    try:
+        return json.loads(value)
+    except json.JSONDecodeError:
+        return value
+
+
+def parse_value_pair(value):
+    key, value = value.split("=", 1)
+    return key, parse_value(value)
+
+
+def create_config(pipeline, image_dir, filename, main_config=None):
+    """
+    Create the config for one run based on the config file of the pipeline
+    """
+    with open(os.path.join(SRC_DIR, PIPELINES[pipeline]), "r") as f:
+        config = json.load(f)
+
+    config["main_config"]["image_dir"] = image_dir
+    config["main_config"]["image_filetype"] = "jpg"
+    config["main_config"]["trace"] = True
+    config["main_config"].update(main_config or {})
+
+    for m in config["modules"]:
+        if m["name"].endswith("YoloDetectionClass"):
+            m["detect_loader"] = STUB_LOADER
+
+    with open(filename, "w") as f:
+        json.dump(config, f, indent=2)
+
+
+def get_git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=SRC_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_module_stats(output_dir):
+    """
+    Return the trace of all steps from the last ctx stored by ShadowWolf
+    """
+    ctx_files = glob.glob(os.path.join(output_dir, "*_end_ctx.pickle"))
+    if not len(ctx_files):
+        return {}
+    last = max(ctx_files, key=lambda f: int(os.path.basename(f).split("_", 1)[0]))
+    with open(last, "rb") as f:
+        ctx = pickle.load(f)
+    return {step["identifier"]: step.get("trace") for step in ctx["steps"]}
+
+
+def run_shadowwolf(config_file, run_dir):
+    """
+    Run ShadowWolf in a new process
+
+    Returns the return code, the wall time in seconds, the peak RSS in MB and the output directory. The peak RSS is
+    the one of the main process, worker processes (c.f. "workers") are not included.
+    """
+    output_dir = os.path.join(run_dir, "output")
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [BENCHMARK_DIR, env.get("PYTHONPATH")]))
+
+    with open(os.path.join(run_dir, "stdout.log"), "w") as log:
+        start = time.perf_counter()
+        p = subprocess.Popen(
+            [sys.executable, os.path.join(SRC_DIR, "BaseClass.py"), "-c", config_file, "-o", output_dir],
+            cwd=run_dir, env=env, stdout=log, stderr=subprocess.STDOUT,
+        )
+        _, status, rusage = os.wait4(p.pid, 0)
+        wall = time.perf_counter() - start
+        p.returncode = os.waitstatus_to_exitcode(status)
+
+    # ru_maxrss is in kB on Linux
+    return p.returncode, wall, rusage.ru_maxrss / 1024.0, output_dir
+
+
+def run_benchmark(args):
+    main_config = dict(parse_value_pair(s) for s in args.set)
+    results = {
+        "created": datetime.datetime.now().isoformat(),
+        "git_revision": get_git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "main_config": main_config,
+        "runs": [],
+    }
+
+    for resolution in args.resolutions:
+        for images_per_sequence in args.images_per_sequence:
+            width, height = resolution
+            dataset = dict(width=width, height=height, sequences=args.sequences,
+                           images_per_sequence=images_per_sequence, seed=args.seed)
+            image_dir = get_dataset(os.path.join(args.work_dir, "datasets"), **dataset)
+            num_images = args.sequences * images_per_sequence
+
+            for pipeline in args.pipelines:
+                name = f"{pipeline}_{width}x{height}_{images_per_sequence}"
+                walls = []
+                run = {"name": name, "pipeline": pipeline, "dataset": dataset, "images": num_images}
+                for repetition in range(args.repeat):
+                    run_dir = os.path.join(args.work_dir, "runs", f"{name}_{repetition}")
+                    shutil.rmtree(run_dir, ignore_errors=True)
+                    os.makedirs(run_dir)
+                    config_file = os.path.join(run_dir, "config.json")
+                    create_config(pipeline, image_dir, config_file, main_config)
+
+                    print(f"Running {name} ({repetition + 1}/{args.repeat})...", flush=True)
+                    returncode, wall, peak_rss_mb, output_dir = run_shadowwolf(config_file, run_dir)
+                    run["returncode"] = returncode
+                    if returncode != 0:
+                        print(f"  Failed with return code {returncode}, c.f. {run_dir}/stdout.log")
+                        break
+                    walls.append(wall)
+                    run["peak_rss_mb"] = max(run.get("peak_rss_mb", 0), peak_rss_mb)
+                    run["modules"] = get_module_stats(output_dir)
+                    print(f"  {wall:.2f}s, {num_images / wall:.2f} images/s, peak RSS {peak_rss_mb:.0f} MB")
+
+                if len(walls):
+                    run["wall_s"] = walls
+                    run["images_per_s"] = num_images / statistics.median(walls)
+                results["runs"].append(run)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Stored results to {args.output}")
+    return results
+
+
+def compare(baseline_file, results):
+    """
+    Print the throughput of the current results relative to a previous benchmark
+    """
+    with open(baseline_file, "r") as f:
+        baseline = {r["name"]: r for r in json.load(f)["runs"]}
+
+    print(f"{'run':45s} {'before':>10s} {'after':>10s} {'speedup':>8s}")
+    for run in results["runs"]:
+        old = baseline.get(run["name"], {}).get("images_per_s")
+        new = run.get("images_per_s")
+        if old is None or new is None:
+            print(f"{run['name']:45s} {str(old):>10s} {str(new):>10s} {'-':>8s}")
+        else:
+            print(f"{run['name']:45s} {old:10.2f} {new:10.2f} {new / old:7.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of ShadowWolf with synthetic data.")
+    parser.add_argument("-w", "--work-dir", type=str, default="benchmark_work",
+                        help="Directory for the datasets and the runs. Datasets are reused.")
+    parser.add_argument("-o", "--output", type=str, default="benchmark_results.json", help="The result file.")
+    parser.add_argument("-p", "--pipelines", nargs="+", default=list(PIPELINES), choices=list(PIPELINES))
+    parser.add_argument("-r", "--resolutions", nargs="+", type=parse_resolution,
+                        default=[(640, 480), (1920, 1080)], help="Image resolutions, e.g. 640x480")
+    parser.add_argument("-n", "--images-per-sequence", nargs="+", type=int, default=[8, 32],
+                        help="Number of images per sequence, i.e. the batch size of the time batching")
+    parser.add_argument("-s", "--sequences", type=int, default=3, help="Number of sequences per dataset")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=1, help="Number of runs per combination, the median is used")
+    parser.add_argument("--set", nargs="*", default=[], metavar="KEY=VALUE",
+                        help="Additional main_config entries, e.g. workers=4 streaming=true")
+    parser.add_argument("--compare", type=str, default=None, help="Result file of a previous run to compare to")
+    args = parser.parse_args()
+
+    results = run_benchmark(args)
+    if args.compare is not None:
+        compare(args.compare, results)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+"""
+Create synthetic camera-trap like image sequences for benchmarks
+
+Each sequence has its own noisy background with a few blobs moving through the scene. The images are stored as jpg
+with the EXIF DateTime set: The images of one sequence are one second apart, the sequences ten minutes. I.e., the time
+batching creates one batch per sequence.
+"""
+
+import os
+import json
+import argparse
+import datetime
+from pathlib import Path
+
+import cv2
+import numpy as np
+import PIL.Image
+
+EXIF_DATETIME = 306
+
+START_TIME = datetime.datetime(2023, 8, 1, 6, 0, 0)
+FRAME_INTERVAL_S = 1
+SEQUENCE_INTERVAL_S = 600
+
+
+def get_background(rng, width, height):
+    """
+    A smooth gradient with some static texture
+    """
+    x = np.linspace(0, 1, width, dtype=np.float32)
+    y = np.linspace(0, 1, height, dtype=np.float32)
+    base = rng.uniform(40, 110, 3).astype(np.float32)
+    slope = rng.uniform(-40, 40, 3).astype(np.float32)
+    gradient = (x[np.newaxis, :, np.newaxis] + y[:, np.newaxis, np.newaxis]) / 2.0 * slope + base
+    texture = cv2.GaussianBlur(rng.normal(0, 25, (height, width, 3)).astype(np.float32), (0, 0), 3)
+    return gradient + texture
+
+
+def generate_dataset(directory, width=640, height=480, sequences=3, images_per_sequence=8, blobs=2, seed=0,
+                     noise=8.0, quality=90):
+    """
+    Create a dataset. Returns the number of created images.
+
+    Parameters
+    ----------
+    directory               Output directory
+    width                   Image width in pixels
+    height                  Image height in pixels
+    sequences               Number of sequences (i.e. time batches)
+    images_per_sequence     Number of images per sequence
+    blobs                   Maximum number of moving blobs per sequence
+    seed                    Seed for the random number generator. The same parameters create the same images
+    noise                   Standard deviation of the per image sensor noise
+    quality                 jpg quality
+    """
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    num = 0
+    for s in range(sequences):
+        background = get_background(rng, width, height)
+        movers = []
+        for _ in range(rng.integers(1, blobs + 1)):
+            axes = (rng.uniform(0.03, 0.1) * width, rng.uniform(0.03, 0.1) * height)
+            start = (rng.uniform(0, width), rng.uniform(height * 0.3, height))
+            velocity = (rng.uniform(-0.5, 0.5) * width / images_per_sequence,
+                        rng.uniform(-0.1, 0.1) * height / images_per_sequence)
+            color = tuple(float(c) for c in rng.uniform(120, 250, 3))
+            movers.append((axes, start, velocity, color))
+
+        for i in range(images_per_sequence):
+            img = background + rng.normal(0, noise, background.shape).astype(np.float32)
+            for axes, start, velocity, color in movers:
+                center = (int(start[0] + velocity[0] * i), int(start[1] + velocity[1] * i))
+                cv2.ellipse(img, center, (int(axes[0]), int(axes[1])), 0, 0, 360, color, -1)
+            img = np.clip(img, 0, 255).astype(np.uint8)
+
+            timestamp = START_TIME + datetime.timedelta(seconds=s * SEQUENCE_INTERVAL_S + i * FRAME_INTERVAL_S)
+            exif = PIL.Image.Exif()
+            exif[EXIF_DATETIME] = timestamp.strftime("%Y:%m:%d %H:%M:%S")
+            PIL.Image.fromarray(img[:, :, ::-1]).save(
+                os.path.join(directory, f"seq{s:03d}_img{i:04d}.jpg"),
+                exif=exif.tobytes(),
+                quality=quality,
+            )
+            num += 1
+    return num
+
+
+def get_dataset(base_dir, **params):
+    """
+    Return the directory of a dataset with the given parameters, create it if required.
+    """
+    name = "ds_" + "_".join(f"{k}-{params[k]}" for k in sorted(params))
+    directory = os.path.join(base_dir, name)
+    marker = os.path.join(directory, "dataset.json")
+    if not os.path.isfile(marker):
+        num = generate_dataset(directory, **params)
+        with open(marker, "w") as f:
+            json.dump({"params": params, "images": num}, f)
+    return directory
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create a synthetic image sequence for benchmarks.")
+    parser.add_argument("output", type=str, help="The output directory.")
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=480)
+    parser.add_argument("--sequences", type=int, default=3)
+    parser.add_argument("--images-per-sequence", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    n = generate_dataset(args.output, args.width, args.height, args.sequences, args.images_per_sequence,
+                         seed=args.seed)
+    print(f"Created {n} images in {args.output}")